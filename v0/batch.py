@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import sys
+import time
+from multiprocessing import Pool
+from dfindex import DFIndex
+from gsearch import *
+from localsearch import search_backend
+from rocchio import *
+from tokenizer import tokenizer
+
+## judgments and settings shared by the sessions of a worker process
+context = {}
+
+## load relevance judgments of documents
+#  the judgment file has one "<key> <label>" row per document, label is one
+#  of rel/irrel (also y/n, 1/0); without a judgment file, the keys listed in
+#  "tmp/rel.txt" and "tmp/irrel.txt" are used, as in interactive mode; the
+#  keys are canonicalized, so any copy of a URL can be judged
+#  @param path the judgment file, type: str
+#  @return mapping of document key to relevance, type: dict(key:str, value:bool)
+def load_judgments(path=None):
+    res = {}
+    if path:
+        with open(path, 'r') as f:
+            for line in f:
+                r = line.strip().rsplit(None, 1)
+                if len(r) != 2: continue
+                res[canonical_url(r[0])] = r[1].lower() in ['rel', 'relevant', 'y', 'yes', '1']
+        return res
+
+    for fname, relevant in [('tmp/rel.txt', True), ('tmp/irrel.txt', False)]:
+        try:
+            with open(fname, 'r') as f:
+                for line in f:
+                    r = line.rstrip()
+                    if r: res[canonical_url(r)] = relevant
+        except IOError:
+            pass
+    return res
+
+## set up the shared context of a worker process
+#  @param ctx judgments and settings, type: dict
+def init_worker(ctx):
+    context.update(ctx)
+    client_options.update(ctx['client'])
+    # one document frequency index per process, shared by its sessions
+    if ctx.get('dfindex'):
+        context['index'] = DFIndex(ctx['dfindex'])
+    # the source of search results, the local index is opened once per process
+    context['search_backend'] = search_backend(ctx['search'], ctx['api'], ctx['engine'],
+                                               ctx['local_index'])
+
+## run the search-feedback loop of one query without user interaction
+#  documents without judgment are treated as irrelevant, same as answering
+#  'N' in interactive mode
+#  @param task (line number, query string), type: tuple(int, str)
+#  @return per-query record, type: dict
+def run_session(task):
+    n, query = task
+    judgments = context['judgments']
+    query_terms = [unicode(i) for i in query.strip().split()]
+    index = context.get('index')
+    ro = Rocchio(context['alpha'], context['beta'], backend=context['backend'],
+                 dfindex=index, blend=context['blend'], phrases=context['phrases'])
+    record = {'id': n, 'query': query, 'iterations': []}
+
+    start = time.time()
+    iteration, precision, status = 0, 0.0, 'max iterations'
+    try:
+        while True:
+            t = time.time()
+            docs = gsearch(" ".join(query_terms), context['api'], context['engine'],
+                           htmltext=context['htmltext'], backend=context['search_backend'],
+                           duplicates=ro.duplicates, session=n, positional=context['phrases'],
+                           passages=context['passages'], vocab=ro.vocab)
+            if index is not None:
+                for d in docs:
+                    if d.duplicate_of is None:
+                        index.add_document(d)
+            # a copy of a page inherits the judgment of the page
+            judged = dict((d, judgments.get(d.key, judgments.get(d.duplicate_of))) for d in docs)
+            rel = set(d for d in docs if judged[d] is True)
+            irrel = set(docs) - rel
+            unjudged = sum(1 for d in docs if judged[d] is None)
+            precision = float(len(rel)) / len(docs) if docs else 0.0
+            it = {'iteration': iteration, 'query': " ".join(query_terms),
+                  'relevant': len(rel), 'irrelevant': len(irrel), 'unjudged': unjudged,
+                  'precision': precision}
+
+            if precision >= context['target_precision']:
+                status = 'achieved'
+            elif precision == 0:
+                status = 'zero precision'
+            else:
+                query_terms += ro.generate_query(rel, irrel, query_terms, context['k'])
+            it['time'] = time.time() - t
+            record['iterations'].append(it)
+
+            iteration += 1
+            if status != 'max iterations' or iteration >= context['max_iterations']:
+                break
+        if index is not None:
+            index.merge()
+    except Exception as e:
+        status = 'error: {}'.format(e)
+
+    record.update({'status': status, 'precision': precision,
+                   'nr_iterations': len(record['iterations']),
+                   'wall_time': time.time() - start})
+    if context['search'] != 'local':
+        record['api_requests'] = search_client(context['api'], context['engine']).spent(n)
+    return record
+
+
+## main
+def main(args):
+    api, engine = args.api, args.engine
+    if (not api or not engine) and args.search != 'local':
+        try:
+            import secrets
+            api = api or secrets.GSEARCH_JSON_API
+            engine = engine or secrets.GSEARCH_ENGINE
+        except:
+            print >> sys.stderr, "[ERROR] Search API or engine ID not specified"
+            exit(1)
+    if not 0 < args.target_precision <= 1.0:
+        print >> sys.stderr, "[ERROR] target precision {} not in range (0, 1]".format(
+            args.target_precision)
+        exit(1)
+    tokenizer.persist()
+
+    with open(args.queries, 'r') as f:
+        tasks = [(n, l.strip()) for n, l in enumerate(f) if l.strip()]
+    ctx = {'judgments': load_judgments(args.judgments), 'api': api, 'engine': engine,
+           'target_precision': args.target_precision, 'alpha': args.alpha,
+           'beta': args.beta, 'k': args.k, 'max_iterations': args.max_iterations,
+           'htmltext': args.htmltext, 'passages': args.passages, 'backend': args.backend,
+           'phrases': args.phrases, 'dfindex': args.dfindex, 'blend': args.blend,
+           'search': args.search, 'local_index': args.index,
+           'client': {'pages': args.pages, 'endpoint': args.endpoint, 'qps': args.qps,
+                      'daily_quota': args.daily_quota or None}}
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    pool = None
+    try:
+        if args.workers == 1:
+            init_worker(ctx)
+            records = (run_session(t) for t in tasks)
+        else:
+            pool = Pool(args.workers or None, init_worker, (ctx,))
+            records = pool.imap_unordered(run_session, tasks)
+        for record in records:
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+    except BaseException:
+        # the sessions left are dropped, e.g. on Ctrl-C
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Relevance Feedback Batch Evaluation')
+    parser.add_argument('queries', type=str, help='file of initial query strings, one per line')
+    parser.add_argument('--judgments', type=str,
+                        help='file of "<url> <rel|irrel>" rows, default tmp/rel.txt and tmp/irrel.txt')
+    parser.add_argument('--target-precision', type=float, default=0.9,
+                        help='target precision, (0, 1]')
+    parser.add_argument('--api', type=str, help='Google search API key')
+    parser.add_argument('--engine', type=str, help='Google search engine ID')
+    parser.add_argument('--alpha', type=float, default=0.75, help='weight of relevant documents')
+    parser.add_argument('--beta', type=float, default=0.25, help='weight of irrelevant documents')
+    parser.add_argument('-k', type=int, default=2, help='number of new query terms per iteration')
+    parser.add_argument('--max-iterations', type=int, default=10, help='maximum iterations per query')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes, default number of CPUs')
+    parser.add_argument('--output', type=str, help='output file of JSON lines, default stdout')
+    parser.add_argument('--htmltext', action="store_true",
+                        help='Use the scraped html text of webpages instead of snippets')
+    parser.add_argument('--passages', action="store_true",
+                        help='with --htmltext, index only the passages of webpages around the query terms')
+    parser.add_argument('--backend', type=str, default='python', choices=['python', 'matrix'],
+                        help='Rocchio weighting backend, "matrix" requires numpy')
+    parser.add_argument('--phrases', action="store_true",
+                        help='expand the queries with phrases as well, python backend only')
+    parser.add_argument('--search', type=str, default='google',
+                        choices=['google', 'local', 'fallback'],
+                        help='source of results: the API, the local index of cached documents, '
+                             'or the API falling back to the local index')
+    parser.add_argument('--index', type=str, default='tmp/local.idx',
+                        help='local index file, built by "localsearch.py build"')
+    parser.add_argument('--pages', type=int, default=1,
+                        help='result pages of 10 results fetched per query, at most 10')
+    parser.add_argument('--endpoint', type=str,
+                        help='URL of the search API, e.g. of a local fake for tests')
+    parser.add_argument('--qps', type=float, default=5.0,
+                        help='max search API requests per second of each worker')
+    parser.add_argument('--daily-quota', type=int, default=100,
+                        help='max search API requests per day of each worker, 0 for unlimited')
+    parser.add_argument('--dfindex', type=str,
+                        help='directory of a corpus-wide document frequency index to use and update')
+    parser.add_argument('--blend', type=float, default=0.5,
+                        help='weight of the corpus-wide idf against the session idf, [0, 1]')
+
+    main(parser.parse_args())
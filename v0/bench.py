@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+import argparse
+import ast
+import glob
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Process, Queue
+from timeit import default_timer as timer
+from gsearch import SearchDocument, vocabulary
+from invfile import InvertedFiles
+from localsearch import LocalSearch, write_index
+from rocchio import Rocchio
+from tokenizer import tokenizer
+
+## recorded results of Google search API
+recorded_files = ['../test_google/output.temp'] + glob.glob('tmp/q_*.txt')
+
+## load the result items of the recorded API responses
+#  @return type: list[dict]
+def recorded_items():
+    items = []
+    for fname in recorded_files:
+        try:
+            with open(fname, 'r') as f:
+                # output.temp is a printed dict rather than JSON
+                items += ast.literal_eval(f.read()).get('items', [])
+        except (IOError, SyntaxError, ValueError):
+            pass
+    return items
+
+## generate a synthetic corpus
+#  words are drawn from a Zipf-like distribution over the vocabulary, so
+#  that a few words are frequent and most are rare, as in real texts
+#  @param n number of documents, type: int
+#  @param vocab size of the vocabulary, type: int
+#  @param length number of words of a document, type: int
+#  @param seed random seed, type: int
+#  @return result items, each with a 'text' of the full document, type: list[dict]
+def synthetic_items(n, vocab, length, seed=0):
+    rnd = random.Random(seed)
+    words = ['w{}'.format(i) for i in range(vocab)]
+    weights, total = [], 0.0
+    for i in range(vocab):
+        total += 1.0 / (i + 1)
+        weights.append(total)
+
+    def draw():
+        x = rnd.random() * total
+        lo, hi = 0, vocab - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if weights[mid] < x: lo = mid + 1
+            else: hi = mid
+        return words[lo]
+
+    items = []
+    for i in range(n):
+        text = ' '.join(draw() for _ in range(length))
+        items.append({'title': ' '.join(draw() for _ in range(8)),
+                      'displayLink': 'example.com',
+                      'link': 'http://example.com/{}/{}'.format(seed, i),
+                      'snippet': text[:160], 'text': text})
+    return items
+
+## construct documents of the given items
+#  @param items type: list[dict]
+#  @param htmltext True to use the 'text' of items, type: bool
+#  @param positional (False) True to keep the order of the words, type: bool
+#  @param passages (False) True to count only the passages around the first
+#         words of the titles, as queries, type: bool
+#  @return type: list[SearchDocument]
+def make_documents(items, htmltext, positional=False, passages=False):
+    if htmltext:
+        return [SearchDocument(i, stemming=True, htmltext=True, normalize=True,
+                               text=i['text'], positional=positional,
+                               passages=frozenset(tokenizer.tokenize(
+                                   ' '.join(i['title'].split()[:2]))) if passages else None)
+                for i in items]
+    return [SearchDocument(i, stemming=True, normalize=True, positional=positional) \
+            for i in items]
+
+## peak resident memory of the process, in KB
+#  @return type: int
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+## time the construction of documents, and measure their size
+def bench_document(items, htmltext, iterations, passages=False):
+    start = timer()
+    docs = make_documents(items, htmltext, passages=passages)
+    res = {'seconds': timer() - start, 'items': len(docs)}
+    res['bytes_per_doc'] = sum(d.memory_usage() for d in docs) / max(1, len(docs))
+    res['words_per_doc'] = sum(d.size for d in docs) / max(1, len(docs))
+    res['vocabulary_bytes'] = vocabulary.memory_usage()
+    return res
+
+def bench_document_passages(items, htmltext, iterations):
+    return bench_document(items, htmltext, iterations, passages=True)
+
+## time the operations of inverted-files
+def bench_index(items, htmltext, iterations):
+    docs = make_documents(items, htmltext)
+    res = {'items': len(docs)}
+    start = timer()
+    invf = InvertedFiles(docs)
+    res['add_document'] = timer() - start
+    words = invf.words()
+    start = timer()
+    for w in words:
+        invf.df(w)
+    res['df'] = timer() - start
+    start = timer()
+    for w in words:
+        sum(invf.tfs(w).values())
+    res['tfs'] = timer() - start
+    res['seconds'] = res['add_document'] + res['df'] + res['tfs']
+    res['words'] = len(words)
+    res['index_bytes'] = invf.memory_usage()['total']
+    return res
+
+## time query expansion over several feedback iterations
+#  the documents are split evenly into iterations, 30% of each batch is
+#  judged relevant
+def bench_expansion(items, htmltext, iterations, backend='python', phrases=False):
+    docs = make_documents(items, htmltext, phrases)
+    ro = Rocchio(0.75, 0.25, backend=backend, phrases=phrases)
+    size = max(1, len(docs) // iterations)
+    per_iteration = []
+    for i in range(0, len(docs), size):
+        batch = docs[i:i+size]
+        cut = max(1, int(len(batch) * 0.3))
+        start = timer()
+        ro.generate_query(batch[:cut], batch[cut:], ['w0'])
+        per_iteration.append(timer() - start)
+    return {'seconds': sum(per_iteration), 'iterations': per_iteration, 'items': len(docs)}
+
+def bench_expansion_matrix(items, htmltext, iterations):
+    return bench_expansion(items, htmltext, iterations, backend='matrix')
+
+def bench_expansion_phrases(items, htmltext, iterations):
+    return bench_expansion(items, htmltext, iterations, phrases=True)
+
+## time building the local BM25 index and answering queries from it
+#  the queries are the first words of the titles, plus 2 expansion terms 
+#  drawn from the snippets, as in a feedback iteration
+def bench_search(items, htmltext, iterations):
+    fd, path = tempfile.mkstemp(suffix='.idx')
+    os.close(fd)
+    try:
+        start = timer()
+        write_index(path, [(i, i.get('text') if htmltext else None) for i in items])
+        res = {'build': timer() - start, 'items': len(items),
+               'index_bytes': os.path.getsize(path)}
+        index = LocalSearch(path)
+        queries = [' '.join(i['title'].split()[:2] + i['snippet'].split()[-2:]) \
+                   for i in items[:1000]] * iterations
+        start = timer()
+        for q in queries:
+            index.search(q)
+        res['seconds'] = timer() - start
+        res['queries'] = len(queries)
+        res['qps'] = len(queries) / res['seconds'] if res['seconds'] else 0.0
+        index.close()
+    finally:
+        os.remove(path)
+    return res
+
+## modules whose import is slow, and should only be imported when needed
+heavy_modules = ['nltk', 'googleapiclient', 'numpy', 'scipy']
+## run in a new process: import the program, then build the documents of
+#  the recorded results, as the first iteration of a fully cached run
+startup_script = """
+import json, sys
+from timeit import default_timer as timer
+start = timer()
+import main
+imported = timer() - start
+main.tokenizer.persist()
+from bench import recorded_items, make_documents
+make_documents(recorded_items(), False)
+print json.dumps({'import': imported, 'documents': timer() - start - imported,
+                  'modules': [m for m in %r if m in sys.modules]})
+""" % heavy_modules
+
+## time the startup of the program in new processes, the first run may
+#  fill the caches on disk (e.g. the stems), the fastest run is kept
+def bench_startup(items, htmltext, iterations):
+    res = None
+    for _ in range(max(2, iterations)):
+        start = timer()
+        out = subprocess.check_output([sys.executable, '-c', startup_script])
+        run = json.loads(out.strip().splitlines()[-1])
+        run['seconds'] = timer() - start
+        if res is None or run['seconds'] < res['seconds']:
+            res = run
+    return res
+
+## benchmarks that don't depend on the corpus, run once
+corpus_free = set(['startup'])
+
+## all benchmarks
+benchmarks = {
+    'document': bench_document,
+    'document-passages': bench_document_passages,
+    'index': bench_index,
+    'expansion': bench_expansion,
+    'expansion-matrix': bench_expansion_matrix,
+    'expansion-phrases': bench_expansion_phrases,
+    'search': bench_search,
+    'startup': bench_startup,
+}
+
+
+## run one benchmark case in the current process
+#  @param case type: dict
+#  @return type: dict
+def run_case(case):
+    if case['corpus'] == 'recorded':
+        items = recorded_items()
+    else:
+        items = synthetic_items(case['docs'], case['vocab'], case['length'], case['seed'])
+    rss = peak_rss()
+    res = benchmarks[case['bench']](items, case['htmltext'], case['iterations'])
+    res['peak_rss_kb'] = peak_rss()
+    res['rss_growth_kb'] = res['peak_rss_kb'] - rss
+    return res
+
+## run one benchmark case in a child process, so that peak memory is
+#  measured for the case alone
+#  @param case type: dict
+#  @return type: dict
+def run_isolated(case):
+    q = Queue()
+    def child():
+        try:
+            q.put(run_case(case))
+        except Exception as e:
+            q.put({'error': repr(e)})
+    p = Process(target=child)
+    p.start()
+    res = q.get()
+    p.join()
+    return res
+
+## name of a benchmark case
+#  @param case type: dict
+#  @return type: str
+def case_name(case):
+    if case['corpus'] == 'recorded':
+        corpus = 'recorded'
+    else:
+        corpus = 'synthetic-n{docs}-v{vocab}-l{length}'.format(**case)
+    return '{}/{}{}'.format(case['bench'], corpus, '-html' if case['htmltext'] else '')
+
+## compare results against a baseline
+#  @param results type: dict(key:str, value:dict)
+#  @param baseline type: dict(key:str, value:dict)
+#  @param tolerance allowed relative slowdown, type: float
+#  @return list of (name, baseline seconds, seconds, ratio, regressed), type: list[tuple]
+def compare(results, baseline, tolerance):
+    res = []
+    for name in sorted(results):
+        if name not in baseline or 'seconds' not in baseline[name] \
+                or 'seconds' not in results[name]:
+            continue
+        old, new = baseline[name]['seconds'], results[name]['seconds']
+        ratio = new / old if old else float('inf')
+        res.append((name, old, new, ratio, ratio > 1 + tolerance))
+    return res
+
+
+## main
+def main(args):
+    tokenizer.persist()
+    cases = []
+    for bench in args.bench.split(','):
+        if bench not in benchmarks:
+            print >> sys.stderr, "[ERROR] unknown benchmark: {}".format(bench)
+            exit(1)
+        if args.recorded or bench in corpus_free:
+            cases.append({'bench': bench, 'corpus': 'recorded', 'htmltext': False,
+                          'iterations': args.iterations})
+        if bench in corpus_free:
+            continue
+        for n in [int(i) for i in args.docs.split(',') if i]:
+            for v in [int(i) for i in args.vocab.split(',') if i]:
+                cases.append({'bench': bench, 'corpus': 'synthetic', 'docs': n, 'vocab': v,
+                              'length': args.length, 'seed': args.seed,
+                              'htmltext': args.htmltext, 'iterations': args.iterations})
+
+    results = {}
+    for case in cases:
+        name = case_name(case)
+        runs = [run_isolated(case) for _ in range(args.repeat)]
+        ok = [r for r in runs if 'error' not in r]
+        res = min(ok, key=lambda r: r['seconds']) if ok else runs[0]
+        res['case'] = case
+        results[name] = res
+        print >> sys.stderr, "{:<60} {}".format(name, "%.4fs" % res['seconds'] \
+            if 'seconds' in res else res['error'])
+
+    output = {'meta': {'python': platform.python_version(), 'machine': platform.machine(),
+                       'repeat': args.repeat},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+    else:
+        print json.dumps(output, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressed = False
+        for name, old, new, ratio, bad in compare(results, baseline, args.tolerance):
+            print >> sys.stderr, "{:<60} {:.4f}s -> {:.4f}s  x{:.2f}{}".format(
+                name, old, new, ratio, '  REGRESSION' if bad else '')
+            regressed = regressed or bad
+        if regressed:
+            exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of document, index and expansion')
+    parser.add_argument('--bench', type=str, default='document,index,expansion',
+                        help='comma separated benchmarks: ' + ', '.join(sorted(benchmarks)))
+    parser.add_argument('--docs', type=str, default='10,100,1000,10000',
+                        help='comma separated numbers of synthetic documents, e.g. 10,100000')
+    parser.add_argument('--vocab', type=str, default='1000,50000',
+                        help='comma separated vocabulary sizes of synthetic corpora')
+    parser.add_argument('--length', type=int, default=40, help='words per synthetic document')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of synthetic corpora')
+    parser.add_argument('--no-recorded', dest='recorded', action='store_false',
+                        help='skip the recorded API results')
+    parser.add_argument('--htmltext', action="store_true",
+                        help='build synthetic documents from full text instead of snippets')
+    parser.add_argument('--iterations', type=int, default=10, help='feedback iterations of expansion')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest is kept')
+    parser.add_argument('--output', type=str, help='output JSON file, default stdout')
+    parser.add_argument('--baseline', type=str, help='baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative slowdown against the baseline')
+
+    main(parser.parse_args())
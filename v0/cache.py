@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import urlparse
+import zlib
+from collections import OrderedDict
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""LRU Cache class
+
+a bounded in-memory mapping, when the number of entries exceeds the capacity
+the least recently used entry is evicted. Hits, misses and evictions are
+counted. It is thread-safe.
+"""
+class LRUCache(object):
+    ## the constructor
+    #  @param capacity max number of entries, type: int
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.hits = self.misses = self.evictions = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    ## value of the given key, marked as most recently used
+    #  @param key type: hashable
+    #  @param default returned if key is not cached
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__data[key] = value
+            self.hits += 1
+            return value
+
+    ## cache the value of the given key, may evict the least recently used
+    #  @param key type: hashable
+    #  @param value
+    def put(self, key, value):
+        with self.__lock:
+            self.__data.pop(key, None)
+            self.__data[key] = value
+            while len(self.__data) > self.capacity:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+
+    ## remove the given key if cached
+    #  @param key type: hashable
+    def pop(self, key, default=None):
+        with self.__lock:
+            return self.__data.pop(key, default)
+
+    ## remove all entries
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    ## cached items, from the least to the most recently used
+    #  @return type: list[tuple]
+    def items(self):
+        with self.__lock:
+            return self.__data.items()
+
+    ## counters of the cache
+    #  @return type: dict(key:str, value:number)
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self.__data), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / total if total else 0.0}
+
+
+## normalize URL so that equivalent spellings share one cache entry
+#  the scheme and host are lowercased, the default port and the fragment
+#  are removed, and an empty path becomes '/'
+#  @param url type: str
+#  @return type: str
+def normalize_url(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    parts = urlparse.urlsplit(url.strip())
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    if (scheme, netloc.rpartition(':')[2]) in [('http', '80'), ('https', '443')]:
+        netloc = netloc.rpartition(':')[0]
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+"""Scrape Cache class
+
+on-disk cache of scraped text contents, keyed by the SHA-1 of the normalized
+URL so that keys are stable across interpreters. Entries are sharded into
+sub-directories by the first two hex digits of the key, and each entry is
+a line of JSON metadata (URL, fetch time, size, status, codec) followed by
+the compressed text. The total size on disk is bounded, the least recently
+used entries are evicted first, and a small in-memory tier keeps the hottest
+entries.
+"""
+class ScrapeCache(object):
+    ## the constructor
+    #  @param local_dir the directory of the cache, type: str
+    #  @param max_bytes max total size of the entries on disk, type: int
+    #  @param hot_entries number of entries kept in memory, type: int
+    #  @param codec 'zlib' or 'zstd' compression of new entries, type: str
+    def __init__(self, local_dir="scrapings", max_bytes=256*1024*1024, hot_entries=64,
+                 codec='zlib'):
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError("zstandard is required for the zstd codec")
+        if codec not in ('zlib', 'zstd'):
+            raise ValueError("invalid codec: {}".format(codec))
+        self.dir = local_dir
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.hot = LRUCache(hot_entries)
+        self.hits = self.misses = self.evictions = 0
+        self.__lock = threading.RLock()
+        self.__index = None # key to entry size, in LRU order
+        self.__size = 0
+
+    ## cache key of the given URL
+    #  @param url type: str
+    #  @return type: str
+    def key(self, url):
+        return hashlib.sha1(normalize_url(url)).hexdigest()
+
+    ## path of the cache file of the given key
+    #  @param key type: str
+    #  @return type: str
+    def __path(self, key):
+        return os.path.join(self.dir, key[:2], key)
+
+    ## the LRU index of the entries on disk, scanned on first use
+    #  @return type: OrderedDict(key:str, value:int)
+    def __entries(self):
+        if self.__index is None:
+            entries = []
+            if os.path.isdir(self.dir):
+                for root, _, files in os.walk(self.dir):
+                    for f in files:
+                        if len(f) != 40: continue
+                        st = os.stat(os.path.join(root, f))
+                        entries.append((st.st_mtime, f, st.st_size))
+            entries.sort()
+            self.__index = OrderedDict((f, size) for _, f, size in entries)
+            self.__size = sum(self.__index.values())
+        return self.__index
+
+    ## encode an entry
+    #  @param meta type: dict
+    #  @param text type: str
+    #  @return type: str
+    def __encode(self, meta, text):
+        if self.codec == 'zstd':
+            payload = zstandard.ZstdCompressor().compress(text)
+        else:
+            payload = zlib.compress(text)
+        meta['codec'] = self.codec
+        return json.dumps(meta) + '\n' + payload
+
+    ## decode an entry
+    #  @param data type: str
+    #  @return (metadata, text), type: tuple(dict, str)
+    def __decode(self, data):
+        header, _, payload = data.partition('\n')
+        meta = json.loads(header)
+        if meta.get('codec') == 'zstd':
+            if zstandard is None:
+                raise ImportError("zstandard is required to read zstd entries")
+            return meta, zstandard.ZstdDecompressor().decompress(payload)
+        return meta, zlib.decompress(payload)
+
+    ## look up the given URL
+    #  @param url type: str
+    #  @return (metadata, text), None if not cached, type: tuple(dict, str)
+    def get_entry(self, url):
+        key = self.key(url)
+        entry = self.hot.get(key)
+        if entry is not None:
+            with self.__lock:
+                self.hits += 1
+                index = self.__entries()
+                if key in index:
+                    index[key] = index.pop(key)
+            return entry
+
+        with self.__lock:
+            index = self.__entries()
+            try:
+                with open(self.__path(key), 'rb') as f:
+                    data = f.read()
+                entry = self.__decode(data)
+            except (IOError, OSError, ValueError, zlib.error):
+                self.misses += 1
+                return None
+            self.hits += 1
+            # mark as most recently used, on disk as well; the entry may 
+            # have been written by another process
+            if key not in index:
+                self.__size += len(data)
+            index[key] = index.pop(key, len(data))
+            try:
+                os.utime(self.__path(key), None)
+            except OSError:
+                pass
+        self.hot.put(key, entry)
+        return entry
+
+    ## text contents of the given URL
+    #  @param url type: str
+    #  @return text contents, None if not cached, type: str
+    def get(self, url):
+        entry = self.get_entry(url)
+        return entry[1] if entry else None
+
+    ## save the text contents of the given URL, evicting the least recently
+    #  used entries if the cache is over its size cap
+    #  @param url type: str
+    #  @param text type: str
+    #  @param status HTTP status of the page, type: int
+    def put(self, url, text, status=200):
+        key = self.key(url)
+        meta = {'url': normalize_url(url), 'fetched': time.time(), 'size': len(text),
+                'status': status}
+        data = self.__encode(meta, text)
+        path = self.__path(key)
+        with self.__lock:
+            index = self.__entries()
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+            self.__size += len(data) - index.pop(key, 0)
+            index[key] = len(data)
+            self.__evict()
+        meta['codec'] = self.codec
+        self.hot.put(key, (meta, text))
+
+    ## evict the least recently used entries until under the size cap
+    def __evict(self):
+        index = self.__index
+        while self.__size > self.max_bytes and index:
+            key, size = index.popitem(last=False)
+            self.__size -= size
+            self.evictions += 1
+            self.hot.pop(key)
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+
+    ## iterate over all cached entries on disk
+    #  @return generator of (metadata, text), type: generator(tuple(dict, str))
+    def entries(self):
+        with self.__lock:
+            keys = list(self.__entries().keys())
+        for key in keys:
+            try:
+                with open(self.__path(key), 'rb') as f:
+                    yield self.__decode(f.read())
+            except (IOError, OSError, ValueError, zlib.error):
+                continue
+
+    ## counters of the cache
+    #  @return type: dict(key:str, value:number)
+    def stats(self):
+        with self.__lock:
+            index = self.__entries()
+            total = self.hits + self.misses
+            return {'entries': len(index), 'bytes': self.__size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'hot_hits': self.hot.hits,
+                    'hit_rate': float(self.hits) / total if total else 0.0}
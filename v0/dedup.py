@@ -0,0 +1,195 @@
+import hashlib
+import re
+import struct
+import threading
+import urlparse
+from array import array
+from collections import defaultdict
+from cache import LRUCache
+from snapshot import pack_strings
+
+## query parameters that only track the visit, e.g. "?utm_source=news"
+tracking_params = frozenset(['gclid', 'fbclid', 'msclkid', 'yclid', 'dclid', 'igshid',
+                             'mc_cid', 'mc_eid', 'ref', 'ref_src', '_ga', '_hsenc', '_hsmi'])
+tracking_prefixes = ('utm_',)
+
+## the scheme of an absolute URL, e.g. "http://"
+url_scheme = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+
+## canonical form of a URL, the key of a document
+#  the scheme is dropped so that http and https copies agree, as well as the
+#  "www." prefix, default ports, the fragment, trailing slashes and tracking
+#  parameters; the remaining parameters are sorted. A URL without scheme,
+#  e.g. "www.example.com/a" as displayed, is taken to start with the host
+#  @param url type: str
+#  @return scheme-relative URL, e.g. "//example.com/a?x=1", type: str
+def canonical_url(url):
+    s = url.strip()
+    if not s.startswith('//') and not url_scheme.match(s):
+        s = '//' + s
+    try:
+        parts = urlparse.urlsplit(s)
+        host, port = (parts.hostname or '').lower(), parts.port
+    except ValueError:
+        return url
+    if not host:
+        return url
+    if host.startswith('www.'):
+        host = host[4:]
+    if port and port not in [80, 443]:
+        host += ':{}'.format(port)
+    path = parts.path.rstrip('/') or '/'
+    params = sorted(p for p in parts.query.split('&') if p and not \
+                    (p.partition('=')[0].lower() in tracking_params or \
+                     p.lower().startswith(tracking_prefixes)))
+    return '//' + host + path + ('?' + '&'.join(params) if params else '')
+
+
+## 64-bit hashes of words, stable across interpreters
+word_hashes = LRUCache(100000)
+
+## 64-bit hash of a word
+#  @param word type: str
+#  @return type: int
+def word_hash(word):
+    h = word_hashes.get(word)
+    if h is None:
+        data = word.encode('utf-8') if isinstance(word, unicode) else word
+        h = struct.unpack('<Q', hashlib.md5(data).digest()[:8])[0]
+        word_hashes.put(word, h)
+    return h
+
+## the +1/-1 contributions of the 8 bits of each byte value to a SimHash
+byte_signs = [[1 if v >> b & 1 else -1 for b in xrange(8)] for v in xrange(256)]
+
+## SimHash fingerprint of a document, documents with similar words have
+#  fingerprints differing in few bits. The weights are summed by byte value
+#  for each of the 8 bytes of the word hashes first, and only then spread over
+#  the bits, since a page has many more words than distinct byte values
+#  @param tf term frequencies, type: dict(key:str, value:float)
+#  @return 64-bit fingerprint, None if there is no word, type: int
+def simhash(tf):
+    if not tf:
+        return None
+    tables = [defaultdict(float) for _ in xrange(8)]
+    for word, freq in tf.items():
+        h = word_hash(word)
+        for table in tables:
+            table[h & 255] += freq
+            h >>= 8
+    res = 0
+    for i, table in enumerate(tables):
+        v = [0.0] * 8
+        for byte, weight in table.iteritems():
+            v = [a + weight * s for a, s in zip(v, byte_signs[byte])]
+        for b in xrange(8):
+            if v[b] > 0:
+                res |= 1 << (8 * i + b)
+    return res
+
+## number of differing bits of two fingerprints
+#  @param a/b type: int
+#  @return type: int
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+"""Duplicate Index class
+
+finds the documents already seen that a document repeats, either by its key
+(the canonical URL) or by its SimHash fingerprint. Fingerprints within
+max_distance bits of each other are near-duplicates, e.g. mirrors or
+syndicated copies of a page. They are found without comparing against every
+document: the 64 bits are split into max_distance+1 bands, and two
+fingerprints that close must agree on at least one whole band, so only the
+documents sharing a band with the fingerprint are compared.
+
+The index is thread-safe.
+"""
+class DuplicateIndex(object):
+    ## the constructor
+    #  @param max_distance (3) max differing bits of near-duplicates, type: int
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        self.__bits = 64 // (max_distance + 1) # bits of each band
+        self.__fingerprints = {} # key to fingerprint, None if unknown
+        self.__bands = [{} for _ in xrange(max_distance + 1)] # band value to keys
+        self.__lock = threading.Lock()
+
+    ## values of the bands of a fingerprint
+    #  @param fingerprint type: int
+    #  @return type: list[int]
+    def __split(self, fingerprint):
+        mask = (1 << self.__bits) - 1
+        return [fingerprint >> (i * self.__bits) & mask for i in xrange(len(self.__bands))]
+
+    ## add a document
+    #  @param key type: str
+    #  @param fingerprint (None) type: int
+    def add(self, key, fingerprint=None):
+        with self.__lock:
+            if key in self.__fingerprints:
+                return
+            self.__fingerprints[key] = fingerprint
+            if fingerprint is None:
+                return
+            for band, value in zip(self.__bands, self.__split(fingerprint)):
+                band.setdefault(value, []).append(key)
+
+    ## key of a near-duplicate of the given fingerprint
+    #  @param fingerprint type: int
+    #  @return None if there is none, type: str
+    def near(self, fingerprint):
+        if fingerprint is None:
+            return None
+        with self.__lock:
+            for band, value in zip(self.__bands, self.__split(fingerprint)):
+                for key in band.get(value, []):
+                    if distance(fingerprint, self.__fingerprints[key]) <= self.max_distance:
+                        return key
+        return None
+
+    ## key of the document the given one repeats, the key itself if already
+    #  added, else the key of a near-duplicate
+    #  @param key type: str
+    #  @param fingerprint (None) type: int
+    #  @return None if the document is new, type: str
+    def find(self, key, fingerprint=None):
+        if key in self:
+            return key
+        return self.near(fingerprint)
+
+    def __contains__(self, key):
+        return key in self.__fingerprints
+
+    def __len__(self):
+        return len(self.__fingerprints)
+
+    ## save the index as two sections of a snapshot, "<name>.keys" and
+    #  "<name>.fps", unknown fingerprints are saved as 0
+    #  @param writer type: SnapshotWriter
+    #  @param name type: str
+    def save(self, writer, name):
+        with self.__lock:
+            keys = list(self.__fingerprints)
+            fingerprints = array('I')
+            for k in keys:
+                fp = self.__fingerprints[k] or 0
+                fingerprints.extend([fp & 0xffffffff, fp >> 32])
+        writer.add(name + '.keys', pack_strings(keys))
+        writer.add(name + '.fps', fingerprints.tostring())
+
+    ## load an index saved by save()
+    #  @param snapshot type: Snapshot
+    #  @param name type: str
+    #  @param max_distance (3) type: int
+    #  @return type: DuplicateIndex
+    @classmethod
+    def load(cls, snapshot, name, max_distance=3):
+        index = cls(max_distance)
+        fingerprints = array('I')
+        fingerprints.fromstring(snapshot.read(name + '.fps'))
+        for i, key in enumerate(snapshot.strings(name + '.keys')):
+            fp = fingerprints[2 * i] | fingerprints[2 * i + 1] << 32
+            index.add(key, fp or None)
+        return index
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+
+import argparse
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict
+from math import log
+from cache import LRUCache, ScrapeCache
+from dedup import canonical_url
+from tokenizer import tokenizer
+
+## header of a segment file: magic, number of documents, terms and keys
+header = struct.Struct('<4sQII')
+magic = 'DFX1'
+key_size = 20 # SHA-1 digest of the canonical URL
+
+## document key of the given URL, the same for the copies of a page that
+#  only differ by scheme, "www.", tracking parameters and the like
+#  @param url the URL or the canonical URL (SearchDocument.key), type: str
+#  @return type: str (20 bytes)
+def doc_key(url):
+    key = canonical_url(url)
+    return hashlib.sha1(key.encode('utf-8') if isinstance(key, unicode) else key).digest()
+
+"""Document frequency segment class
+
+one immutable file of the index, memory-mapped and read in place, so that
+opening it costs nothing however large it is and the pages are shared by
+every process that has it open. The layout is:
+    header      magic, number of documents N, terms T, document keys K
+    offsets     T+1 uint32, offset of each term in the string area
+    dfs         T uint32, document frequency of each term
+    keys        K * 20 bytes, sorted SHA-1 keys of the counted documents
+    strings     UTF-8 terms, in sorted order
+Terms and keys are looked up by binary search.
+"""
+class DFSegment(object):
+    ## the constructor
+    #  @param path type: str
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        tag, self.nr_docs, self.nr_terms, self.nr_keys = header.unpack_from(self.__mm, 0)
+        if tag != magic:
+            raise ValueError("not a df segment: {}".format(path))
+        self.__offsets = header.size
+        self.__dfs = self.__offsets + 4 * (self.nr_terms + 1)
+        self.__keys = self.__dfs + 4 * self.nr_terms
+        self.__strings = self.__keys + key_size * self.nr_keys
+
+    ## term of the given index
+    #  @param i type: int
+    #  @return UTF-8 term, type: str
+    def __term(self, i):
+        start, end = struct.unpack_from('<II', self.__mm, self.__offsets + 4 * i)
+        return self.__mm[self.__strings + start:self.__strings + end]
+
+    ## document key of the given index
+    #  @param i type: int
+    #  @return type: str
+    def __key(self, i):
+        pos = self.__keys + key_size * i
+        return self.__mm[pos:pos + key_size]
+
+    ## index of the first item not less than the given value
+    #  @param item function of the index to the item, type: function(int)
+    #  @param n number of items, type: int
+    #  @param value type: str
+    #  @return type: int
+    @staticmethod
+    def __bisect(item, n, value):
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if item(mid) < value: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    ## document frequency of the given UTF-8 term
+    #  @param term type: str
+    #  @return type: int
+    def df(self, term):
+        i = self.__bisect(self.__term, self.nr_terms, term)
+        if i < self.nr_terms and self.__term(i) == term:
+            return struct.unpack_from('<I', self.__mm, self.__dfs + 4 * i)[0]
+        return 0
+
+    ## whether the document of the given key is counted
+    #  @param key type: str
+    #  @return type: bool
+    def has_document(self, key):
+        i = self.__bisect(self.__key, self.nr_keys, key)
+        return i < self.nr_keys and self.__key(i) == key
+
+    ## iterate over (UTF-8 term, df) in sorted order
+    #  @return type: generator(tuple(str, int))
+    def iteritems(self):
+        for i in xrange(self.nr_terms):
+            yield self.__term(i), struct.unpack_from('<I', self.__mm, self.__dfs + 4 * i)[0]
+
+    ## iterate over the document keys in sorted order
+    #  @return type: generator(str)
+    def keys(self):
+        for i in xrange(self.nr_keys):
+            yield self.__key(i)
+
+    def close(self):
+        self.__mm.close()
+
+    ## write a segment file, atomically
+    #  @param path type: str
+    #  @param nr_docs number of documents, type: int
+    #  @param dfs UTF-8 term to df, type: dict(key:str, value:int)
+    #  @param keys document keys, type: iterable(str)
+    @staticmethod
+    def write(path, nr_docs, dfs, keys):
+        terms = sorted(dfs)
+        keys = sorted(keys)
+        offsets, pos = [0], 0
+        for t in terms:
+            pos += len(t)
+            offsets.append(pos)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(header.pack(magic, nr_docs, len(terms), len(keys)))
+            f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+            f.write(struct.pack('<{}I'.format(len(terms)), *[dfs[t] for t in terms]))
+            f.write(''.join(keys))
+            f.write(''.join(terms))
+        os.rename(tmp, path)
+
+
+"""Document frequency index class
+
+a persistent corpus-wide document frequency of words, built up from every
+document the system has seen, so that idf is meaningful from the very first
+feedback iteration instead of being derived from a dozen session documents.
+
+The index is a directory of immutable memory-mapped segments listed in a
+MANIFEST file. New documents are counted in memory and written as a new
+segment by merge(); once there are more than max_segments segments they are
+compacted into one. Writers take a file lock, and replace the MANIFEST
+atomically, so that several processes can read and update the same index.
+Each document is counted once, by the SHA-1 of its normalized URL.
+"""
+class DFIndex(object):
+    ## the constructor
+    #  @param path the directory of the index, type: str
+    #  @param max_segments segments kept before compaction, type: int
+    #  @param cache_size number of cached df lookups, type: int
+    def __init__(self, path="tmp/dfindex", max_segments=8, cache_size=100000):
+        self.path = path
+        self.max_segments = max_segments
+        self.__cache = LRUCache(cache_size)
+        self.__lock = threading.RLock()
+        self.__segments = []
+        self.__manifest = None # (mtime, size, inode) of the loaded MANIFEST
+        # documents counted but not yet merged: key to UTF-8 terms, and
+        # the df of the terms over them
+        self.__pending = {}
+        self.__pending_dfs = defaultdict(int)
+        self.reload()
+
+    ## read the MANIFEST
+    #  @return segment file names, type: list[str]
+    def __read_manifest(self):
+        try:
+            with open(os.path.join(self.path, 'MANIFEST'), 'r') as f:
+                return [l.strip() for l in f if l.strip()]
+        except IOError:
+            return []
+
+    ## (re)open the segments listed in the MANIFEST if it has changed
+    def reload(self):
+        manifest = os.path.join(self.path, 'MANIFEST')
+        with self.__lock:
+            try:
+                st = os.stat(manifest)
+                stamp = (st.st_mtime, st.st_size, st.st_ino)
+            except OSError:
+                stamp = None
+            if stamp == self.__manifest:
+                return
+            for retry in range(100):
+                try:
+                    segments = [DFSegment(os.path.join(self.path, name))
+                                for name in self.__read_manifest()]
+                    break
+                except (IOError, OSError):
+                    # a segment was compacted away after the MANIFEST was
+                    # read, the new MANIFEST lists its replacement
+                    if retry == 99: raise
+                    time.sleep(0.01)
+            for s in self.__segments:
+                s.close()
+            self.__segments = segments
+            self.__manifest = stamp
+            self.__cache.clear()
+
+    ## number of documents counted
+    #  @return type: int
+    def nr_docs(self):
+        return sum(s.nr_docs for s in self.__segments) + len(self.__pending)
+
+    ## document frequency of the given word
+    #  @param word type: str
+    #  @return type: int
+    def df(self, word):
+        term = word.encode('utf-8') if isinstance(word, unicode) else word
+        df = self.__cache.get(term)
+        if df is None:
+            df = sum(s.df(term) for s in self.__segments)
+            self.__cache.put(term, df)
+        return df + self.__pending_dfs.get(term, 0)
+
+    ## smoothed inverse document frequency of the given word
+    #  idf is log((N+1)/(df+1)), log is base 10, so that a word never seen
+    #  gets the largest idf rather than none
+    #  @param word type: str
+    #  @return None if the index is empty, type: float
+    def idf(self, word):
+        n = self.nr_docs()
+        if n == 0: return None
+        return log(float(n + 1) / (self.df(word) + 1), 10)
+
+    ## whether the document of the given URL is counted
+    #  @param url type: str
+    #  @return type: bool
+    def __contains__(self, url):
+        key = doc_key(url)
+        return key in self.__pending or any(s.has_document(key) for s in self.__segments)
+
+    ## count the words of a document, unless already counted
+    #  @param url type: str
+    #  @param words words of the document, type: iterable(str)
+    #  @return True if counted, type: bool
+    def add(self, url, words):
+        terms = set(w.encode('utf-8') if isinstance(w, unicode) else w for w in words)
+        with self.__lock:
+            # checked under the lock, so that concurrent adds count it once
+            if url in self:
+                return False
+            self.__pending[doc_key(url)] = terms
+            for t in terms:
+                self.__pending_dfs[t] += 1
+        return True
+
+    ## count the words of a search document, unless already counted
+    #  @param doc type: SearchDocument
+    #  @return True if counted, type: bool
+    def add_document(self, doc):
+        return self.add(doc.key, doc.tf.keys())
+
+    ## run a function holding the file lock of the index, with the latest
+    #  MANIFEST loaded
+    #  @param func type: function()
+    def __locked(self, func):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, 'LOCK'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with self.__lock:
+                    self.reload()
+                    return func()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    ## replace the MANIFEST, and remove the segments no longer listed
+    #  @param names segment file names, type: list[str]
+    def __commit(self, names):
+        old = set(self.__read_manifest())
+        manifest = os.path.join(self.path, 'MANIFEST')
+        tmp = "{}.{}.tmp".format(manifest, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(''.join(n + '\n' for n in names))
+        os.rename(tmp, manifest)
+        for name in old - set(names):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+        self.reload()
+
+    ## a new segment file name
+    #  @return type: str
+    def __new_name(self):
+        return "{:.6f}-{}.dfx".format(time.time(), os.getpid())
+
+    ## write the pending counts as a new segment, compacting if there are
+    #  too many segments
+    #  @return number of documents merged, type: int
+    def merge(self):
+        def merge():
+            # drop documents counted by other processes in the meantime
+            keys = [k for k in self.__pending
+                    if not any(s.has_document(k) for s in self.__segments)]
+            if keys:
+                dfs = self.__pending_dfs
+                if len(keys) < len(self.__pending):
+                    dfs = defaultdict(int)
+                    for k in keys:
+                        for t in self.__pending[k]:
+                            dfs[t] += 1
+                name = self.__new_name()
+                DFSegment.write(os.path.join(self.path, name), len(keys), dfs, keys)
+                self.__commit(self.__read_manifest() + [name])
+            self.__pending = {}
+            self.__pending_dfs = defaultdict(int)
+            if len(self.__segments) > self.max_segments:
+                self.__compact()
+            return len(keys)
+        if not self.__pending:
+            return 0
+        return self.__locked(merge)
+
+    ## merge all segments into one
+    def __compact(self):
+        if len(self.__segments) <= 1:
+            return
+        dfs, keys, n = defaultdict(int), set(), 0
+        for s in self.__segments:
+            n += s.nr_docs
+            for term, df in s.iteritems():
+                dfs[term] += df
+            keys.update(s.keys())
+        name = self.__new_name()
+        DFSegment.write(os.path.join(self.path, name), n, dfs, keys)
+        self.__commit([name])
+
+    ## merge all segments into one
+    def compact(self):
+        self.__locked(self.__compact)
+
+    ## counters of the index
+    #  @return type: dict(key:str, value:number)
+    def stats(self):
+        return {'documents': self.nr_docs(), 'segments': len(self.__segments),
+                'terms': sum(s.nr_terms for s in self.__segments),
+                'pending': len(self.__pending),
+                'bytes': sum(os.path.getsize(s.path) for s in self.__segments)}
+
+    def close(self):
+        with self.__lock:
+            for s in self.__segments:
+                s.close()
+            self.__segments = []
+            self.__manifest = None
+
+
+## count the cached scrapes and cached search results into the index
+#  full texts are preferred, a result whose page is cached is counted once
+#  @param index type: DFIndex
+#  @param scrapings the directory of the scrape cache, type: str
+#  @param queries the query store database, type: str
+#  @return number of documents added, type: int
+def build(index, scrapings="scrapings", queries="tmp/queries.db"):
+    from qstore import QueryStore
+    n = 0
+    for meta, text in ScrapeCache(scrapings).entries():
+        n += index.add(meta['url'], tokenizer.tokenize(text.decode('utf-8', 'ignore')))
+    if os.path.exists(queries):
+        for _, res in QueryStore(queries, ttl=None).entries():
+            for item in res.get('items', []):
+                title, snippet = tokenizer.tokenize_many(
+                    [item.get('title', u''), item.get('snippet', u'')])
+                n += index.add(item['link'], title + snippet)
+    index.merge()
+    return n
+
+
+## main
+def main(args):
+    tokenizer.persist()
+    index = DFIndex(args.path, args.max_segments)
+    if args.action == 'build':
+        n = build(index, args.scrapings, args.queries)
+        print "added {} documents".format(n)
+    elif args.action == 'compact':
+        index.compact()
+    elif args.action == 'df':
+        for word in args.words:
+            term = tokenizer.tokenize(unicode(word, 'utf-8'))
+            term = term[0] if term else word
+            print u"{}\t{}\t{}".format(term, index.df(term), index.idf(term))
+    print >> sys.stderr, index.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Corpus-wide document frequency index')
+    parser.add_argument('action', choices=['build', 'compact', 'df', 'stats'],
+                        help='build from the caches, compact, look up words, or show stats')
+    parser.add_argument('words', nargs='*', help='words to look up')
+    parser.add_argument('--path', type=str, default='tmp/dfindex', help='directory of the index')
+    parser.add_argument('--max-segments', type=int, default=8,
+                        help='segments kept before compaction')
+    parser.add_argument('--scrapings', type=str, default='scrapings',
+                        help='directory of the scrape cache')
+    parser.add_argument('--queries', type=str, default='tmp/queries.db',
+                        help='database of the query store')
+
+    # positional words may follow the options as well
+    args, rest = parser.parse_known_args()
+    if [w for w in rest if w.startswith('-')]:
+        parser.error("unrecognized arguments: {}".format(' '.join(rest)))
+    args.words += rest
+    main(args)
@@ -0,0 +1,122 @@
+import re
+from HTMLParser import HTMLParser, HTMLParseError
+
+"""Text Extractor class
+
+a streaming HTML parser that extracts the text contents of a web page as it
+is downloaded. Texts under style, script, head and title tags and comments
+are dropped on the fly, so no document tree is ever built. The page is fed
+in chunks, and each feed returns the new pieces of text; a piece never ends
+in the middle of a word, so it can be tokenized right away. Optionally, the
+extraction stops after a budget of words.
+"""
+class TextExtractor(HTMLParser):
+    ## tags whose texts are dropped
+    skipped = frozenset(['style', 'script', 'head', 'title'])
+    ## whitespaces
+    spaces = re.compile(r'\s')
+    ## non-ascii characters
+    non_ascii = re.compile(r'[^\x00-\x7f]+')
+
+    ## the constructor
+    #  @param max_words max number of words to extract, None for unlimited, type: int
+    def __init__(self, max_words=None):
+        HTMLParser.__init__(self)
+        self.max_words = max_words
+        self.nr_words = 0
+        self.done = False # True when the budget of words is reached
+        self.__skipping = [] # stack of open tags whose texts are dropped
+        self.__pending = [] # texts of the current text node
+        self.__pieces = [] # complete pieces since the last feed
+
+    def handle_starttag(self, tag, attrs):
+        self.__flush()
+        if tag == 'body':
+            # head may not be closed explicitly
+            self.__skipping = []
+        elif tag in self.skipped:
+            self.__skipping.append(tag)
+
+    def handle_endtag(self, tag):
+        self.__flush()
+        if tag in self.__skipping:
+            while self.__skipping.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        if not self.__skipping and not self.done:
+            self.__pending.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&{};'.format(name)))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#{};'.format(name)))
+
+    ## end the current piece of text, texts of different nodes are separate
+    #  pieces, and whitespace-only texts are ignored
+    #  @param partial True to keep the trailing partial word pending, type: bool
+    def __flush(self, partial=False):
+        if not self.__pending:
+            return
+        text = u''.join(t if isinstance(t, unicode) else t.decode('latin-1') \
+                        for t in self.__pending)
+        self.__pending = []
+        if partial:
+            i = max(text.rfind(c) for c in ' \t\n\r\f\v')
+            if i < 0:
+                self.__pending = [text]
+                return
+            text, rest = text[:i], text[i:]
+            self.__pending = [rest]
+        text = self.non_ascii.sub('', text).encode('ascii')
+        if not text.strip():
+            return
+
+        if self.max_words is not None:
+            words = text.split()
+            if self.nr_words + len(words) >= self.max_words:
+                text = ' '.join(words[:self.max_words - self.nr_words])
+                self.done = True
+            self.nr_words += len(words)
+        self.__pieces.append(text)
+
+    ## feed a chunk of the page
+    #  @param chunk type: str
+    #  @return new pieces of text, type: list[str]
+    def feed(self, chunk):
+        if not self.done:
+            try:
+                HTMLParser.feed(self, chunk)
+            except HTMLParseError:
+                self.done = True
+            self.__flush(partial=True)
+        pieces, self.__pieces = self.__pieces, []
+        return pieces
+
+    ## end of the page
+    #  @return the last pieces of text, type: list[str]
+    def close(self):
+        if not self.done:
+            try:
+                HTMLParser.close(self)
+            except HTMLParseError:
+                pass
+            self.__flush()
+        pieces, self.__pieces = self.__pieces, []
+        return pieces
+
+
+## extract text contents from a page, incrementally
+#  @param chunks chunks of the page as they are downloaded, type: iterable(str)
+#  @param max_words max number of words to extract, None for unlimited, type: int
+#  @return generator of pieces of text, type: generator(str)
+def iter_text(chunks, max_words=None):
+    extractor = TextExtractor(max_words)
+    for chunk in chunks:
+        for piece in extractor.feed(chunk):
+            yield piece
+        if extractor.done:
+            return
+    for piece in extractor.close():
+        yield piece
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import random
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+"""Fake custom search endpoint
+
+a local stand-in of the custom search JSON API, to test SearchClient and run
+batch sessions without spending quota, e.g.
+    ./fakecse.py --port 8112 --throttle 0.2 &
+    ./batch.py queries.txt --api x --engine y --endpoint http://127.0.0.1:8112/customsearch/v1
+Results are made up from the query, or read from a query store. Requests can
+be delayed, throttled with 429 at random, and refused with 403 once a quota
+is spent; the counts of requests are served at /stats.
+"""
+
+"""Request Handler class
+
+answers GET /customsearch/v1?q=...&start=...&num=... as the API does, and
+GET /stats with the counts of requests.
+"""
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    ## send a JSON response
+    #  @param code HTTP status, type: int
+    #  @param obj type: dict
+    def __reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ## an error response of the API
+    #  @param code HTTP status, type: int
+    #  @param reason type: str
+    def __error(self, code, reason):
+        self.__reply(code, {'error': {'code': code, 'message': reason,
+                                      'errors': [{'reason': reason}]}})
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        if url.path.rstrip('/') == '/stats':
+            return self.__reply(200, self.server.stats())
+        if url.path.rstrip('/') != '/customsearch/v1':
+            return self.__error(404, 'notFound')
+        params = dict(urlparse.parse_qsl(url.query))
+        if not params.get('q') or not params.get('key') or not params.get('cx'):
+            return self.__error(400, 'invalid')
+
+        status = self.server.admit(params['q'])
+        if status == 429:
+            return self.__error(429, 'rateLimitExceeded')
+        elif status == 403:
+            return self.__error(403, 'dailyLimitExceeded')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        start, num = int(params.get('start', 1)), int(params.get('num', 10))
+        items = self.server.results(params['q'].decode('utf-8'))
+        self.__reply(200, {'kind': 'customsearch#search',
+                           'searchInformation': {'totalResults': str(len(items))},
+                           'items': items[start - 1:start - 1 + num]})
+
+
+"""Fake Search Server class
+
+a multi-threaded HTTP server of made-up or recorded search results.
+"""
+class FakeSearchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    ## the constructor
+    #  @param address (host, port), type: tuple(str, int)
+    #  @param total (100) results of each made-up query, type: int
+    #  @param throttle (0.0) fraction of requests answered with 429, type: float
+    #  @param quota (None) requests answered before 403, type: int
+    #  @param latency (0.0) seconds before each answer, type: float
+    #  @param store (None) recorded results to answer with, type: QueryStore
+    #  @param verbose (False) True to log every request, type: bool
+    def __init__(self, address, total=100, throttle=0.0, quota=None, latency=0.0, store=None,
+                 verbose=False):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.total = total
+        self.throttle = throttle
+        self.quota = quota
+        self.latency = latency
+        self.store = store
+        self.verbose = verbose
+        self.__lock = threading.Lock()
+        self.__counts = {'requests': 0, 'throttled': 0, 'refused': 0}
+        self.__queries = {} # requests of each query
+
+    ## count a request, and decide whether it is answered
+    #  @param query type: str
+    #  @return 200, or the status of the refusal, type: int
+    def admit(self, query):
+        with self.__lock:
+            self.__counts['requests'] += 1
+            self.__queries[query] = self.__queries.get(query, 0) + 1
+            if self.quota is not None and self.__counts['requests'] > self.quota:
+                self.__counts['refused'] += 1
+                return 403
+            if random.random() < self.throttle:
+                self.__counts['throttled'] += 1
+                return 429
+        return 200
+
+    ## the result items of a query, recorded or made up
+    #  @param query type: unicode
+    #  @return type: list[dict]
+    def results(self, query):
+        if self.store is not None:
+            res = self.store.get(query)
+            return res['items'] if res is not None else []
+        slug = u'-'.join(query.split())
+        return [{'title': u'{} result {}'.format(query, i),
+                 'displayLink': u'example.com',
+                 'link': u'http://example.com/{}/{}'.format(slug, i),
+                 'snippet': u'result {} of the query {}'.format(i, query)}
+                for i in range(1, self.total + 1)]
+
+    ## counts of the requests
+    #  @return type: dict
+    def stats(self):
+        with self.__lock:
+            res = dict(self.__counts)
+            res['queries'] = dict(self.__queries)
+        return res
+
+
+## main
+def main(args):
+    store = None
+    if args.queries_db:
+        from qstore import QueryStore
+        store = QueryStore(args.queries_db, ttl=None)
+    server = FakeSearchServer((args.host, args.port), args.total, args.throttle,
+                              args.quota or None, args.latency, store, args.verbose)
+    print "serving on {}:{}".format(*server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake custom search endpoint')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8112, help='port to listen on')
+    parser.add_argument('--total', type=int, default=100,
+                        help='results of each made-up query')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='fraction of requests answered with 429')
+    parser.add_argument('--quota', type=int, default=0,
+                        help='requests answered before 403, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each answer')
+    parser.add_argument('--queries-db', type=str,
+                        help='database of a query store to answer with recorded results')
+    parser.add_argument('--verbose', action="store_true", help='log every request')
+
+    main(parser.parse_args())
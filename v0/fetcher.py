@@ -0,0 +1,230 @@
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+from Queue import Queue, Empty
+
+"""Page Stream class
+
+the body of an HTTP response being downloaded, read chunk by chunk up to the
+maximum body size of the fetcher. The connection goes back to the pool of
+the fetcher only if the body has been read completely, it must be closed
+after use (it is a context manager).
+"""
+class PageStream(object):
+    ## the constructor
+    #  @param fetcher type: PageFetcher
+    #  @param release callback to give the connection back, called with
+    #         True if the connection can be reused, type: function(bool)
+    #  @param resp type: httplib.HTTPResponse
+    def __init__(self, fetcher, release, resp):
+        self.status = resp.status
+        self.__fetcher = fetcher
+        self.__release = release
+        self.__resp = resp
+        self.__complete = False
+
+    ## iterate over the chunks of the body
+    #  @param chunk_size max size of a chunk, type: int
+    #  @return generator of chunks, type: generator(str)
+    def chunks(self, chunk_size=65536):
+        size, limit = 0, self.__fetcher.max_bytes
+        while size < limit:
+            chunk = self.__resp.read(min(chunk_size, limit - size))
+            if not chunk:
+                self.__complete = True
+                return
+            size += len(chunk)
+            yield chunk
+        # the body may end right at the limit
+        self.__complete = self.__resp.read(1) == ''
+
+    ## the whole body, up to the maximum body size
+    #  @return type: str
+    def read(self):
+        return ''.join(self.chunks())
+
+    ## give the connection back to the fetcher, only once
+    def close(self):
+        if self.__release:
+            release, self.__release = self.__release, None
+            release(self.__complete and not self.__resp.will_close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+"""Page Fetcher class
+
+an HTTP client to download web pages, several pages can be fetched
+concurrently by a pool of worker threads. Connections are kept alive and
+reused per host, and the number of concurrent requests to each host is
+limited, each request is bounded by a timeout and a maximum body size.
+"""
+class PageFetcher(object):
+    ## HTTP status codes of redirections
+    redirects = (301, 302, 303, 307, 308)
+
+    ## the constructor
+    #  @param workers max number of concurrent requests, type: int
+    #  @param per_host max number of concurrent requests to one host, type: int
+    #  @param timeout socket timeout in seconds, type: float
+    #  @param max_bytes max size of a response body, larger bodies are
+    #         truncated, type: int
+    #  @param max_redirects max number of redirections to follow, type: int
+    def __init__(self, workers=10, per_host=2, timeout=10.0, max_bytes=2*1024*1024,
+                 max_redirects=5):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_redirects = max_redirects
+        self.headers = {'User-Agent': 'Mozilla/5.0 (compatible; teamworks)'}
+        self.__lock = threading.Lock()
+        self.__idle = {} # idle connections of each host
+        self.__slots = {} # semaphore limiting concurrent requests of each host
+
+    ## semaphore of the given host
+    #  @param host (scheme, netloc), type: tuple(str)
+    #  @return type: threading.BoundedSemaphore
+    def __slot(self, host):
+        with self.__lock:
+            if host not in self.__slots:
+                self.__slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self.__slots[host]
+
+    ## get an idle connection of the given host, or open a new one
+    #  @param host (scheme, netloc), type: tuple(str)
+    #  @return (connection, True if reused), type: tuple(httplib.HTTPConnection, bool)
+    def __connect(self, host):
+        with self.__lock:
+            idle = self.__idle.get(host)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = host
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    ## put a connection back to the idle pool of the given host
+    #  @param host (scheme, netloc), type: tuple(str)
+    #  @param conn type: httplib.HTTPConnection
+    def __release(self, host, conn):
+        with self.__lock:
+            self.__idle.setdefault(host, []).append(conn)
+
+    ## send one GET request, a stale kept-alive connection is retried once
+    #  @param host (scheme, netloc), type: tuple(str)
+    #  @param path request path with query string, type: str
+    #  @return type: tuple(httplib.HTTPConnection, httplib.HTTPResponse)
+    def __request(self, host, path):
+        while True:
+            conn, reused = self.__connect(host)
+            try:
+                conn.request('GET', path, headers=self.headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+
+    ## open one URL, following redirections
+    #  the body is not read yet, the returned stream must be closed after use
+    #  @param url type: str
+    #  @return type: PageStream
+    def open(self, url):
+        if isinstance(url, unicode):
+            url = urllib.quote(url.encode('utf-8'), safe="%/:=&?~#+!$,;'@()*[]")
+        for _ in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError("unsupported URL: {}".format(url))
+            host = (parts.scheme, parts.netloc)
+            path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            slot = self.__slot(host)
+            slot.acquire()
+            try:
+                conn, resp = self.__request(host, path)
+            except:
+                slot.release()
+                raise
+
+            def release(reusable, host=host, conn=conn, slot=slot):
+                if reusable:
+                    self.__release(host, conn)
+                else:
+                    conn.close()
+                slot.release()
+
+            stream = PageStream(self, release, resp)
+            location = resp.getheader('location')
+            if resp.status in self.redirects and location:
+                with stream:
+                    stream.read()
+                url = urlparse.urljoin(url, location)
+                continue
+            return stream
+        raise IOError("too many redirections: {}".format(url))
+
+    ## fetch one URL, following redirections
+    #  @param url type: str
+    #  @return (status, body), type: tuple(int, str)
+    def fetch(self, url):
+        with self.open(url) as stream:
+            return stream.status, stream.read()
+
+    ## apply a function to several URLs concurrently
+    #  failures are reported in place of the result, so that one bad page
+    #  does not fail the others
+    #  @param func function of one URL, type: function(str)
+    #  @param urls type: list[str]
+    #  @return result or the exception of each URL, in order, type: list
+    def map(self, func, urls):
+        res = [None] * len(urls)
+        tasks = Queue()
+        for i, url in enumerate(urls):
+            tasks.put((i, url))
+
+        def worker():
+            while True:
+                try:
+                    i, url = tasks.get_nowait()
+                except Empty:
+                    return
+                try:
+                    res[i] = func(url)
+                except Exception as e:
+                    res[i] = e
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.workers, len(urls)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return res
+
+    ## fetch several URLs concurrently
+    #  @param urls type: list[str]
+    #  @return (status, body) or the exception of each URL, in order,
+    #          type: list[tuple(int, str) or Exception]
+    def fetch_many(self, urls):
+        return self.map(self.fetch, urls)
+
+    ## close all idle connections
+    def close(self):
+        with self.__lock:
+            for conns in self.__idle.values():
+                for conn in conns:
+                    conn.close()
+            self.__idle.clear()
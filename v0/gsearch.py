@@ -1,12 +1,114 @@
 # reference: Google custom search API client implementations
 # link: https://github.com/google/google-api-python-client/blob/master/samples/customsearch/main.py
 # author: jcgregorio@google.com (Joe Gregorio)
-from googleapiclient.discovery import build
-import json
-import re
+import atexit
+import sys
+import threading
+from array import array
+from bisect import bisect_left
 from collections import Counter
-from nltk.stem.snowball import SnowballStemmer
+from dedup import DuplicateIndex, canonical_url, simhash
+from instrument import recorder
+from passages import best_passages
+from qstore import QueryStore
 from scraper import WebScraper
+from searchclient import SearchClient
+from tokenizer import tokenizer
+from varint import get_varint, put_varint
+from vocab import Vocabulary
+
+## the term IDs of the words of documents built without a vocabulary of their
+#  own; words are never removed from it, so a long-running process should give
+#  each session its own vocabulary, e.g. that of its Rocchio instance, which
+#  is dropped with the session
+vocabulary = Vocabulary()
+
+"""Term Frequencies class
+
+the term frequencies of a document, as a read-only mapping of word to
+frequency like the Counter it replaces (0 for absent words). The pairs are
+kept in two parallel arrays of term IDs, in ascending order, and frequencies,
+rather than a dict of word strings and float objects, which is about ten
+times smaller; the words themselves are only stored once, in the vocabulary
+the term IDs refer to.
+"""
+class TermFrequencies(object):
+    __slots__ = ('ids', 'freqs', 'vocab')
+
+    ## the constructor
+    #  @param counts raw counts of the words, type: dict(key:str, value:int)
+    #  @param size (None) number of words to divide the counts by, raw counts if None
+    #  @param vocab (None) vocabulary of the term IDs, the module's if None, type: Vocabulary
+    def __init__(self, counts, size=None, vocab=None):
+        self.vocab = vocab if vocab is not None else vocabulary
+        pairs = sorted(zip([self.vocab.intern(w) for w in counts.keys()], counts.values()))
+        self.ids = array('I', [t for t, _ in pairs])
+        self.freqs = array('d', [c for _, c in pairs])
+        if size:
+            n = float(size)
+            for i in xrange(len(self.freqs)):
+                self.freqs[i] /= n
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (self.vocab.term(t) for t in self.ids)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        return self.get(word, 0)
+
+    ## frequency of the given word
+    #  @param word type: str
+    #  @param default value if the word is absent
+    #  @return type: float
+    def get(self, word, default=None):
+        tid = self.vocab.id(word)
+        if tid is not None:
+            i = bisect_left(self.ids, tid)
+            if i < len(self.ids) and self.ids[i] == tid:
+                return self.freqs[i]
+        return default
+
+    def keys(self):
+        return [self.vocab.term(t) for t in self.ids]
+
+    def values(self):
+        return self.freqs.tolist()
+
+    def items(self):
+        return zip(self.keys(), self.freqs)
+
+    ## memory used by the term frequencies, in bytes, without the words
+    #  @return type: int
+    def memory_usage(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.ids) + sys.getsizeof(self.freqs)
+
+## encode the words of pieces of text, see SearchDocument.positions
+#  @param pieces type: list[list[str]]
+#  @param vocab vocabulary of the term IDs, type: Vocabulary
+#  @return type: str
+def encode_sequence(pieces, vocab):
+    buf = bytearray()
+    for n, words in enumerate(pieces):
+        if n:
+            buf.append(0)
+        for tid in [vocab.intern(w) for w in words]:
+            put_varint(tid + 1, buf)
+    return str(buf)
+
+## decode the words of a document, see SearchDocument.positions
+#  @param positions type: str
+#  @return term ID of each position, None between pieces, type: list[int]
+def decode_sequence(positions):
+    buf, res, pos = bytearray(positions), [], 0
+    while pos < len(buf):
+        tid, pos = get_varint(buf, pos)
+        res.append(tid - 1 if tid else None)
+    return res
 
 """Search Document class
 
@@ -14,16 +116,29 @@ a document returned by Google search engine, extracted from the 'item' part
 of the JSON data returned by Google search API, including information such as 
 the title, URL link, and a snippet of document. Also include some statistical 
 information such as term frequency of each word.
+
+Documents are kept lean: only the fields of the item and the term
+frequencies are stored, in slots. Neither the tokens nor the html text are
+kept after the term frequencies are counted, the text is read back from the
+scrape cache when asked for.
+
+The key of a document is its canonical URL, and its SimHash fingerprint is
+taken from its words when first needed, so that repeated pages can be found;
+duplicate_of is set to the key of the document it repeats, if any.
+
+Optionally, the order of the words is kept as well, for positional indexing:
+positions holds the term IDs of the words in order, each plus 1, as varints,
+with a 0 between the pieces of text (e.g. the title and the snippet) so that
+no phrase spans two pieces; one or two bytes per word.
+
+Also optionally, only the best passages of the html text around the query
+terms are counted, see best_passages(), rather than the whole page: a few
+windows of words instead of thousands of words of menus, footers and the
+like, closer to what the snippet holds.
 """
 class SearchDocument(object):
-    ## global stemming engine
-    try:
-        stemmer = SnowballStemmer("english")
-    except Exception as e:
-        print "SearchDocument class failed to initialize stemming engine: {}".format(e)
-        stemmer = None
-    ## global cache of word stemming to reduce calling snowball stemming API
-    cache_stemming = {}
+    __slots__ = ('title', 'displink', 'url', 'snippet', 'key', 'stemming', 'htmltext',
+                 'size', 'tf', '_fingerprint', 'duplicate_of', 'positions')
     scraper = WebScraper()
 
     ## the constructor
@@ -31,88 +146,304 @@ class SearchDocument(object):
     #  @param stemming (False) True to enable stemming, e.g. stem("apples") = "apple"
     #  @param htmltext (False) True to use the html text instead of snippet
     #  @param normalize (False) True to have term frequency instead of raw counts
-    def __init__(self, fields, stemming=False, htmltext=False, normalize=False):
+    #  @param text (None) the html text if already scraped, scraped on demand if None
+    #  @param counts (None) raw counts of the words if already tokenized, e.g. by
+    #         a WordCountPool, the text is not tokenized again, type: dict(key:str, value:int)
+    #  @param positional (False) True to keep the order of the words, ignored if
+    #         counts are given
+    #  @param passages (None) query terms to count only the passages of the html
+    #         text around, the whole text if None, type: set(str)
+    #  @param vocab (None) vocabulary the words are interned in, the module's
+    #         if None, type: Vocabulary
+    def __init__(self, fields, stemming=False, htmltext=False, normalize=False, text=None,
+                 counts=None, positional=False, passages=None, vocab=None):
         self.title = fields['title']
         self.displink = fields['displayLink']
         self.url = fields['link'] # 'link' is the complete URL, not 'formattedUrl'
         self.snippet = fields['snippet']
-        self.key = self.url
-        self.text = self.scraper.scrape_text(self.url) if htmltext else ""
+        self.key = canonical_url(self.url)
+        self.duplicate_of = None
+        self._fingerprint = None
         self.stemming = stemming
+        self.htmltext = htmltext
+        self.positions = None
 
-        # all words in document (with duplicates)
-        if htmltext:
-            self.words = self.__parse(self.text)
-        else:
-            self.words = self.__parse(self.title) + self.__parse(self.snippet)
+        # counts of all words in document
+        if counts is None:
+            pieces = [] if positional else None
+            counts = self.__count(stemming, htmltext, text, pieces, passages)
+            if positional:
+                self.positions = encode_sequence(pieces, vocab if vocab is not None else vocabulary)
         # document length
-        self.size = len(self.words)
+        self.size = sum(counts.itervalues())
         # term count/frequency
-        self.tf = self.__tf(normalize)
-
-    ## calculate terms occurence/frequency
-    def __tf(self, normalize):
-        res = Counter(self.words)
-        if normalize:
-            for word, count in res.items():
-                res[word] = float(count)/self.size
-        return res
+        self.tf = TermFrequencies(counts, self.size if normalize else None, vocab)
+        recorder.count('documents')
 
-    ## apply word stemming if necessary
-    def __stem(self, word):
-        if not self.stemming or not self.stemmer:
-            # stemming is disabled
-            return word
-        elif word in self.cache_stemming:
-            # found in cache
-            return self.cache_stemming[word]
-        else:
-            # stem, and save in cache
-            stemmed = self.cache_stemming[word] = self.stemmer.stem(word)
-            return stemmed
-
-    ## convert string to list of lowercase words w/o punctuations
-    def __parse(self, s):
-        res = []
-        for w in s.split():
-            r = re.sub(r'[\W_]', '', self.__stem(w.lower()))
-            if r:
-                res.append(r)
+    ## count the words of the document
+    #  @param pieces (None) list the words of each piece of text are appended
+    #         to, type: list[list[str]]
+    #  @param passages (None) query terms to select the passages around, type: set(str)
+    #  @return type: Counter
+    def __count(self, stemming, htmltext, text, pieces=None, passages=None):
+        counts = Counter()
+        with recorder.span('tokenize'):
+            if htmltext and text is None:
+                # tokenize the texts of the webpage as they are downloaded
+                words = (tokenizer.tokenize(piece, stemming) \
+                         for piece in self.scraper.iter_text(self.url))
+            elif htmltext:
+                words = [tokenizer.tokenize(text, stemming)]
+            else:
+                words = tokenizer.tokenize_many([self.title, self.snippet], stemming)
+            if htmltext and passages is not None:
+                words = best_passages([w for piece in words for w in piece], passages)
+            for w in words:
+                counts.update(w)
+                if pieces is not None:
+                    pieces.append(w)
+        return counts
+
+    ## the SimHash fingerprint of the words, computed on first use
+    #  @return None if there is no word, type: int
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = simhash(self.tf)
+        return self._fingerprint
+
+    ## the html text of the webpage, from the scrape cache
+    #  @return empty if not using the html text or not cached, type: str
+    @property
+    def text(self):
+        if not self.htmltext:
+            return ""
+        return self.scraper.cache.get(self.url) or ""
+
+    ## memory used by the document, in bytes, without the strings of the
+    #  item, which are shared with the query store, nor the vocabulary
+    #  @return type: int
+    def memory_usage(self):
+        return sys.getsizeof(self) + self.tf.memory_usage()
+
+## count the words of a text, in a worker process of a WordCountPool
+#  @param task (text, stemming, query terms to count the best passages around,
+#         None for all words), type: tuple(str, bool, set(str))
+#  @return distinct words and their counts, type: tuple(list[str], array)
+def count_words(task):
+    text, stemming, passages = task
+    words = tokenizer.tokenize(text, stemming)
+    if passages is not None:
+        words = [w for piece in best_passages(words, passages) for w in piece]
+    counts = Counter(words)
+    return counts.keys(), array('I', counts.values())
+
+"""Word Count Pool class
+
+tokenizes and counts the words of large texts in a pool of worker processes,
+so that documents of full webpages are built on all cores rather than the
+one the GIL allows. Only the distinct words and their counts are sent back,
+the documents themselves are built by the caller. Texts shorter than
+min_chars are cheaper to count inline than to send to a worker.
+
+The pool is disabled (no workers) until configured; it should be configured
+before any thread is started, since the workers are forked.
+"""
+class WordCountPool(object):
+    ## the constructor
+    #  @param workers (0) number of worker processes, 0 to count inline, type: int
+    #  @param min_chars (20000) min length of the texts sent to the workers, type: int
+    def __init__(self, workers=0, min_chars=20000):
+        self.pool = None
+        self.configure(workers, min_chars)
+
+    ## start the worker processes, or stop them if workers is 0
+    #  @param workers number of worker processes, None for the number of CPUs, type: int
+    #  @param min_chars (None) min length of the texts sent to the workers,
+    #         unchanged if None, type: int
+    def configure(self, workers, min_chars=None):
+        self.close()
+        if min_chars is not None:
+            self.min_chars = min_chars
+        if workers != 0:
+            from multiprocessing import Pool
+            self.pool = Pool(workers)
+
+    ## stop the worker processes
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    ## count the words of the large texts in the worker processes
+    #  @param texts type: list[str]
+    #  @param stemming True to apply word stemming, type: bool
+    #  @param passages (None) query terms to count only the best passages
+    #         around, see best_passages(), type: set(str)
+    #  @return counts of each text, None for the texts to count inline, 
+    #          type: list[dict(key:str, value:int)]
+    def count_many(self, texts, stemming=True, passages=None):
+        res = [None] * len(texts)
+        if self.pool is None:
+            return res
+        large = [i for i, t in enumerate(texts) if t and len(t) >= self.min_chars]
+        if not large:
+            return res
+        with recorder.span('count_pool'):
+            counted = self.pool.map(count_words, [(texts[i], stemming, passages) for i in large],
+                                    chunksize=1)
+        for i, (words, counts) in zip(large, counted):
+            res[i] = dict(zip(words, counts))
+        recorder.count('count_pool.texts', len(large))
         return res
 
+## pool counting the words of large html texts, disabled unless configured
+word_counter = WordCountPool()
+atexit.register(word_counter.close)
+
+## store of search results, shared by all queries of the process
+store = QueryStore()
+
+## settings of the search clients, see SearchClient, e.g. {'pages': 3}
+client_options = {}
+## search clients of the process, by API key and engine ID
+clients = {}
+clients_lock = threading.Lock()
+
+## the search client of the given API key and engine, shared by all threads
+#  and sessions of the process so that their requests are limited, counted 
+#  and coalesced together
+#  @param api the Google search API key, type: str
+#  @param engine the Google search engine ID, type: str
+#  @return type: SearchClient
+def search_client(api, engine):
+    with clients_lock:
+        client = clients.get((api, engine))
+        if client is None:
+            client = clients[(api, engine)] = SearchClient(api, engine, **client_options)
+        return client
+
 ## execute search and get the JSON formatted result
 #  @param api the Google search API key, type: str
 #  @param engine the Google search engine ID, type: str
+#  @param session (None) ID of the session the API requests are counted to
 #  @return type: dict
-def gsearch_exec(query, api, engine):
+def gsearch_exec(query, api, engine, session=None):
     # first try to fetch the search result from saved results on disk,
     # keep in mind that Google charges you fees if you call the API too many times a day!
-    fname = 'tmp/q_' + '-'.join(query.split()) + '.txt'
-    try:
-        with open(fname, 'r') as f:
-            res = json.load(f)
+    res = store.get(query)
+    if res is not None:
+        recorder.count('query_cache.hit')
         return res
-    except:
-        pass
-
-    # Build a service object for interacting with the API. Visit
-    # the Google APIs Console <http://code.google.com/apis/console>
-    # to get an API key for your own application.
-    service = build("customsearch", "v1", developerKey=api)
-    res = service.cse().list(q=query, cx=engine).execute()
-    
-    # save the res into tmp file
-    with open(fname, 'w') as f:
-        json.dump(res, f)
-    return res
+    recorder.count('query_cache.miss')
+
+    # results saved by earlier versions, one JSON file per query, are imported
+    # into the store once
+    if store.import_files():
+        res = store.get(query)
+        if res is not None:
+            return res
+
+    # Call the API, visit the Google APIs Console 
+    # <http://code.google.com/apis/console> to get an API key for your own 
+    # application.
+    with recorder.span('search_api'):
+        res = search_client(api, engine).search(query, session)
+
+    # save the res into the store
+    return store.put(query, res)
+
+"""Search Backend class
+
+a source of search results, answering a query string with the JSON formatted
+result of Google search API, i.e. a dict of "items" each with the title, 
+displayLink, link and snippet of a document.
+"""
+class SearchBackend(object):
+    ## search the given query
+    #  @param query query terms, type: str
+    #  @param session (None) ID of the session searching, type: str
+    #  @return type: dict
+    def search(self, query, session=None):
+        raise NotImplementedError
+
+"""Google Search Backend class
+
+Google custom search API, through the query store.
+"""
+class GoogleSearch(SearchBackend):
+    ## the constructor
+    #  @param api the Google search API key, type: str
+    #  @param engine the Google search engine ID, type: str
+    def __init__(self, api, engine):
+        self.api = api
+        self.engine = engine
+
+    def search(self, query, session=None):
+        return gsearch_exec(query, self.api, self.engine, session)
+
+"""Fallback Search Backend class
+
+searches the primary backend, and the fallback backend if the primary one 
+fails, e.g. the API is throttled or unreachable.
+"""
+class FallbackSearch(SearchBackend):
+    ## the constructor
+    #  @param primary type: SearchBackend
+    #  @param fallback type: SearchBackend
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+
+    def search(self, query, session=None):
+        try:
+            return self.primary.search(query, session)
+        except Exception:
+            recorder.count('search.fallback')
+            return self.fallback.search(query, session)
+
+## mark the documents that repeat a document already seen, either one of
+#  the given index or an earlier one of the list
+#  @param docs type: list[SearchDocument]
+#  @param duplicates (None) the documents already seen, type: DuplicateIndex
+def mark_duplicates(docs, duplicates=None):
+    seen = DuplicateIndex()
+    for doc in docs:
+        if doc.duplicate_of is None:
+            for index in [duplicates, seen]:
+                key = index.find(doc.key, doc.fingerprint) if index is not None else None
+                if key is not None:
+                    doc.duplicate_of = key
+                    recorder.count('duplicates')
+                    break
+        seen.add(doc.key, doc.fingerprint)
 
 ## apply Google search
 #  @param query query terms, type: str
 #  @param api the Google search API key, type: str
 #  @param engine the Google search engine ID, type: str
-#  @return list of returned documents, type: list[SearchDocument]
-def gsearch(query, api, engine):
-    raw = gsearch_exec(query, api, engine)
+#  @param htmltext (False) True to use the html text instead of snippet
+#  @param cancelled (None) function polled between the steps, the search is 
+#         abandoned once it returns True, type: function()
+#  @param backend (None) the source of results, Google search API if None, type: SearchBackend
+#  @param duplicates (None) the documents already seen, the results repeating one 
+#         of them are marked, and their pages are not scraped if they have the
+#         same key, type: DuplicateIndex
+#  @param session (None) ID of the session searching, type: str
+#  @param positional (False) True to keep the order of the words of documents
+#  @param passages (False) True to count only the passages of the html texts
+#         around the query terms, see best_passages()
+#  @param vocab (None) vocabulary of the session the words of the documents are
+#         interned in, the module's if None, type: Vocabulary
+#  @return list of returned documents, None if cancelled, type: list[SearchDocument]
+def gsearch(query, api, engine, htmltext=False, cancelled=None, backend=None, duplicates=None,
+            session=None, positional=False, passages=False, vocab=None):
+    with recorder.span('search'):
+        if backend is not None:
+            raw = backend.search(query, session)
+        else:
+            raw = gsearch_exec(query, api, engine, session)
 
     ##
     # when cosntructing the documents, several decisions should be made:
@@ -132,4 +463,52 @@ def gsearch(query, api, engine):
     #   webpage's contents (although mostly the contents around the keywords we searched 
     #   for), besides it's much smaller in size and easier to process 
     #   
-    return [SearchDocument(i, stemming=True, normalize=True) for i in raw['items']]
+    # - if the raw text is used anyway, the whole page or passages of it?
+    #   passages, optionally: the few windows of the page around the query terms
+    #   are indexed, which is closer to a snippet and an order of magnitude fewer
+    #   words to count and index than the whole page
+    #
+    items = raw.get('items', [])
+    if cancelled is not None and cancelled():
+        return None
+    if not htmltext:
+        docs = [SearchDocument(i, stemming=True, normalize=True, positional=positional,
+                               vocab=vocab) for i in items]
+        mark_duplicates(docs, duplicates)
+        return docs
+
+    # the pages of a key already seen are not scraped again, their documents 
+    # are made of the snippets
+    seen, repeated = set(), []
+    for i in items:
+        key = canonical_url(i['link'])
+        repeated.append(key in seen or (duplicates is not None and key in duplicates))
+        seen.add(key)
+    recorder.count('duplicates.unscraped', sum(repeated))
+
+    # download all the webpages concurrently, rather than one after another 
+    # while constructing each document
+    with recorder.span('scrape'):
+        texts = SearchDocument.scraper.scrape_many(
+            [i['link'] for i, r in zip(items, repeated) if not r], cancelled)
+    if cancelled is not None and cancelled():
+        return None
+    terms = frozenset(tokenizer.tokenize(query, True)) if passages else None
+    # tokenize the large pages in the worker processes, if any; the workers
+    # only count the words, positional documents are tokenized here
+    if positional:
+        counts = iter([None] * len(texts))
+    else:
+        counts = iter(word_counter.count_many(texts, stemming=True, passages=terms))
+    texts = iter(texts)
+    docs = []
+    for i, r in zip(items, repeated):
+        if r:
+            docs.append(SearchDocument(i, stemming=True, normalize=True, positional=positional,
+                                       vocab=vocab))
+        else:
+            docs.append(SearchDocument(i, stemming=True, htmltext=True, normalize=True,
+                                       text=next(texts), counts=next(counts),
+                                       positional=positional, passages=terms, vocab=vocab))
+    mark_duplicates(docs, duplicates)
+    return docs
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from timeit import default_timer as timer
+
+"""Span class
+
+times a named stage of the work as a context manager, the elapsed time is
+added to the recorder when the span exits.
+"""
+class Span(object):
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.add_time(self.name, timer() - self.start)
+
+
+"""No-op span class
+
+the span used while the recorder is disabled, one shared instance that
+does nothing.
+"""
+class NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+nospan = NoSpan()
+
+
+"""Recorder class
+
+a lightweight instrumentation layer: named spans accumulate the count and
+total time of each stage, counters accumulate events (e.g. cache hits) and
+gauges keep the last value of a measurement (e.g. vocabulary size). Probes
+are functions polled for gauges when a record is made. Each call to flush()
+makes one record of everything since the previous flush, and hands it to
+the registered hooks, e.g. to write it as a line of JSON.
+
+The recorder is disabled by default, and then spans are a shared no-op and
+counters return immediately, so instrumented code pays almost nothing.
+"""
+class Recorder(object):
+    ## the constructor
+    def __init__(self):
+        self.enabled = False
+        self.__lock = threading.Lock()
+        self.__hooks = []
+        self.__probes = {}
+        self.reset()
+
+    ## enable or disable recording
+    #  @param enabled type: bool
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    ## clear all spans, counters and gauges
+    def reset(self):
+        with self.__lock:
+            self.spans = {} # name to [count, seconds]
+            self.counters = {}
+            self.gauges = {}
+
+    ## a span timing the stage of the given name
+    #  @param name type: str
+    #  @return context manager, type: Span
+    def span(self, name):
+        if not self.enabled:
+            return nospan
+        return Span(self, name)
+
+    ## add elapsed time to the span of the given name
+    #  @param name type: str
+    #  @param seconds type: float
+    def add_time(self, name, seconds):
+        with self.__lock:
+            s = self.spans.get(name)
+            if s is None:
+                self.spans[name] = [1, seconds]
+            else:
+                s[0] += 1
+                s[1] += seconds
+
+    ## increase the counter of the given name
+    #  @param name type: str
+    #  @param n type: int
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    ## set the gauge of the given name
+    #  @param name type: str
+    #  @param value type: number
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.gauges[name] = value
+
+    ## register a hook called with each record
+    #  @param hook type: function(dict)
+    def add_hook(self, hook):
+        self.__hooks.append(hook)
+
+    ## unregister a hook
+    #  @param hook type: function(dict)
+    def remove_hook(self, hook):
+        self.__hooks.remove(hook)
+
+    ## register a probe polled for gauges on each record, each item of the
+    #  returned dict is recorded as gauge "<name>.<key>"
+    #  @param name type: str
+    #  @param probe type: function() -> dict
+    def add_probe(self, name, probe):
+        self.__probes[name] = probe
+
+    ## make a record of everything since the previous flush, hand it to the
+    #  hooks, and start over
+    #  @param fields extra fields of the record, e.g. the iteration
+    #  @return the record, None if disabled, type: dict
+    def flush(self, **fields):
+        if not self.enabled:
+            return None
+        for name, probe in self.__probes.items():
+            for k, v in probe().items():
+                self.gauge('{}.{}'.format(name, k), v)
+        with self.__lock:
+            record = {'time': time.time(),
+                      'spans': dict((k, {'count': c, 'seconds': s}) \
+                                    for k, (c, s) in self.spans.items()),
+                      'counters': self.counters, 'gauges': self.gauges}
+        record.update(fields)
+        self.reset()
+        for hook in self.__hooks:
+            hook(record)
+        return record
+
+
+## a hook writing each record as a line of JSON
+#  @param f file object, type: file
+#  @return type: function(dict)
+def json_hook(f):
+    def hook(record):
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+    return hook
+
+
+## recorder shared by the whole process
+recorder = Recorder()
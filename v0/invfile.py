@@ -1,22 +1,125 @@
-from collections import defaultdict
+import sys
+from array import array
+from bisect import bisect_left
+from collections import Mapping
 from math import log
-from gsearch import SearchDocument
+from gsearch import SearchDocument, decode_sequence
+from instrument import recorder
+from snapshot import pack_strings
+from varint import get_varint, put_varint
+from vocab import Vocabulary
+
+"""Document Reference class
+
+stands in for a document restored from a snapshot, of which only the key
+is kept; optionally with its term frequencies while the state of a session
+is being rebuilt.
+"""
+class DocumentRef(object):
+    __slots__ = ('key', 'url', 'tf')
+
+    ## the constructor
+    #  @param key type: str
+    #  @param tf (None) term frequencies, type: dict(key:str, value:float)
+    def __init__(self, key, tf=None):
+        self.key = self.url = key
+        self.tf = tf
+
+
+"""Postings view class
+
+A read-only mapping of (document, term frequency) pairs of a word, backed by
+the arrays of the inverted-files without copying them. Iteration follows the
+order in which documents were added.
+"""
+class PostingsView(Mapping):
+    ## the constructor
+    #  @param docs documents of the inverted-files, type: list[SearchDocument]
+    #  @param ids document IDs in ascending order, type: array('I')
+    #  @param freqs term frequencies, type: array('f')
+    def __init__(self, docs, ids, freqs):
+        self.__docs = docs
+        self.__ids = ids
+        self.__freqs = freqs
+
+    def __getitem__(self, doc):
+        for i, did in enumerate(self.__ids):
+            if self.__docs[did] is doc:
+                return self.__freqs[i]
+        raise KeyError(doc)
+
+    def __iter__(self):
+        for did in self.__ids:
+            yield self.__docs[did]
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def iteritems(self):
+        for did, freq in zip(self.__ids, self.__freqs):
+            yield self.__docs[did], freq
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.__freqs)
+
+    ## document IDs of the postings, in ascending order
+    #  @return type: list[int]
+    def doc_ids(self):
+        return list(self.__ids)
+
+    ## term frequency of the given document ID, 0.0 if absent
+    #  @param did type: int
+    #  @return type: float
+    def tf(self, did):
+        i = bisect_left(self.__ids, did)
+        if i < len(self.__ids) and self.__ids[i] == did:
+            return self.__freqs[i]
+        return 0.0
+
 
 """Inverted-files class
 
-Inverted-files is a common data structure used for information retrieval, 
-it contains the bag of words in a collection of documents, as well as 
-information associated to the words. In this implementation, a hash table 
-is used, where key is the word, and value is also a hash table which 
-contains the (document, term frequency) pairs of the word. The term 
-frequency is in absolute number, NOT normalized.
+Inverted-files is a common data structure used for information retrieval,
+it contains the bag of words in a collection of documents, as well as
+information associated to the words. In this implementation, words are
+interned into dense term IDs by a Vocabulary, documents are given dense
+document IDs in the order they are added, and the postings of each word
+are two compact arrays: the document IDs (array('I')) and the term
+frequencies (array('f')) in these documents. The term frequency is the
+value of SearchDocument.tf, NOT normalized any further.
+
+The collection can be saved to a snapshot, and loaded back without the
+documents themselves: they are replaced by DocumentRef, and the postings of
+each word are read from the memory-mapped snapshot on first use.
+
+Optionally, the collection is positional: the positions of each word in each
+document are kept as well, from SearchDocument.positions, so that phrases
+can be looked up. The positions of a word are appended to one buffer per
+word, for each posting its number of positions then the gaps between them,
+all as varints, with the offset of each posting in the buffer in an array
+parallel to the postings. The positions are not saved to snapshots.
 """
 class InvertedFiles(object):
     ## the constructor
     #  @param docs collection of documents, type: list[SearchDocument]
-    def __init__(self, docs=[]):
-        self.__docs = []
-        self.__data = defaultdict(dict) # the inverted-file data
+    #  @param vocab vocabulary to share with other inverted-files, type: Vocabulary
+    #  @param positional (False) True to keep the positions of the words
+    def __init__(self, docs=[], vocab=None, positional=False):
+        self.__docs = [] # document ID to document
+        self.__vocab = vocab if vocab is not None else Vocabulary()
+        # postings indexed by term ID, None if the word is not in any document
+        self.__ids = [] # type: list[array('I')]
+        self.__freqs = [] # type: list[array('f')]
+        # postings still in the snapshot are False, see load()
+        self.__base = None # (snapshot, postings offsets, ids offset, freqs offset)
+        self.__nr_words = 0
+        # positions indexed by term ID, if positional
+        self.positional = positional
+        self.__positions = [] # type: list[bytearray]
+        self.__offsets = [] # offset of the positions of each posting, type: list[array('I')]
         # add docs
         for doc in docs:
             self.add_document(doc)
@@ -26,38 +129,137 @@ class InvertedFiles(object):
     def add_document(self, doc):
         if not doc:
             return
-        if not isinstance(doc, SearchDocument):
+        if not isinstance(doc, (SearchDocument, DocumentRef)):
             raise ValueError("invalid type: {}".format(type(doc)))
 
-        self.__docs.append(doc)
-        # SearchDocument.tf contains {word: term frequency} mapping of the doc
-        for word, freq in doc.tf.items():
-            self.__data[word][doc] = freq
+        with recorder.span('index'):
+            did = len(self.__docs)
+            self.__docs.append(doc)
+            positions = self.__doc_positions(doc) if self.positional else None
+            # SearchDocument.tf contains {word: term frequency} mapping of the doc
+            for word, freq in doc.tf.items():
+                tid = self.__vocab.intern(word)
+                if tid >= len(self.__ids):
+                    pad = tid + 1 - len(self.__ids)
+                    self.__ids.extend([None] * pad)
+                    self.__freqs.extend([None] * pad)
+                    if self.positional:
+                        self.__positions.extend([None] * pad)
+                        self.__offsets.extend([None] * pad)
+                if self.__ids[tid] is None:
+                    self.__ids[tid] = array('I')
+                    self.__freqs[tid] = array('f')
+                    if self.positional:
+                        self.__positions[tid] = bytearray()
+                        self.__offsets[tid] = array('I')
+                    self.__nr_words += 1
+                elif self.__ids[tid] is False:
+                    self.__load(tid)
+                self.__ids[tid].append(did)
+                self.__freqs[tid].append(freq)
+                if self.positional:
+                    self.__add_positions(tid, positions.get(word, []))
+        recorder.count('documents_indexed')
+
+    ## positions of the words of a document
+    #  @param doc type: SearchDocument
+    #  @return type: dict(key:str, value:list[int])
+    def __doc_positions(self, doc):
+        res = {}
+        sequence = getattr(doc, 'positions', None)
+        if sequence:
+            term = doc.tf.vocab.term
+            for pos, tid in enumerate(decode_sequence(sequence)):
+                if tid is not None:
+                    res.setdefault(term(tid), []).append(pos)
+        return res
+
+    ## append the positions of the last posting of a word
+    #  @param tid type: int
+    #  @param positions in ascending order, type: list[int]
+    def __add_positions(self, tid, positions):
+        buf = self.__positions[tid]
+        self.__offsets[tid].append(len(buf))
+        put_varint(len(positions), buf)
+        last = 0
+        for p in positions:
+            put_varint(p - last, buf)
+            last = p
+
+    ## read the postings of the given term ID from the snapshot
+    #  @param tid type: int
+    def __load(self, tid):
+        snapshot, offsets, ids_at, freqs_at = self.__base
+        start, end = offsets[tid], offsets[tid + 1]
+        ids, freqs = array('I'), array('f')
+        ids.fromstring(snapshot.mm[ids_at + 4 * start:ids_at + 4 * end])
+        freqs.fromstring(snapshot.mm[freqs_at + 4 * start:freqs_at + 4 * end])
+        self.__ids[tid], self.__freqs[tid] = ids, freqs
+        if self.positional:
+            # the positions are not saved, the postings have none
+            self.__positions[tid] = bytearray(len(ids))
+            self.__offsets[tid] = array('I', xrange(len(ids)))
+
+    ## postings of the given term ID
+    #  @param tid type: int
+    #  @return (document IDs, term frequencies), type: tuple(array('I'), array('f'))
+    def __postings(self, tid):
+        if self.__ids[tid] is False:
+            self.__load(tid)
+        return self.__ids[tid], self.__freqs[tid]
+
+    ## term ID of the given word if it has postings, None otherwise
+    #  @param word type: str
+    #  @return type: int
+    def __tid(self, word):
+        tid = self.__vocab.id(word)
+        if tid is None or tid >= len(self.__ids) or self.__ids[tid] is None:
+            return None
+        return tid
+
+    ## the vocabulary of the collection
+    #  @return type: Vocabulary
+    def vocabulary(self):
+        return self.__vocab
 
     ## size of bag of words in the collection
     #  @return type: int
     def nr_words(self):
-        return len(self.__data)
+        return self.__nr_words
 
     ## number of documents in the collection
     #  @return type: int
     def nr_docs(self):
         return len(self.__docs)
 
+    ## document of the given document ID
+    #  @param did type: int
+    #  @return type: SearchDocument
+    def document(self, did):
+        return self.__docs[did]
+
     ## list of words in the collection
     #  @return type: list[str]
     def words(self):
-        return self.__data.keys()
+        return [self.__vocab.term(tid) for tid, ids in enumerate(self.__ids) \
+            if ids is not None]
 
     ## document frequency of the given word
-    #  df is the absolute number of documents that the word exists in
+    #  df is the absolute number of documents that the word exists in,
+    #  looking up an unknown word does not modify the collection
     #  @param word type: str
     #  @return type: int
     def df(self, word):
-        return len(self.__data[word])
+        tid = self.__tid(word)
+        if tid is None:
+            return 0
+        if self.__ids[tid] is False:
+            offsets = self.__base[1]
+            return offsets[tid + 1] - offsets[tid]
+        return len(self.__ids[tid])
 
     ## inverse document frequency of the given word
-    #  idf is log(N/df), where N is the total number of documents, 
+    #  idf is log(N/df), where N is the total number of documents,
     #  if df or N is 0, return 0.0; log is base 10
     #  @param word type: str
     #  @return type: float
@@ -72,9 +274,135 @@ class InvertedFiles(object):
         return log(float(n)/df, 10)
 
     ## term frequencies of the given word in documents
-    #  tf is the absolute number of appearances of the word in a document, 
-    #  for data protection a copy of the data is returned
+    #  tf is the value in SearchDocument.tf of each document, a read-only
+    #  view of the postings is returned instead of a copy
     #  @param word type: str
-    #  @return type: dict(key:SearchDocument, value:int)
+    #  @return type: PostingsView(key:SearchDocument, value:float)
     def tfs(self, word):
-        return dict(self.__data[word])
+        tid = self.__tid(word)
+        if tid is None:
+            return PostingsView(self.__docs, array('I'), array('f'))
+        return PostingsView(self.__docs, *self.__postings(tid))
+
+    ## positions of the given word in the given document
+    #  @param word type: str
+    #  @param did document ID, type: int
+    #  @return in ascending order, empty if none or not positional, type: list[int]
+    def positions(self, word, did):
+        tid = self.__tid(word)
+        if tid is None or not self.positional:
+            return []
+        ids = self.__postings(tid)[0]
+        i = bisect_left(ids, did)
+        if i == len(ids) or ids[i] != did:
+            return []
+        return self.__read_positions(tid, i)
+
+    ## positions of the i-th posting of the given term ID
+    #  @param tid type: int
+    #  @param i type: int
+    #  @return type: list[int]
+    def __read_positions(self, tid, i):
+        buf = self.__positions[tid]
+        n, pos = get_varint(buf, self.__offsets[tid][i])
+        res, last = [], 0
+        for _ in xrange(n):
+            gap, pos = get_varint(buf, pos)
+            last += gap
+            res.append(last)
+        return res
+
+    ## term frequencies of a phrase, i.e. of consecutive words, in documents
+    #  the frequency is scaled as the tf of the first word, i.e. the count of
+    #  the phrase times the tf of one occurrence of the first word
+    #  @param words type: list[str]
+    #  @return documents IDs to frequencies, of the documents containing the
+    #          phrase, type: dict(key:int, value:float)
+    def phrase_tfs(self, words):
+        res = {}
+        tids = [self.__tid(w) for w in words]
+        if not self.positional or not words or None in tids:
+            return res
+        postings = [self.__postings(t) for t in tids]
+        # the documents containing all words, by the shortest postings
+        shortest = min(range(len(tids)), key=lambda j: len(postings[j][0]))
+        for did in postings[shortest][0]:
+            indices = []
+            for ids, _ in postings:
+                i = bisect_left(ids, did)
+                if i == len(ids) or ids[i] != did:
+                    break
+                indices.append(i)
+            else:
+                first = self.__read_positions(tids[0], indices[0])
+                if not first:
+                    continue
+                starts = set(first)
+                for n in range(1, len(tids)):
+                    starts &= set(p - n for p in self.__read_positions(tids[n], indices[n]))
+                    if not starts:
+                        break
+                if starts:
+                    res[did] = len(starts) * postings[0][1][indices[0]] / len(first)
+        return res
+
+    ## memory used by the collection, in bytes
+    #  the documents themselves are not included, only the references to them
+    #  @return type: dict(key:str, value:int)
+    def memory_usage(self):
+        # postings still in the snapshot take no memory
+        postings = sys.getsizeof(self.__ids) + sys.getsizeof(self.__freqs) + \
+            sum(sys.getsizeof(a) for a in self.__ids if a) + \
+            sum(sys.getsizeof(a) for a in self.__freqs if a) + \
+            sum(sys.getsizeof(a) for a in self.__positions if a) + \
+            sum(sys.getsizeof(a) for a in self.__offsets if a)
+        res = {
+            'docs': sys.getsizeof(self.__docs),
+            'vocabulary': self.__vocab.memory_usage(),
+            'postings': postings,
+        }
+        res['total'] = sum(res.values())
+        return res
+
+    ## save the collection as sections "<prefix>.docs", "<prefix>.offsets",
+    #  "<prefix>.ids" and "<prefix>.freqs" of a snapshot; the vocabulary is
+    #  saved separately, since it may be shared
+    #  @param writer type: SnapshotWriter
+    #  @param prefix type: str
+    def save(self, writer, prefix):
+        writer.add(prefix + '.docs', pack_strings([d.key for d in self.__docs]))
+        offsets, ids, freqs = array('I', [0]), array('I'), array('f')
+        for tid in range(len(self.__ids)):
+            if self.__ids[tid] is not None:
+                i, f = self.__postings(tid)
+                ids.extend(i)
+                freqs.extend(f)
+            offsets.append(len(ids))
+        writer.add(prefix + '.offsets', offsets.tostring())
+        writer.add(prefix + '.ids', ids.tostring())
+        writer.add(prefix + '.freqs', freqs.tostring())
+
+    ## load a collection saved by save()
+    #  the documents are DocumentRef, and the postings are read from the
+    #  snapshot on first use, which must stay open meanwhile
+    #  @param snapshot type: Snapshot
+    #  @param prefix type: str
+    #  @param vocab the vocabulary of the collection, type: Vocabulary
+    #  @param positional (False) True to keep the positions of the documents
+    #         added from now on, type: bool
+    #  @return type: InvertedFiles
+    @classmethod
+    def load(cls, snapshot, prefix, vocab, positional=False):
+        invf = cls(vocab=vocab, positional=positional)
+        invf.__docs = [DocumentRef(k) for k in snapshot.strings(prefix + '.docs')]
+        offsets = array('I')
+        offsets.fromstring(snapshot.read(prefix + '.offsets'))
+        invf.__base = (snapshot, offsets, snapshot.section(prefix + '.ids')[0],
+                       snapshot.section(prefix + '.freqs')[0])
+        invf.__ids = [False if offsets[t + 1] > offsets[t] else None \
+                      for t in xrange(len(offsets) - 1)]
+        invf.__freqs = list(invf.__ids)
+        if positional:
+            invf.__positions, invf.__offsets = list(invf.__ids), list(invf.__ids)
+        invf.__nr_words = len(invf.__ids) - invf.__ids.count(None)
+        return invf
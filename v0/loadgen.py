@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import argparse
+import httplib
+import json
+import random
+import sys
+import threading
+from timeit import default_timer as timer
+from bench import recorded_items, synthetic_items
+
+"""Load generator of the relevance feedback service
+
+each client thread runs whole sessions against the service: it creates a
+session, submits several rounds of results and judgments, and deletes the
+session, over one kept-alive connection. The latency of every request is
+recorded, and the throughput and latency percentiles are reported as JSON.
+"""
+
+## send one JSON request
+#  @param conn type: httplib.HTTPConnection
+#  @param method type: str
+#  @param path type: str
+#  @param body type: dict
+#  @return (status, JSON response), type: tuple(int, dict)
+def request(conn, method, path, body=None):
+    data = json.dumps(body) if body is not None else ''
+    conn.request(method, path, data, {'Content-Type': 'application/json',
+                                      'Content-Length': str(len(data))})
+    resp = conn.getresponse()
+    return resp.status, json.loads(resp.read() or '{}')
+
+## run sessions of one client
+#  @param args command line arguments
+#  @param items result items to submit, type: list[dict]
+#  @param seed random seed of the client, type: int
+#  @param latencies shared list of (request kind, seconds), type: list
+#  @param errors shared list of failed requests, type: list
+def client(args, items, seed, latencies, errors):
+    rnd = random.Random(seed)
+    conn = httplib.HTTPConnection(args.host, args.port, timeout=30)
+
+    def timed(kind, method, path, body=None):
+        start = timer()
+        try:
+            status, res = request(conn, method, path, body)
+        except Exception as e:
+            conn.close()
+            errors.append(repr(e))
+            return None
+        latencies.append((kind, timer() - start))
+        if status >= 400:
+            errors.append('{} {}: {}'.format(method, path, status))
+            return None
+        return res
+
+    for _ in range(args.sessions):
+        res = timed('create', 'POST', '/sessions', {'query': args.query})
+        if res is None: continue
+        path = '/sessions/{}'.format(res['id'])
+        for _ in range(args.rounds):
+            batch = rnd.sample(items, min(10, len(items)))
+            relevant = [i['link'] for i in batch if rnd.random() < 0.3]
+            timed('feedback', 'POST', path + '/feedback',
+                  {'items': batch, 'relevant': relevant, 'k': 2})
+        timed('delete', 'DELETE', path)
+    conn.close()
+
+## percentile of sorted values
+#  @param values sorted values, type: list[float]
+#  @param p percentile, type: float
+#  @return type: float
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+## main
+def main(args):
+    items = recorded_items() if args.recorded else []
+    if not items:
+        items = synthetic_items(200, 2000, 30)
+    items = [dict((k, i[k]) for k in ('title', 'displayLink', 'link', 'snippet')) for i in items]
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(args, items, n, latencies, errors))
+               for n in range(args.clients)]
+    start = timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = timer() - start
+
+    report = {'clients': args.clients, 'requests': len(latencies), 'errors': len(errors),
+              'seconds': elapsed, 'rps': len(latencies) / elapsed if elapsed else 0.0}
+    for kind in ['all', 'create', 'feedback', 'delete']:
+        values = sorted(s for k, s in latencies if kind == 'all' or k == kind)
+        report[kind] = {'count': len(values), 'p50': percentile(values, 50),
+                        'p90': percentile(values, 90), 'p99': percentile(values, 99),
+                        'max': values[-1] if values else 0.0}
+    print json.dumps(report, indent=1, sort_keys=True)
+    for e in errors[:10]:
+        print >> sys.stderr, e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator of the relevance feedback service')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address of the service')
+    parser.add_argument('--port', type=int, default=8111, help='port of the service')
+    parser.add_argument('--clients', type=int, default=50, help='number of concurrent clients')
+    parser.add_argument('--sessions', type=int, default=5, help='sessions per client')
+    parser.add_argument('--rounds', type=int, default=3, help='feedback rounds per session')
+    parser.add_argument('--query', type=str, default='brin', help='initial query of sessions')
+    parser.add_argument('--synthetic', dest='recorded', action='store_false',
+                        help='submit synthetic results instead of the recorded ones')
+
+    main(parser.parse_args())
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+import argparse
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from math import log
+from timeit import default_timer as timer
+from cache import LRUCache, ScrapeCache, normalize_url
+from gsearch import FallbackSearch, GoogleSearch, SearchBackend, SearchDocument
+from invfile import InvertedFiles
+from tokenizer import tokenizer
+from varint import get_varint, put_varint
+
+## header of an index file: magic, number of documents, number of terms,
+#  average document length, k1 and b of BM25
+header = struct.Struct('<4sIIddd')
+magic = 'BM25'
+## per-term entry: df, offset and size of the postings, max score
+entry = struct.Struct('<IQIf')
+## document ID past the end of every postings list
+sentinel = 0xffffffff
+## fields of a result item
+fields = ('title', 'displayLink', 'link', 'snippet')
+
+## decode postings of (document ID gap, term frequency) varints
+#  @param buf type: bytearray
+#  @param n number of postings, type: int
+#  @return (document IDs, term frequencies), type: tuple(array('I'), array('I'))
+def decode_postings(buf, n):
+    ids, tfs = array('I'), array('I')
+    pos, did = 0, 0
+    for _ in xrange(n):
+        gap, pos = get_varint(buf, pos)
+        tf, pos = get_varint(buf, pos)
+        did += gap
+        ids.append(did)
+        tfs.append(tf)
+    return ids, tfs
+
+## write a BM25 index of the given documents
+#  the layout of the index file is:
+#      header      magic, N documents, T terms, average length, k1, b
+#      offsets     T+1 uint32, offset of each term in the string area
+#      entries     T * (df, postings offset, postings size, max score)
+#      lengths     N uint32, length of each document
+#      items       N+1 uint64, offset of each item in the item area
+#      strings     UTF-8 terms, in sorted order
+#      items       JSON result item of each document
+#      postings    per term, varint (document ID gap, term frequency) pairs
+#  @param path type: str
+#  @param docs (result item, full text or None) of each document, type: iterable(tuple)
+#  @param k1 BM25 term frequency saturation, type: float
+#  @param b BM25 length normalization, type: float
+#  @return number of documents, type: int
+def write_index(path, docs, k1=1.2, b=0.75):
+    items, invf = [], InvertedFiles()
+    for item, text in docs:
+        item = dict((f, item.get(f, u'')) for f in fields)
+        text = u' '.join([item['title'], item['snippet'], text or u''])
+        # raw counts, not normalized: BM25 needs the term frequency
+        invf.add_document(SearchDocument(item, stemming=True, htmltext=True, text=text))
+        items.append(json.dumps(item))
+    n = len(items)
+    lengths = array('I', [invf.document(i).size for i in range(n)])
+    avgdl = float(sum(lengths)) / n if n else 0.0
+    norms = [k1 * (1 - b + b * l / avgdl) if avgdl else k1 for l in lengths]
+
+    terms = sorted((w.encode('utf-8'), w) for w in invf.words())
+    offsets, pos = array('I', [0]), 0
+    for t, _ in terms:
+        pos += len(t)
+        offsets.append(pos)
+    entries, postings = [], bytearray()
+    for _, w in terms:
+        tfs = invf.tfs(w)
+        start, last, best = len(postings), 0, 0.0
+        df = len(tfs)
+        idf = log(1 + (n - df + 0.5) / (df + 0.5))
+        for did, tf in zip(tfs.doc_ids(), tfs.values()):
+            tf = int(tf)
+            put_varint(did - last, postings)
+            put_varint(tf, postings)
+            last = did
+            best = max(best, idf * tf * (k1 + 1) / (tf + norms[did]))
+        # rounded up, so that float32 never underestimates the bound
+        entries.append(entry.pack(df, start, len(postings) - start, best * (1 + 1e-6)))
+    item_offsets, pos = [0], 0
+    for i in items:
+        pos += len(i)
+        item_offsets.append(pos)
+
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(header.pack(magic, n, len(terms), avgdl, k1, b))
+        f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+        f.write(''.join(entries))
+        f.write(struct.pack('<{}I'.format(n), *lengths))
+        f.write(struct.pack('<{}Q'.format(n + 1), *item_offsets))
+        f.write(''.join(t for t, _ in terms))
+        f.write(''.join(items))
+        f.write(str(postings))
+    os.rename(tmp, path)
+    return n
+
+## documents of the cached scrapes and cached search results
+#  a result whose page is cached is indexed with its full text, a page
+#  without a result is indexed with its URL as the title
+#  @param scrapings the directory of the scrape cache, type: str
+#  @param queries the query store database, type: str
+#  @return (result item, full text or None) of each document, type: list[tuple]
+def cached_documents(scrapings="scrapings", queries="tmp/queries.db"):
+    from qstore import QueryStore
+    docs = {}
+    if os.path.exists(queries):
+        for _, res in QueryStore(queries, ttl=None).entries():
+            for item in res.get('items', []):
+                docs.setdefault(normalize_url(item['link']), [item, None])
+    for meta, text in ScrapeCache(scrapings).entries():
+        text = text.decode('utf-8', 'ignore')
+        doc = docs.get(meta['url'])
+        if doc is None:
+            host = meta['url'].split('/')[2] if '//' in meta['url'] else meta['url']
+            docs[meta['url']] = [{'title': meta['url'], 'displayLink': host,
+                                  'link': meta['url'], 'snippet': text[:160]}, text]
+        else:
+            doc[1] = text
+    return [tuple(docs[u]) for u in sorted(docs)]
+
+
+"""Local Search Backend class
+
+answers queries from a BM25 index of cached documents on disk, so that the
+feedback loop can run offline, e.g. for testing or when the API is
+throttled. The index file is memory-mapped and read in place; the postings
+are delta and varint compressed, and decoded on demand into a small LRU
+cache. The top k documents are found by MaxScore: the query terms are
+ordered by their max score, and the documents matching only terms whose
+max scores can't lift them into the current top k are never enumerated.
+"""
+class LocalSearch(SearchBackend):
+    ## the constructor
+    #  @param path the index file, type: str
+    #  @param top number of results of a query, type: int
+    #  @param cache_size number of decoded postings lists cached, type: int
+    def __init__(self, path="tmp/local.idx", top=10, cache_size=4096):
+        self.path = path
+        self.top = top
+        self.postings_cache = LRUCache(cache_size)
+        with open(path, 'rb') as f:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        tag, self.nr_docs, self.nr_terms, self.avgdl, self.k1, self.b = \
+            header.unpack_from(self.__mm, 0)
+        if tag != magic:
+            raise ValueError("not a BM25 index: {}".format(path))
+        n, t = self.nr_docs, self.nr_terms
+        self.__offsets = header.size
+        self.__entries = self.__offsets + 4 * (t + 1)
+        lengths = self.__entries + entry.size * t
+        self.__items = lengths + 4 * n
+        self.__strings = self.__items + 8 * (n + 1)
+        end = struct.unpack_from('<I', self.__mm, self.__offsets + 4 * t)[0]
+        self.__item_area = self.__strings + end
+        end = struct.unpack_from('<Q', self.__mm, self.__items + 8 * n)[0]
+        self.__postings = self.__item_area + end
+        # length normalization of each document
+        dl = struct.unpack_from('<{}I'.format(n), self.__mm, lengths)
+        self.norms = array('d', [self.k1 * (1 - self.b + self.b * l / self.avgdl) \
+                                 if self.avgdl else self.k1 for l in dl])
+
+    ## term of the given index
+    #  @param i type: int
+    #  @return UTF-8 term, type: str
+    def __term(self, i):
+        start, end = struct.unpack_from('<II', self.__mm, self.__offsets + 4 * i)
+        return self.__mm[self.__strings + start:self.__strings + end]
+
+    ## index of the given UTF-8 term
+    #  @param term type: str
+    #  @return -1 if not found, type: int
+    def __find(self, term):
+        lo, hi = 0, self.nr_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__term(mid) < term: lo = mid + 1
+            else: hi = mid
+        return lo if lo < self.nr_terms and self.__term(lo) == term else -1
+
+    ## document frequency, postings and max score of the given word
+    #  @param word type: str
+    #  the document IDs end with the sentinel ID
+    #  @return None if not found, type: tuple(int, array('I'), array('I'), float)
+    def postings(self, word):
+        term = word.encode('utf-8') if isinstance(word, unicode) else word
+        res = self.postings_cache.get(term)
+        if res is None:
+            i = self.__find(term)
+            if i < 0: return None
+            df, offset, size, maxscore = entry.unpack_from(self.__mm,
+                                                           self.__entries + entry.size * i)
+            start = self.__postings + offset
+            ids, tfs = decode_postings(bytearray(self.__mm[start:start + size]), df)
+            ids.append(sentinel)
+            res = (df, ids, tfs, maxscore)
+            self.postings_cache.put(term, res)
+        return res
+
+    ## result item of the given document ID
+    #  @param did type: int
+    #  @return type: dict
+    def item(self, did):
+        start, end = struct.unpack_from('<QQ', self.__mm, self.__items + 8 * did)
+        return json.loads(self.__mm[self.__item_area + start:self.__item_area + end])
+
+    ## the top k documents of the given query terms by BM25
+    #  @param words stemmed query terms, repeated terms weigh more, type: list[str]
+    #  @param k type: int
+    #  @return (score, document ID) by descending score, type: list[tuple(float, int)]
+    def top_docs(self, words, k=10):
+        k1, norms = self.k1, self.norms
+        n = self.nr_docs
+        # [upper bound, weight, document IDs, term frequencies, cursor]
+        lists = []
+        for word, qtf in Counter(words).items():
+            p = self.postings(word)
+            if p is None: continue
+            df, ids, tfs, maxscore = p
+            idf = log(1 + (n - df + 0.5) / (df + 0.5))
+            lists.append([maxscore * qtf, idf * qtf * (k1 + 1), ids, tfs, 0])
+        if not lists or k <= 0:
+            return []
+        lists.sort(key=lambda l: l[0])
+        # bounds[i] is the max score of a document matching only lists[:i+1]
+        bounds, total = [], 0.0
+        for l in lists:
+            total += l[0]
+            bounds.append(total)
+
+        heap, theta = [], 0.0
+        first = 0 # lists[first:] are essential, a document must match one of them
+        essential, optional = lists, []
+        while True:
+            # the next document of the essential lists, postings end with
+            # the sentinel document ID
+            did = min(l[2][l[4]] for l in essential)
+            if did == sentinel:
+                break
+            score = 0.0
+            for l in essential:
+                pos = l[4]
+                if l[2][pos] == did:
+                    tf = l[3][pos]
+                    score += l[1] * tf / (tf + norms[did])
+                    l[4] = pos + 1
+            # non-essential lists, while they can still lift the document
+            for j, l in optional:
+                if score + bounds[j] <= theta:
+                    break
+                pos = l[4] = bisect_left(l[2], did, l[4])
+                if l[2][pos] == did:
+                    tf = l[3][pos]
+                    score += l[1] * tf / (tf + norms[did])
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -did))
+            elif score > theta:
+                heapq.heapreplace(heap, (score, -did))
+            else:
+                continue
+            if len(heap) == k:
+                theta = heap[0][0]
+                if bounds[first] <= theta:
+                    while first < len(lists) and bounds[first] <= theta:
+                        first += 1
+                    if first == len(lists):
+                        break
+                    essential = lists[first:]
+                    optional = [(j, lists[j]) for j in range(first - 1, -1, -1)]
+        return [(s, -d) for s, d in sorted(heap, reverse=True)]
+
+    ## search the given query
+    #  @param query query terms, type: str
+    #  @param session (None) ID of the session searching, unused, type: str
+    #  @return JSON formatted result, as of Google search API, type: dict
+    def search(self, query, session=None):
+        words = tokenizer.tokenize(query if isinstance(query, unicode) \
+                                   else query.decode('utf-8', 'ignore'))
+        return {'items': [self.item(did) for _, did in self.top_docs(words, self.top)]}
+
+    def close(self):
+        self.__mm.close()
+
+
+## the search backend of the given kind
+#  @param kind 'google' for the API, 'local' for the local index, or 
+#         'fallback' for the API falling back to the local index, type: str
+#  @param api the Google search API key, type: str
+#  @param engine the Google search engine ID, type: str
+#  @param index the local index file, type: str
+#  @return type: SearchBackend
+def search_backend(kind, api=None, engine=None, index="tmp/local.idx"):
+    if kind == 'google':
+        return GoogleSearch(api, engine)
+    elif kind == 'local':
+        return LocalSearch(index)
+    elif kind == 'fallback':
+        return FallbackSearch(GoogleSearch(api, engine), LocalSearch(index))
+    raise ValueError("invalid search backend: {}".format(kind))
+
+
+## main
+def main(args):
+    tokenizer.persist()
+    if args.action == 'build':
+        start = timer()
+        n = write_index(args.index, cached_documents(args.scrapings, args.queries),
+                        args.k1, args.b)
+        print >> sys.stderr, "indexed {} documents in {:.2f}s".format(n, timer() - start)
+        return
+    index = LocalSearch(args.index, args.top)
+    for i, item in enumerate(index.search(' '.join(args.query))['items']):
+        print u"{:>3} {}\n    {}".format(i + 1, item['title'], item['link'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local BM25 search over cached documents')
+    parser.add_argument('action', choices=['build', 'search'],
+                        help='build the index from the caches, or search it')
+    parser.add_argument('query', nargs='*', help='query terms to search')
+    parser.add_argument('--index', type=str, default='tmp/local.idx', help='the index file')
+    parser.add_argument('--scrapings', type=str, default='scrapings',
+                        help='directory of the scrape cache')
+    parser.add_argument('--queries', type=str, default='tmp/queries.db',
+                        help='database of the query store')
+    parser.add_argument('--k1', type=float, default=1.2, help='BM25 term frequency saturation')
+    parser.add_argument('-b', type=float, default=0.75, help='BM25 length normalization')
+    parser.add_argument('--top', type=int, default=10, help='number of results')
+
+    # positional words may follow the options as well
+    args, rest = parser.parse_known_args()
+    if [w for w in rest if w.startswith('-')]:
+        parser.error("unrecognized arguments: {}".format(' '.join(rest)))
+    args.query += rest
+    main(args)
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
 import argparse
+from dfindex import DFIndex
 from gsearch import *
+from localsearch import search_backend
 from rocchio import *
+from speculate import Speculator
+from instrument import recorder, json_hook
 from termcolor import colored
-from nltk.stem.snowball import SnowballStemmer
+from tokenizer import tokenizer
 
 nocol = False # no colors
-stemmer = SnowballStemmer("english")
 
 ## color the string based on its type
 #  @param s string, type: str
@@ -38,10 +41,11 @@ def highlight_keywords(string, keywords):
     if nocol:
         return string
     string = string.encode('ascii', 'ignore')
-    keys = [stemmer.stem(w) for w in keywords]
+    keys = set(tokenizer.tokenize(" ".join(keywords)))
+    words = string.split()
     res = []
-    for i, w in enumerate(string.split()):
-        if stemmer.stem(filter(str.isalnum, w.lower())) in keys:
+    for w, terms in zip(words, tokenizer.tokenize_many(words)):
+        if terms and terms[0] in keys:
             res.append(color(w, 'key'))
         else:
             res.append(color(w))
@@ -49,9 +53,9 @@ def highlight_keywords(string, keywords):
 
 ## validate input arguments
 def validate(args):
-    # validate search API
+    # validate search API, not needed by the local search
     api = args.api
-    if not api:
+    if not api and args.search != 'local':
         try:
             from secrets import GSEARCH_JSON_API
             api = GSEARCH_JSON_API
@@ -60,7 +64,7 @@ def validate(args):
             exit(1)
     # validate search engine
     engine = args.engine
-    if not engine:
+    if not engine and args.search != 'local':
         try:
             from secrets import GSEARCH_ENGINE
             engine = GSEARCH_ENGINE
@@ -86,14 +90,16 @@ def validate(args):
 ## collect user feedbacks on the documents returned by search engine,
 #  the feedback is binary Y/N indicating whether the document is relevant.
 #  @param docs documents returned by search engine, type: list[SearchDocument]
-def feedback(docs, keywords):
+#  @param judged (None) function called after each judgment, type: function(SearchDocument, bool)
+def feedback(docs, keywords, judged=None):
     # to save human effort, we save the previous feedbacks in two files: 
     # "tmp/rel.txt" and "tmp/irrel.txt", where each row is the key of a doc
     def f2set(f):
         res = set()
         for line in f.readlines():
             r = line.rstrip()
-            if r: res.add(r)
+            # rows written before the keys were canonical URLs
+            if r: res.add(canonical_url(r))
         return res
 
     try:
@@ -102,7 +108,7 @@ def feedback(docs, keywords):
         rels, irrels = f2set(rf), f2set(irf)
     except:
         rf = irf = None
-        rels = irrels = []
+        rels, irrels = set(), set()
 
     # for each document, require user feedback if not already in rels/irrels
     rel, irrel = set(), set()
@@ -120,17 +126,28 @@ def feedback(docs, keywords):
         elif doc.key in irrels:
             print "\n" + color("already marked irrelevant, continue...", "irrel")
             irrel.add(doc)
+        elif doc.duplicate_of in rels:
+            # a copy of a page already judged
+            print "\n" + color("duplicate of a relevant page, continue...", "rel")
+            rel.add(doc)
+        elif doc.duplicate_of in irrels:
+            print "\n" + color("duplicate of an irrelevant page, continue...", "irrel")
+            irrel.add(doc)
         else:
             i = raw_input("\n" + color("Is this relevant (" + \
                 color("Y", "rel") + color("/") + color("N", "irrel") + color(")? ")))
             if i.strip().lower() in ['y', 'yes']:
                 print color("marked relevant...", "rel")
                 rel.add(doc)
+                rels.add(doc.key)
                 if rf: rf.write(doc.key + '\n')
             else:
                 print color("marked irrelevant...", "irrel")
                 irrel.add(doc)
+                irrels.add(doc.key)
                 if irf: irf.write(doc.key + '\n')
+        if judged is not None:
+            judged(doc, doc in rel)
     print ""
 
     l1, l2 = len(rel), len(irrel)
@@ -143,20 +160,63 @@ def main(args):
     target_precision, query_terms, api, engine = validate(args)
     global nocol
     nocol = args.nocol
+    tokenizer.persist()
+
+    # tokenize the full texts of webpages on several cores; the workers are 
+    # forked before any other thread is started
+    if args.htmltext and args.count_workers != 0:
+        word_counter.configure(args.count_workers if args.count_workers > 0 else None)
+
+    # settings of the search API client
+    client_options.update({'pages': args.pages, 'endpoint': args.endpoint,
+                           'qps': args.qps, 'daily_quota': args.daily_quota or None})
+
+    # optionally, record the time and counters of each iteration
+    if args.trace:
+        recorder.enable()
+        recorder.add_hook(json_hook(open(args.trace, 'a')))
+        recorder.add_probe('stem_cache', tokenizer.stats)
+        recorder.add_probe('query_store', store.stats)
+        recorder.add_probe('scrape_cache', SearchDocument.scraper.cache.stats)
+        if args.search != 'local':
+            recorder.add_probe('search_api', search_client(api, engine).stats)
+
+    # optionally, use and update a corpus-wide document frequency index
+    index = DFIndex(args.dfindex) if args.dfindex else None
+    if index is not None and args.trace:
+        recorder.add_probe('dfindex', index.stats)
+
+    # the source of search results
+    search = search_backend(args.search, api, engine, args.index)
 
     # set Rocchio weights: relevant 0.75, irrelevant 0.25
-    ro = Rocchio(0.75, 0.25)
+    ro = Rocchio(0.75, 0.25, backend=args.backend, dfindex=index, blend=args.blend,
+                 phrases=args.phrases)
+    # optionally, expand the query and prefetch the next search while the 
+    # user is judging the results
+    spec = Speculator(ro, api, engine, args.htmltext, backend=search,
+                      passages=args.passages) if args.speculate else None
     iteration, precision = 0, 0.0
     while iteration == 0 or precision < target_precision:
         print color("=" * 80, "delim")
         print color("[iteration: ", "bold") + color(str(iteration), "strong") + \
               color("]", "bold")
         print color("query: ", "bold") + color(" ".join(query_terms), "strong")
-        # apply search on the current query terms
-        docs = gsearch(" ".join(query_terms), api, engine)
+        # apply search on the current query terms, unless already prefetched
+        docs = spec.take(" ".join(query_terms)) if spec else None
+        if docs is None:
+            docs = gsearch(" ".join(query_terms), api, engine, htmltext=args.htmltext,
+                           backend=search, duplicates=ro.duplicates, positional=args.phrases,
+                           passages=args.passages, vocab=ro.vocab)
+        if index is not None:
+            for doc in docs:
+                if doc.duplicate_of is None:
+                    index.add_document(doc)
         
         # collect user feedback
-        rel, irrel, precision = feedback(docs, query_terms)
+        if spec: spec.begin(query_terms)
+        with recorder.span('feedback'):
+            rel, irrel, precision = feedback(docs, query_terms, spec.judge if spec else None)
         print color("[iteration: ", "bold") + color(str(iteration), "strong") + color("] ", "bold") + \
               color(str(len(rel)), "strong") + color(" relevant, ", "bold") + \
               color(str(len(irrel)), "strong") + color(" irrelevant, ", "bold") + \
@@ -165,14 +225,19 @@ def main(args):
         if precision >= target_precision:
             # target achieved
             print color("target precision %.1f has been achieved" % target_precision, "rel")
+            recorder.flush(iteration=iteration, query=" ".join(query_terms), precision=precision)
             break
         elif precision == 0:
             # no need to move on
             print color("no need to continue under zero precision", "error")
+            recorder.flush(iteration=iteration, query=" ".join(query_terms), precision=precision)
             break
 
         # update query string
+        query = " ".join(query_terms)
+        if spec: spec.wait()
         query_terms += ro.generate_query(rel, irrel, query_terms)
+        recorder.flush(iteration=iteration, query=query, precision=precision)
 
         iteration += 1
         if iteration >= 10:
@@ -180,6 +245,9 @@ def main(args):
             print color("maximum iteration exceeded", "error")
             break
 
+    if spec: spec.close()
+    if index is not None:
+        index.merge()
     print color("Exit...\n", "bold")
 
 
@@ -191,6 +259,37 @@ if __name__ == '__main__':
     parser.add_argument('--api', type=str, help='Google search API key')
     parser.add_argument('--engine', type=str, help='Google search engine ID')
     parser.add_argument('--nocol', action="store_true", help='Disable color prints')
+    parser.add_argument('--htmltext', action="store_true",
+                        help='Use the scraped html text of webpages instead of snippets')
+    parser.add_argument('--passages', action="store_true",
+                        help='With --htmltext, index only the passages of webpages around the query terms')
+    parser.add_argument('--count-workers', type=int, default=0,
+                        help='Processes tokenizing the html texts, 0 for none, -1 for the number of CPUs')
+    parser.add_argument('--trace', type=str,
+                        help='Append per-iteration timings and counters as JSON lines to file')
+    parser.add_argument('--backend', type=str, default='python', choices=['python', 'matrix'],
+                        help='Rocchio weighting backend, "matrix" requires numpy')
+    parser.add_argument('--phrases', action="store_true",
+                        help='Expand the query with phrases as well, python backend only')
+    parser.add_argument('--search', type=str, default='google',
+                        choices=['google', 'local', 'fallback'],
+                        help='Source of results: the API, the local index of cached documents, '
+                             'or the API falling back to the local index')
+    parser.add_argument('--index', type=str, default='tmp/local.idx',
+                        help='Local index file, built by "localsearch.py build"')
+    parser.add_argument('--pages', type=int, default=1,
+                        help='Result pages of 10 results fetched per query, at most 10')
+    parser.add_argument('--endpoint', type=str,
+                        help='URL of the search API, e.g. of a local fake for tests')
+    parser.add_argument('--qps', type=float, default=5.0, help='Max search API requests per second')
+    parser.add_argument('--daily-quota', type=int, default=100,
+                        help='Max search API requests per day, 0 for unlimited')
+    parser.add_argument('--no-speculate', dest='speculate', action="store_false",
+                        help='Do not expand the query and prefetch the next search during feedback')
+    parser.add_argument('--dfindex', type=str,
+                        help='directory of a corpus-wide document frequency index to use and update')
+    parser.add_argument('--blend', type=float, default=0.5,
+                        help='weight of the corpus-wide idf against the session idf, [0, 1]')
 
     # args = vars()
     main(parser.parse_args())
@@ -0,0 +1,45 @@
+from bisect import bisect_left
+
+## words of each passage
+passage_size = 50
+## passages kept of each document
+nr_passages = 3
+
+## the passages of a document around the given terms
+#  the words are split into windows of size words, overlapping by half; the
+#  positions of the terms in the document are indexed first, so that each
+#  window is scored by bisecting them rather than by scanning its words:
+#  first by the number of distinct terms it contains, then by their
+#  occurrences, then the earlier the better. The best windows that do not
+#  overlap and contain a term are kept; only if no term occurs in the page
+#  are the windows at its start kept instead
+#  @param words the words of the document in order, type: list[str]
+#  @param terms the (stemmed) query terms, type: set(str)
+#  @param size (passage_size) words of each passage, type: int
+#  @param top (nr_passages) max number of passages, type: int
+#  @return the words of each passage in document order, the whole document
+#          if it is not longer than the passages, type: list[list[str]]
+def best_passages(words, terms, size=passage_size, top=nr_passages):
+    if len(words) <= size * top:
+        return [words]
+    # positions of the terms, a small index of the document
+    hits = {}
+    for pos, w in enumerate(words):
+        if w in terms:
+            hits.setdefault(w, []).append(pos)
+
+    step = max(1, size // 2)
+    scores = []
+    for start in xrange(0, len(words) - size + step, step):
+        n = [bisect_left(p, start + size) - bisect_left(p, start) for p in hits.itervalues()]
+        scores.append((sum(1 for x in n if x), sum(n), -start))
+    chosen = []
+    for score in sorted(scores, reverse=True):
+        if hits and not score[0]:
+            break
+        start = -score[2]
+        if all(abs(start - s) >= size for s in chosen):
+            chosen.append(start)
+            if len(chosen) == top:
+                break
+    return [words[s:s + size] for s in sorted(chosen)]
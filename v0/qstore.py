@@ -0,0 +1,179 @@
+import glob
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from cache import LRUCache
+
+"""Query Store class
+
+an indexed store of search results, backed by a single SQLite database with
+an in-process LRU cache in front of it. Queries are normalized so that word
+order and case variants share one entry (the words of a quoted phrase keep
+their order), and entries expire after a TTL.
+Only the fields of each result item needed by SearchDocument are stored, so
+a stored result is ready to be turned into documents.
+
+The JSON files of results saved by earlier versions, one per query, are
+imported once: the imported files are recorded in the database, so that an
+entry imported from a file expires like any other and is not imported again.
+"""
+class QueryStore(object):
+    ## fields of a result item used by SearchDocument
+    fields = ('title', 'displayLink', 'link', 'snippet')
+    ## a quoted phrase of a query
+    quoted = re.compile(r'"([^"]*)"')
+
+    ## the constructor
+    #  @param path the SQLite database file, type: str
+    #  @param ttl seconds before an entry expires, None to never expire, type: float
+    #  @param lru_entries number of entries cached in memory, type: int
+    def __init__(self, path="tmp/queries.db", ttl=7*24*3600, lru_entries=256):
+        self.path = path
+        self.ttl = ttl
+        self.lru = LRUCache(lru_entries)
+        self.hits = self.misses = self.expired = 0
+        self.__db = None # opened on first use
+        self.__lock = threading.Lock()
+        self.__imported = False # legacy files imported by this process
+
+    ## the database connection, the table is created if necessary
+    #  @return type: sqlite3.Connection
+    def __conn(self):
+        if self.__db is None:
+            d = os.path.dirname(self.path)
+            if d and not os.path.exists(d):
+                os.makedirs(d)
+            self.__db = sqlite3.connect(self.path, check_same_thread=False)
+            self.__db.execute("CREATE TABLE IF NOT EXISTS results ("
+                              "key TEXT PRIMARY KEY, query TEXT, created REAL, items TEXT)")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS imported (fname TEXT PRIMARY KEY)")
+            self.__db.commit()
+        return self.__db
+
+    ## normalized key of a query: lowercase, distinct terms in sorted order,
+    #  where a quoted phrase is one term whose words are kept in order
+    #  @param query type: str
+    #  @return type: str
+    def key(self, query):
+        query = query.lower()
+        phrases = [u'"{}"'.format(u' '.join(p.split())) for p in self.quoted.findall(query) \
+                   if p.split()]
+        return u' '.join(sorted(set(self.quoted.sub(u' ', query).split() + phrases)))
+
+    ## check if an entry created at the given time has expired
+    #  @param created type: float
+    #  @return type: bool
+    def __expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    ## search result of the given query
+    #  @param query type: str
+    #  @return {'items': list[dict]}, None if not stored or expired, type: dict
+    def get(self, query):
+        key = self.key(query)
+        entry = self.lru.get(key)
+        if entry is not None and self.__expired(entry[0]):
+            self.lru.pop(key)
+            entry = None
+        if entry is None:
+            with self.__lock:
+                row = self.__conn().execute(
+                    "SELECT created, items FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = (row[0], {'items': json.loads(row[1])})
+                if self.__expired(entry[0]):
+                    self.expired += 1
+                    entry = None
+                else:
+                    self.lru.put(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    ## save the search result of the given query
+    #  @param query type: str
+    #  @param res JSON formatted result of Google search API, type: dict
+    #  @param created (None) time the result was fetched, now if None, type: float
+    #  @return the stored result, type: dict
+    def put(self, query, res, created=None):
+        key = self.key(query)
+        items = [dict((f, i.get(f, u'')) for f in self.fields) for i in res.get('items', [])]
+        if created is None:
+            created = time.time()
+        with self.__lock:
+            db = self.__conn()
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                       (key, query, created, json.dumps(items)))
+            db.commit()
+        stored = {'items': items}
+        self.lru.put(key, (created, stored))
+        return stored
+
+    ## import the results saved by earlier versions, one JSON file per query
+    #  named after its terms, e.g. "tmp/q_sergey-brin.txt"; each file is
+    #  imported only once, as fetched at its modification time, and unless
+    #  the store already holds the query. Files that cannot be read or parsed
+    #  are skipped. Only the first call of a process looks for files
+    #  @param pattern (tmp/q_*.txt) glob of the files, type: str
+    #  @return number of imported results, type: int
+    def import_files(self, pattern='tmp/q_*.txt'):
+        if self.__imported:
+            return 0
+        self.__imported = True
+        n = 0
+        for fname in sorted(glob.glob(pattern)):
+            with self.__lock:
+                db = self.__conn()
+                if db.execute("SELECT 1 FROM imported WHERE fname = ?", (fname,)).fetchone():
+                    continue
+                db.execute("INSERT INTO imported VALUES (?)", (fname,))
+                db.commit()
+            query = os.path.basename(fname)[2:-4].replace('-', ' ')
+            try:
+                with open(fname, 'r') as f:
+                    res = json.load(f)
+                created = os.path.getmtime(fname)
+            except (IOError, ValueError):
+                continue
+            with self.__lock:
+                held = self.__conn().execute("SELECT 1 FROM results WHERE key = ?",
+                                             (self.key(query),)).fetchone()
+            if not held:
+                self.put(query, res, created)
+                n += 1
+        return n
+
+    ## remove expired entries from the database
+    #  @return number of removed entries, type: int
+    def purge(self):
+        if self.ttl is None:
+            return 0
+        with self.__lock:
+            db = self.__conn()
+            n = db.execute("DELETE FROM results WHERE created < ?",
+                           (time.time() - self.ttl,)).rowcount
+            db.commit()
+        self.lru.clear()
+        return n
+
+    ## iterate over all unexpired entries
+    #  @return generator of (query, {'items': list[dict]}), type: generator(tuple)
+    def entries(self):
+        with self.__lock:
+            rows = self.__conn().execute("SELECT query, created, items FROM results").fetchall()
+        for query, created, items in rows:
+            if not self.__expired(created):
+                yield query, {'items': json.loads(items)}
+
+    ## counters of the store
+    #  @return type: dict(key:str, value:number)
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+                'lru_hits': self.lru.hits,
+                'hit_rate': float(self.hits) / total if total else 0.0}
@@ -1,6 +1,38 @@
+import json
+from array import array
+from collections import defaultdict
 from math import log
+from dedup import DuplicateIndex
 from invfile import *
 from heapq import nlargest
+from instrument import recorder
+from snapshot import Snapshot, SnapshotWriter
+
+## stop words of each file, loaded only once per process
+stop_words = {}
+
+## number of the best single words phrase candidates are made of
+phrase_seeds = 10
+
+## documents the corpus-wide index must hold before its idf, rather than
+#  the stop words, keeps words like 'is' and 'the' down
+min_corpus_docs = 1000
+
+## generate a set of stop words from local file 'stop.txt', if exists
+#  the set is shared by all Rocchio instances, and must not be modified
+#  @param fname type: str
+#  @return type: frozenset(str)
+def gen_stop_words(fname='stop.txt'):
+    if fname not in stop_words:
+        res = set()
+        try:
+            with open(fname, 'r') as f:
+                for l in f.readlines():
+                    res.add(l.rstrip())
+        except:
+            pass
+        stop_words[fname] = frozenset(res)
+    return stop_words[fname]
 
 """Rocchio Relevant Feedback class
 
@@ -20,70 +52,158 @@ Each vector element is the word's tf-idf value in the document, e.g. dr1 is a
 vector of tf-idf value of each word in the first document of set Dr. Negative 
 weights are treated as 0, so we only consider the words that exist in relevant 
 documents.
+
+Optionally, phrases are candidates as well: the inverted-files keep the
+positions of the words, and the ordered pairs of the best single words are
+weighted as one term from the documents they occur in next to each other,
+the best pairs extended to triples the same way. A chosen phrase is returned
+quoted, e.g. '"apple pie"', and the single words it covers are not returned.
 """
 class Rocchio(object):
     ## the constructor
     #  @param alpha weight of relevant document vectors, type: float
     #  @param beta weight of irrelevant document vectors, type: float
-    def __init__(self, alpha=1.0, beta=0.0):
-        self.rel = set() # set of relevant documents
+    #  @param backend 'python' for per-word weighting, or 'matrix' for the
+    #         vectorized numpy weighting, type: str
+    #  @param dfindex corpus-wide document frequencies, type: DFIndex
+    #  @param blend weight of the corpus-wide idf against the idf of the
+    #         session documents, in [0, 1], type: float
+    #  @param phrases (False) True to generate phrases as well, from the
+    #         positions of the words, python backend only, type: bool
+    def __init__(self, alpha=1.0, beta=0.0, backend='python', dfindex=None, blend=0.5,
+                 phrases=False):
+        if phrases and backend != 'python':
+            raise ValueError("phrases are not supported by the {} backend".format(backend))
+        self.phrases = phrases
+        self.vocab = Vocabulary() # term IDs shared by both inverted-files
+
+        self.rel = set() # keys of relevant documents
         self.rel_size = 0 # number of relevant documents
-        self.rel_invf = InvertedFiles() # inverted-files
+        self.rel_invf = InvertedFiles(vocab=self.vocab, positional=phrases) # inverted-files
 
-        self.irrel = set() # set of irrelevant documents
+        self.irrel = set() # keys of irrelevant documents
         self.irrel_size = 0
-        self.irrel_invf = InvertedFiles()
+        self.irrel_invf = InvertedFiles(vocab=self.vocab, positional=phrases)
+
+        # keys and fingerprints of the documents added, a document repeating
+        # one of them, e.g. a mirror of a page, is not counted again
+        self.duplicates = DuplicateIndex()
+
+        # running sums of log(1+tf, 10) of each word over the relevant and 
+        # irrelevant documents, and the document frequency of each word over 
+        # both; they are updated only from newly added documents, and the 
+        # weights are derived from them lazily since idf changes with N
+        self.rel_logtf = defaultdict(float)
+        self.irrel_logtf = defaultdict(float)
+        self.dfs = defaultdict(int)
 
         self.alpha = alpha # weight of relevant documents
         self.beta = beta # weight of irrelevant documents
+        self.backend = backend
 
-        # optionally, maintain a list of stop words, in case 
-        # the collection of documents is not enough to derive a 
-        # small idf value for words like 'is' and 'the'
-        self.stops = self.__gen_stop_words()
+        # optionally, blend in the idf of a corpus-wide index, which 
+        # already gives a small idf to words like 'is' and 'the'
+        if not 0 <= blend <= 1:
+            raise ValueError("blend {} not in range [0, 1]".format(blend))
+        self.dfindex = dfindex
+        self.blend = blend if dfindex is not None else 0.0
 
-    ## generate a set of stop words from local file 'stop.txt', if exists
-    #  @return type: set(str)
-    def __gen_stop_words(self):
-        res = set()
-        try:
-            with open('stop.txt', 'r') as f:
-                for l in f.readlines():
-                    res.add(l.rstrip())
-        except:
-            pass
-        return res
+        # otherwise, or while the index is small, maintain a list of stop
+        # words, in case the collection of documents is not enough to derive
+        # a small idf value for words like 'is' and 'the'
+        self.stops = gen_stop_words()
+        self.__clamped = self.stops # the stop words of the current weighting
+
+        # optionally, keep sparse term-document matrices of the documents 
+        # and compute the weights as whole-array operations
+        if backend == 'matrix':
+            # numpy is only imported when needed
+            from termmatrix import MatrixScorer
+            self.scorer = MatrixScorer(alpha, beta, self.stops, dfindex, self.blend)
+        elif backend == 'python':
+            self.scorer = None
+        else:
+            raise ValueError("invalid backend: {}".format(backend))
 
     ## update relevant and irrelevant document sets
+    #  a document is known by its key, the canonical URL, so that the sets
+    #  can be saved and loaded; a URL returned again in a later iteration is
+    #  therefore counted once, where the document objects themselves used to
+    #  be kept and such a repeat was counted again with each new object
     #  @param rel/irrel type: list[SearchDocument]
     def __update_docs(self, rel, irrel):
         for doc in rel:
-            if doc in self.rel: continue
-            self.rel.add(doc)
+            if doc.key in self.rel or self.__repeats(doc): continue
+            self.rel.add(doc.key)
             self.rel_size += 1
             self.rel_invf.add_document(doc)
+            self.__accumulate(doc, self.rel_logtf)
+            if self.scorer: self.scorer.add_document(doc, True)
         for doc in irrel:
-            if doc in self.irrel: continue
-            self.irrel.add(doc)
+            if doc.key in self.irrel or self.__repeats(doc): continue
+            self.irrel.add(doc.key)
             self.irrel_size += 1
             self.irrel_invf.add_document(doc)
+            self.__accumulate(doc, self.irrel_logtf)
+            if self.scorer: self.scorer.add_document(doc, False)
+
+    ## whether the document repeats another document already added, new
+    #  documents are added to the index of duplicates
+    #  @param doc type: SearchDocument
+    #  @return type: bool
+    def __repeats(self, doc):
+        fingerprint = getattr(doc, 'fingerprint', None)
+        if getattr(doc, 'duplicate_of', None) not in [None, doc.key] or \
+                self.duplicates.near(fingerprint) not in [None, doc.key]:
+            recorder.count('duplicates.skipped')
+            return True
+        self.duplicates.add(doc.key, fingerprint)
+        return False
+
+    ## accumulate term statistics of a newly added document
+    #  @param doc type: SearchDocument
+    #  @param logtf running sums to update, type: dict(key:str, value:float)
+    def __accumulate(self, doc, logtf):
+        for word, freq in doc.tf.items():
+            logtf[word] += log(1+freq, 10)
+            self.dfs[word] += 1
 
     ## calculate idf of the given word 
-    #  document frequency is based on both relevant and irrelevant documents
+    #  document frequency is based on both relevant and irrelevant documents, 
+    #  blended with the corpus-wide idf if there is a document frequency index
     #  @param word type: str
     #  @return type: float
     def __idf(self, word):
+        # number of documents (rel and irrel) the word appears in
+        return self.__term_idf(self.dfs.get(word, 0), (word,))
+
+    ## the stop words whose idf is clamped, none once the blended corpus-wide
+    #  index holds min_corpus_docs documents and gives them a small idf itself
+    #  @return type: frozenset(str)
+    def __stop_words(self):
+        if self.blend and self.dfindex.nr_docs() >= min_corpus_docs:
+            return frozenset()
+        return self.stops
+
+    ## calculate idf of a term, i.e. a word or a phrase, of the given document
+    #  frequency; the corpus-wide idf of a phrase is that of its rarest word,
+    #  the closest to the idf of the phrase itself the index can tell
+    #  @param df number of documents (rel and irrel) the term appears in, type: int
+    #  @param words the words of the term, type: tuple(str)
+    #  @return type: float
+    def __term_idf(self, df, words):
         # total number of documents (rel and irrel)
         n = self.rel_size + self.irrel_size
-        if n == 0: return 0.0
-        # number of documents (rel and irrel) the word appears in
-        df = self.rel_invf.df(word) + self.irrel_invf.df(word)
-        if df == 0: return 0.0
+        if n == 0 or df == 0: return 0.0
         # idf = log(N/df, 10)
         idf = log(float(n)/df, 10)
-        if word in self.stops:
-            # for a known stop word, e.g. 'is', 'and', assign
-            # an arbitrary small idf
+        if self.blend:
+            corpus_idfs = [i for i in map(self.dfindex.idf, words) if i is not None]
+            if corpus_idfs:
+                idf = (1 - self.blend) * idf + self.blend * max(corpus_idfs)
+        if all(w in self.__clamped for w in words):
+            # for a known stop word, e.g. 'is', 'and', or a phrase of stop
+            # words only, assign an arbitrary small idf
             idf = min(idf, 0.0001)
         return idf
 
@@ -92,13 +212,12 @@ class Rocchio(object):
     #  @param idfs idf values cache, type: dict(key:str, value:float)
     #  @param blacklist words to be ignored, type: list[str]
     def __weight_rel(self, weights, idfs, blacklist):
-        for word in self.rel_invf.words():
+        for word, logtf in self.rel_logtf.items():
             if word in blacklist: continue
             # idf
             idfs[word] = idf = self.__idf(word)
-            # tf-idf, where tf is obtained from inverted-files
-            weights[word] = sum(map(lambda x:log(1+x, 10), \
-                self.rel_invf.tfs(word).values())) * idf if idf else 0
+            # tf-idf, where the sum of log tf is maintained incrementally
+            weights[word] = logtf * idf if idf else 0
 
     ## update weights of words w.r.t irrelevant documents
     #  for weights(vectors) generated from relevant documents, subtract the 
@@ -110,12 +229,50 @@ class Rocchio(object):
         for word, rel_weight in weights.items():
             # calculate sum of irrelevant weights
             idf = idfs[word]
-            irrel_weight = sum(map(lambda x:log(1+x, 10), \
-                self.irrel_invf.tfs(word).values())) * idf if idf else 0
+            irrel_weight = self.irrel_logtf.get(word, 0.0) * idf if idf else 0
             if irrel_weight > 0:
                 weights[word] = max(0.0, float(self.alpha) * rel_weight / self.rel_size \
                     - float(self.beta) * irrel_weight / self.irrel_size)
 
+    ## weight of a phrase, as __weight_rel() and __weight_irrel() weight a
+    #  word, from the documents the phrase occurs in, with the same idf
+    #  @param words type: tuple(str)
+    #  @return type: float
+    def __weight_phrase(self, words):
+        rel_tfs = self.rel_invf.phrase_tfs(words)
+        # a phrase of a single relevant document is most likely a coincidence
+        if len(rel_tfs) < min(2, self.rel_size):
+            return 0.0
+        irrel_tfs = self.irrel_invf.phrase_tfs(words)
+        idf = self.__term_idf(len(rel_tfs) + len(irrel_tfs), words)
+        weight = sum(log(1+tf, 10) for tf in rel_tfs.itervalues()) * idf
+        irrel_weight = sum(log(1+tf, 10) for tf in irrel_tfs.itervalues()) * idf
+        if self.beta > 0 and irrel_weight > 0:
+            weight = max(0.0, float(self.alpha) * weight / self.rel_size \
+                - float(self.beta) * irrel_weight / self.irrel_size)
+        return weight
+
+    ## calculate weights of phrases of the best words
+    #  the ordered pairs of the best words are weighted, then the best pairs
+    #  are extended by one more of the best words on either side
+    #  @param weights tf-idf vector of words, type: dict(key:str, value:float)
+    #  @return phrases to weights, type: dict(key:tuple(str), value:float)
+    def __weight_phrases(self, weights):
+        seeds = [w for w, x in nlargest(phrase_seeds, weights.items(), key=lambda x:x[1]) if x > 0]
+        res = {}
+        for a in seeds:
+            for b in seeds:
+                if a != b:
+                    res[(a, b)] = self.__weight_phrase((a, b))
+        pairs = [p for p in nlargest(phrase_seeds, res, key=res.get) if res[p] > 0]
+        for pair in pairs:
+            for c in seeds:
+                if c in pair: continue
+                for words in [pair + (c,), (c,) + pair]:
+                    if words not in res:
+                        res[words] = self.__weight_phrase(words)
+        return dict((p, x) for p, x in res.items() if x > 0)
+
     ## generate k query terms based on relevant and irrelevant documents
     #  after calculating new vector of query terms using Rocchio's algorithm, 
     #  the top k terms with largest weights will be returned
@@ -124,20 +281,117 @@ class Rocchio(object):
     #  @param irrel irrelevant documents, type: set(SearchDocument)
     #  @param blacklist words to be ignored, type: list[str], default []
     #  @param k number of new query terms, type: int
+    #  @return words, and quoted phrases if enabled, type: list[str]
     def generate_query(self, rel, irrel, blacklist=[], k=2):
         # update local data by adding new documents
-        self.__update_docs(rel, irrel)
+        with recorder.span('update'):
+            self.__update_docs(rel, irrel)
+        recorder.gauge('vocabulary', len(self.vocab))
+        self.__clamped = self.__stop_words()
+
+        with recorder.span('weight'):
+            if self.scorer:
+                self.scorer.stops = self.__clamped
+                return self.scorer.top_terms(blacklist, k)
+
+            # the weights of each word, and a cache of idf of each word
+            weights, idfs = {}, {}
+
+            # first calculate the weights of each word in relevant documents, 
+            # for each word, it is the sum of its tf-idf value in all relevant docs
+            self.__weight_rel(weights, idfs, blacklist)
+
+            # if necessary, update the weights w.r.t irrelevant documents
+            if self.beta > 0 and self.irrel_size:
+                self.__weight_irrel(weights, idfs)
+
+            if not self.phrases:
+                # find the first k words with maximum weights
+                return [i[0] for i in nlargest(k, weights.items(), key=lambda x:x[1])]
+
+        with recorder.span('phrases'):
+            # the words of phrases already in the query are ignored as well
+            used = set(w for term in blacklist for w in term.strip('"').split())
+            for word in used:
+                weights.pop(word, None)
+            terms = dict(((w,), x) for w, x in weights.items())
+            terms.update(self.__weight_phrases(weights))
+            # the best terms, skipping those overlapping a term chosen before
+            res, chosen = [], set()
+            for words in sorted(terms, key=terms.get, reverse=True):
+                if len(res) == k:
+                    break
+                if chosen.intersection(words):
+                    continue
+                chosen.update(words)
+                res.append(words[0] if len(words) == 1 else '"{}"'.format(' '.join(words)))
+            recorder.count('phrases', sum(1 for t in res if t.startswith('"')))
+            return res
 
-        # the weights of each word, and a cache of idf of each word
-        weights, idfs = {}, {}
+    ## save the state of the session to a snapshot file
+    #  the vocabulary, the postings of both inverted-files, the keys and
+    #  fingerprints of the documents and the running sums are saved; the
+    #  documents are not, nor the positions of the words, so the phrases of a
+    #  loaded session come from the documents added after it is loaded
+    #  @param path type: str
+    def save(self, path):
+        terms = [self.vocab.term(tid) for tid in range(len(self.vocab))]
+        with SnapshotWriter(path) as w:
+            w.add('meta', json.dumps({'alpha': self.alpha, 'beta': self.beta,
+                                      'backend': self.backend, 'phrases': self.phrases}))
+            self.vocab.save(w, 'vocab')
+            self.rel_invf.save(w, 'rel')
+            self.irrel_invf.save(w, 'irrel')
+            self.duplicates.save(w, 'dups')
+            w.add('rel.logtf', array('d', [self.rel_logtf.get(t, 0.0) for t in terms]).tostring())
+            w.add('irrel.logtf', array('d', [self.irrel_logtf.get(t, 0.0) for t in terms]).tostring())
+            w.add('dfs', array('I', [self.dfs.get(t, 0) for t in terms]).tostring())
 
-        # first calculate the weights of each word in relevant documents, 
-        # for each word, it is the sum of its tf-idf value in all relevant docs
-        self.__weight_rel(weights, idfs, blacklist)
+    ## load the state of a session saved by save(), nothing is re-tokenized
+    #  and the postings are read from the memory-mapped snapshot on demand
+    #  @param path type: str
+    #  @param dfindex corpus-wide document frequencies, type: DFIndex
+    #  @param blend weight of the corpus-wide idf, type: float
+    #  @return type: Rocchio
+    @classmethod
+    def load(cls, path, dfindex=None, blend=0.5):
+        snapshot = Snapshot(path)
+        meta = json.loads(snapshot.read('meta'))
+        # the matrix backend is rebuilt from the postings below
+        ro = cls(meta['alpha'], meta['beta'], dfindex=dfindex, blend=blend,
+                 phrases=meta.get('phrases', False))
+        ro.vocab = Vocabulary.load(snapshot, 'vocab')
+        ro.rel_invf = InvertedFiles.load(snapshot, 'rel', ro.vocab, ro.phrases)
+        ro.irrel_invf = InvertedFiles.load(snapshot, 'irrel', ro.vocab, ro.phrases)
+        ro.rel = set(ro.rel_invf.document(i).key for i in range(ro.rel_invf.nr_docs()))
+        ro.irrel = set(ro.irrel_invf.document(i).key for i in range(ro.irrel_invf.nr_docs()))
+        ro.rel_size, ro.irrel_size = len(ro.rel), len(ro.irrel)
+        if 'dups.keys' in snapshot:
+            ro.duplicates = DuplicateIndex.load(snapshot, 'dups')
+        else:
+            # saved before the fingerprints were kept
+            for key in ro.rel | ro.irrel:
+                ro.duplicates.add(key)
 
-        # if necessary, update the weights w.r.t irrelevant documents
-        if self.beta > 0 and self.irrel_size:
-            self.__weight_irrel(weights, idfs)
+        # running sums, of the words that have any
+        term = ro.vocab.term
+        for name, sums, typecode in [('rel.logtf', ro.rel_logtf, 'd'),
+                                     ('irrel.logtf', ro.irrel_logtf, 'd'),
+                                     ('dfs', ro.dfs, 'I')]:
+            values = array(typecode)
+            values.fromstring(snapshot.read(name))
+            sums.update((term(tid), v) for tid, v in enumerate(values) if v)
 
-        # find the first k words with maximum weights
-        return [i[0] for i in nlargest(k, weights.items(), key=lambda x:x[1])]
+        if meta['backend'] == 'matrix':
+            from termmatrix import MatrixScorer
+            ro.backend = 'matrix'
+            ro.scorer = MatrixScorer(ro.alpha, ro.beta, ro.stops, dfindex, ro.blend)
+            for invf, relevant in [(ro.rel_invf, True), (ro.irrel_invf, False)]:
+                docs = [DocumentRef(invf.document(i).key, {}) for i in range(invf.nr_docs())]
+                for word in invf.words():
+                    tfs = invf.tfs(word)
+                    for did, freq in zip(tfs.doc_ids(), tfs.values()):
+                        docs[did].tf[word] = freq
+                for doc in docs:
+                    ro.scorer.add_document(doc, relevant)
+        return ro
@@ -1,58 +1,82 @@
-import os
-import urllib
-from bs4 import BeautifulSoup
-from bs4.element import Comment
+from cache import ScrapeCache
+from extract import iter_text
+from fetcher import PageFetcher
+from instrument import recorder
 """Web Scraper class
 
-a web scrapping utility to scrape web page contents, specifically only the 
+a web scrapping utility to scrape web page contents, specifically only the
 text contents in paragraphs
 """
 class WebScraper(object):
     ## the constructor
     #  @param local_dir the local directory containing cached files, type: str
-    def __init__(self, local_dir="scrapings"):
+    #  @param fetcher HTTP client to download pages, type: PageFetcher
+    #  @param cache cache of scraped texts, a ScrapeCache under local_dir
+    #         if not given, type: ScrapeCache
+    #  @param max_words max number of words kept of a page, None for unlimited, type: int
+    def __init__(self, local_dir="scrapings", fetcher=None, cache=None, max_words=20000):
         self.dir = local_dir
+        self.fetcher = fetcher if fetcher else PageFetcher()
+        self.cache = cache if cache else ScrapeCache(local_dir)
+        self.max_words = max_words
 
-    ## check if HTML tag is valid
-    #  copyright from SO answer: https://stackoverflow.com/a/1983219/7164327
-    def __valid_tag(self, elem):
-        if elem.parent.name in ['style', 'script', '[document]', 'head', 'title']:
-            return False
-        elif isinstance(elem, Comment):
-            return False
-        return True
-
-    ## scraping text contents from given URL
-    #  save the texts in a file under self.dir as a cache for future queries
+    ## scraping text contents from given URL, incrementally
+    #  the page is downloaded in chunks and its texts are extracted as they
+    #  arrive, the download stops once self.max_words words are extracted;
+    #  save the texts in the cache under self.dir for future queries
     #  @param url URL to visit, type: str
-    #  @return text contents, type: str
-    def scrape_text(self, url):
-        if not url: return ""
-
-        # mkdir if necessary
-        if not os.path.exists(self.dir) and self.dir:
-            os.makedirs(self.dir)
+    #  @return generator of pieces of text contents, type: generator(str)
+    def iter_text(self, url):
+        if not url: return
 
-        # use hash value of url string to name the cache file
-        fname = "{}/{}.txt".format(self.dir, abs(hash(url)))
-        
-        # try to read from local cached files
-        if os.path.exists(fname):
-            with open(fname, 'r') as f:
-                return f.read()
+        # try to read from local cache
+        contents = self.cache.get(url)
+        if contents is not None:
+            recorder.count('scrape_cache.hit')
+            if contents:
+                yield contents
+            return
+        recorder.count('scrape_cache.miss')
 
         # didn't get anything from cache, scrape from webpage
         try:
-            page = urllib.urlopen(url).read()
+            stream = self.fetcher.open(url)
         except Exception as e:
             print "failed to open URL, {}".format(e)
-            return ""
-        soup = BeautifulSoup(page, 'html.parser')
-        texts = filter(self.__valid_tag, soup.findAll(text=True))
-        ts = [t for t in texts if t != u'\n']
-        contents = u' '.join(ts).encode('ascii', 'ignore')
+            return
+        pieces = []
+        with stream:
+            if stream.status >= 400:
+                print "failed to open URL, HTTP status {}: {}".format(stream.status, url)
+                return
+            try:
+                for piece in iter_text(stream.chunks(), self.max_words):
+                    pieces.append(piece)
+                    yield piece
+            except Exception as e:
+                print "failed to read URL, {}".format(e)
+                return
+
+        # save into local cache
+        recorder.count('scrape.bytes', sum(len(p) for p in pieces))
+        self.cache.put(url, ' '.join(pieces), stream.status)
+
+    ## scraping text contents from given URL
+    #  @param url URL to visit, type: str
+    #  @return text contents, type: str
+    def scrape_text(self, url):
+        return ' '.join(self.iter_text(url))
 
-        # save into local cache file
-        with open(fname, 'w') as f:
-            f.write(contents)
-        return contents
+    ## scraping text contents from several URLs
+    #  pages not in the cache are downloaded concurrently
+    #  @param urls URLs to visit, type: list[str]
+    #  @param cancelled (None) function polled before each URL, the URLs not 
+    #         yet started are skipped once it returns True, type: function()
+    #  @return text contents of each URL, in order, type: list[str]
+    def scrape_many(self, urls, cancelled=None):
+        def scrape(url):
+            if cancelled is not None and cancelled():
+                return ""
+            return self.scrape_text(url)
+        return ["" if isinstance(r, Exception) else r \
+                for r in self.fetcher.map(scrape, urls)]
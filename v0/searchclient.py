@@ -0,0 +1,279 @@
+import httplib
+import json
+import random
+import threading
+import time
+import urllib
+from datetime import date
+from fetcher import PageFetcher
+from instrument import recorder
+
+## the endpoint of the custom search JSON API
+default_endpoint = 'https://www.googleapis.com/customsearch/v1'
+## results per page, the most the API returns
+page_size = 10
+## the API returns no result beyond the 100th
+max_pages = 10
+
+## HTTP status codes of throttled or failed requests worth retrying
+retry_statuses = (429, 500, 502, 503, 504)
+## error reasons of a 403 response, the per-second rate is exceeded
+rate_reasons = ('rateLimitExceeded', 'userRateLimitExceeded')
+## error reasons of a 403 response, the daily quota is spent
+quota_reasons = ('dailyLimitExceeded', 'quotaExceeded')
+
+"""Search Error class
+
+a request of the search API failed, with the HTTP status of its response
+(None if there was no response).
+"""
+class SearchError(IOError):
+    ## the constructor
+    #  @param status type: int
+    #  @param message type: str
+    def __init__(self, status, message):
+        IOError.__init__(self, "search API error {}: {}".format(status, message))
+        self.status = status
+
+"""Quota Exceeded class
+
+the daily quota of search API requests is spent, either as counted by the
+client or as answered by the API.
+"""
+class QuotaExceeded(SearchError):
+    pass
+
+
+"""Token Bucket class
+
+limits the rate of requests: the bucket holds up to capacity tokens and is
+refilled at rate tokens per second, each request takes one token and waits
+for it if the bucket is empty. Bursts of up to capacity requests go through
+at once. Thread-safe.
+"""
+class TokenBucket(object):
+    ## the constructor
+    #  @param rate tokens added per second, type: float
+    #  @param capacity max number of tokens, type: int
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.__tokens = float(capacity)
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    ## take one token, waiting for it if necessary
+    #  @return seconds waited, type: float
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+                self.__last = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return waited
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+"""Search Client class
+
+a client of the custom search JSON API, shared by all the sessions of a
+process:
+- the first pages of results of a query are fetched concurrently, up to
+  pages * 10 results;
+- requests are limited to qps per second (with bursts of up to burst
+  requests) by a token bucket, and to daily_quota per day, counted by the
+  client, after which QuotaExceeded is raised without calling the API;
+- throttled and failed requests are retried with exponential backoff and
+  jitter, up to retries times, as are requests that got no response, e.g.
+  for a lost connection, which are not charged to the quota;
+- identical queries in flight at the same time, e.g. from concurrent
+  sessions, are sent once and their callers share the result.
+The requests spent by each session are counted. The endpoint can be any
+server answering as the API does, e.g. a local fake for tests.
+"""
+class SearchClient(object):
+    ## the constructor
+    #  @param api the Google search API key, type: str
+    #  @param engine the Google search engine ID, type: str
+    #  @param endpoint (None) URL of the API, default_endpoint if None, type: str
+    #  @param pages (1) number of result pages per query, at most 10, type: int
+    #  @param qps (5.0) max requests per second, type: float
+    #  @param burst (10) max requests at once, type: int
+    #  @param daily_quota (100) max requests per day, None for unlimited, type: int
+    #  @param retries (4) max retries of a throttled request, type: int
+    #  @param backoff (0.5) seconds before the first retry, doubled after
+    #         each one, type: float
+    #  @param connections (10) max concurrent requests to the endpoint, shared by
+    #         all the sessions, unless a fetcher is given, type: int
+    #  @param fetcher (None) HTTP client, type: PageFetcher
+    def __init__(self, api, engine, endpoint=None, pages=1, qps=5.0, burst=10,
+                 daily_quota=100, retries=4, backoff=0.5, connections=10, fetcher=None):
+        if not 1 <= pages <= max_pages:
+            raise ValueError("pages {} not in range [1, {}]".format(pages, max_pages))
+        self.api = api
+        self.engine = engine
+        self.endpoint = endpoint or default_endpoint
+        self.pages = pages
+        self.daily_quota = daily_quota
+        self.retries = retries
+        self.backoff = backoff
+        self.fetcher = fetcher if fetcher else PageFetcher(workers=connections,
+                                                           per_host=connections)
+        self.bucket = TokenBucket(qps, burst)
+        self.__lock = threading.Lock()
+        self.__inflight = {} # query to the call in flight
+        self.__day, self.__spent = date.today(), 0 # requests spent today
+        self.__sessions = {} # requests spent by each session
+        self.__stats = {'queries': 0, 'requests': 0, 'coalesced': 0, 'retries': 0,
+                        'throttled': 0, 'connection_errors': 0, 'waited': 0.0}
+
+    ## search the given query, the result of a call in flight is shared
+    #  @param query type: str
+    #  @param session (None) ID of the session the requests are counted to
+    #  @return JSON formatted result, the items of all pages, type: dict
+    def search(self, query, session=None):
+        with self.__lock:
+            call = self.__inflight.get(query)
+            leader = call is None
+            if leader:
+                call = self.__inflight[query] = {'done': threading.Event(),
+                                                 'res': None, 'error': None}
+                self.__stats['queries'] += 1
+            else:
+                self.__stats['coalesced'] += 1
+        if not leader:
+            recorder.count('search_api.coalesced')
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['res']
+
+        try:
+            call['res'] = self.__search(query, session)
+            return call['res']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__inflight[query]
+            call['done'].set()
+
+    ## fetch the pages of a query concurrently
+    #  @param query type: str
+    #  @param session ID of the session, type: str
+    #  @return type: dict
+    def __search(self, query, session):
+        starts = [1 + page_size * i for i in range(self.pages)]
+        pages = self.fetcher.map(lambda start: self.__page(query, start, session), starts)
+        if isinstance(pages[0], Exception):
+            raise pages[0]
+        res = pages[0]
+        items = list(res.get('items', []))
+        # the pages after a short or failed page are dropped
+        for page in pages[1:]:
+            if isinstance(page, Exception) or len(items) % page_size:
+                break
+            items += page.get('items', [])
+        res['items'] = items
+        return res
+
+    ## spend one request of the daily quota
+    #  @param session ID of the session, type: str
+    def __spend(self, session):
+        with self.__lock:
+            today = date.today()
+            if today != self.__day:
+                self.__day, self.__spent = today, 0
+            if self.daily_quota is not None and self.__spent >= self.daily_quota:
+                raise QuotaExceeded(None, "daily quota of {} requests spent".format(
+                    self.daily_quota))
+            self.__spent += 1
+            self.__sessions[session] = self.__sessions.get(session, 0) + 1
+            self.__stats['requests'] += 1
+        recorder.count('search_api.calls')
+
+    ## give back the request of a session that got no response
+    #  @param session ID of the session, type: str
+    def __refund(self, session):
+        with self.__lock:
+            self.__spent -= 1
+            self.__sessions[session] -= 1
+            self.__stats['requests'] -= 1
+            self.__stats['connection_errors'] += 1
+        recorder.count('search_api.connection_errors')
+
+    ## fetch one page of results, retrying throttled or unanswered requests
+    #  @param query type: str
+    #  @param start index of the first result, from 1, type: int
+    #  @param session ID of the session, type: str
+    #  @return type: dict
+    def __page(self, query, start, session):
+        params = {'key': self.api, 'cx': self.engine, 'start': start, 'num': page_size,
+                  'q': query.encode('utf-8') if isinstance(query, unicode) else query}
+        url = '{}?{}'.format(self.endpoint, urllib.urlencode(sorted(params.items())))
+        for attempt in range(self.retries + 1):
+            self.__spend(session)
+            waited = self.bucket.acquire()
+            with self.__lock:
+                self.__stats['waited'] += waited
+            try:
+                status, body = self.fetcher.fetch(url)
+            except (IOError, httplib.HTTPException) as e:
+                self.__refund(session)
+                if attempt == self.retries:
+                    raise SearchError(None, "connection failed after {} retries: {}".format(
+                        attempt, e))
+            else:
+                if status == 200:
+                    return json.loads(body)
+
+                reason = error_reason(body)
+                if status == 403 and reason in quota_reasons:
+                    raise QuotaExceeded(status, reason)
+                if status not in retry_statuses and \
+                        not (status == 403 and reason in rate_reasons):
+                    raise SearchError(status, reason or body[:200])
+                with self.__lock:
+                    self.__stats['throttled'] += 1
+                if attempt == self.retries:
+                    raise SearchError(status, "still throttled after {} retries".format(attempt))
+            with self.__lock:
+                self.__stats['retries'] += 1
+            recorder.count('search_api.retries')
+            time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    ## requests spent by the given session
+    #  @param session ID of the session
+    #  @return type: int
+    def spent(self, session):
+        with self.__lock:
+            return self.__sessions.get(session, 0)
+
+    ## counters of the client
+    #  @return type: dict(key:str, value:number)
+    def stats(self):
+        with self.__lock:
+            res = dict(self.__stats)
+            res['spent_today'] = self.__spent
+            res['sessions'] = len(self.__sessions)
+        return res
+
+
+## the reason of an error response of the API
+#  @param body type: str
+#  @return None if not a JSON error, type: str
+def error_reason(body):
+    try:
+        error = json.loads(body)['error']
+    except (ValueError, KeyError, TypeError):
+        return None
+    for e in error.get('errors', []):
+        if e.get('reason'):
+            return e['reason']
+    return error.get('status') or error.get('message')
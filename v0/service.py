@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from gsearch import *
+from rocchio import *
+from tokenizer import tokenizer
+
+"""Session class
+
+the state of one relevance feedback session: its own Rocchio instance and
+the current query terms. Requests of a session are serialized by its lock,
+different sessions run concurrently.
+"""
+class Session(object):
+    ## the constructor
+    #  @param sid session ID, type: str
+    #  @param query initial query string, type: str
+    #  @param alpha weight of relevant documents, type: float
+    #  @param beta weight of irrelevant documents, type: float
+    #  @param backend Rocchio weighting backend, type: str
+    def __init__(self, sid, query=u'', alpha=0.75, beta=0.25, backend='python'):
+        self.id = sid
+        self.query_terms = [unicode(i) for i in query.split()]
+        self.rocchio = Rocchio(alpha, beta, backend=backend)
+        self.iteration = 0
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+    ## submit one round of results and judgments, and expand the query
+    #  @param items "items" of Google search results, type: list[dict]
+    #  @param relevant links of the relevant items, type: list[str]
+    #  @param k number of new query terms, type: int
+    #  @return new query terms, type: list[str]
+    def feedback(self, items, relevant, k=2):
+        # the words are interned in the vocabulary of the session, which is
+        # dropped with it
+        docs = [SearchDocument(i, stemming=True, normalize=True, vocab=self.rocchio.vocab) \
+                for i in items]
+        relevant = set(relevant)
+        rel = set(d for d in docs if d.url in relevant or d.key in relevant)
+        irrel = set(docs) - rel
+        terms = self.rocchio.generate_query(rel, irrel, self.query_terms, k)
+        self.query_terms += terms
+        self.iteration += 1
+        return terms
+
+    ## save the session to "<sid>.snap" and "<sid>.json" in the given directory
+    #  @param directory type: str
+    def save(self, directory):
+        path = os.path.join(directory, self.id)
+        self.rocchio.save(path + '.snap')
+        with open(path + '.json', 'w') as f:
+            json.dump({'query_terms': self.query_terms, 'iteration': self.iteration}, f)
+
+    ## load a session saved by save()
+    #  @param directory type: str
+    #  @param sid session ID, type: str
+    #  @return type: Session
+    @classmethod
+    def load(cls, directory, sid):
+        path = os.path.join(directory, sid)
+        with open(path + '.json', 'r') as f:
+            state = json.load(f)
+        session = cls(sid)
+        session.rocchio = Rocchio.load(path + '.snap')
+        session.query_terms = state['query_terms']
+        session.iteration = state['iteration']
+        return session
+
+    ## state of the session
+    #  @return type: dict
+    def status(self):
+        return {'id': self.id, 'query': u' '.join(self.query_terms),
+                'iteration': self.iteration, 'relevant': self.rocchio.rel_size,
+                'irrelevant': self.rocchio.irrel_size, 'last_used': self.last_used}
+
+
+"""Session Manager class
+
+keeps the sessions of the service, idle sessions expire after a TTL and are
+removed by a background reaper thread. Stop words, the stemming cache and
+the result and scrape caches are module-level and shared by all sessions;
+the words of the documents are interned in the vocabulary of each session,
+so they are freed with it.
+
+With a snapshot directory, expired sessions are saved there rather than
+dropped, and a session not in memory is loaded from there on its next
+request, e.g. after a restart or by another process of the service.
+"""
+class SessionManager(object):
+    ## the constructor
+    #  @param ttl seconds of inactivity before a session expires, type: float
+    #  @param snapshot_dir (None) directory of saved sessions, type: str
+    def __init__(self, ttl=1800, snapshot_dir=None):
+        self.ttl = ttl
+        self.snapshot_dir = snapshot_dir
+        if snapshot_dir and not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        self.__sessions = {}
+        # expired sessions being saved, by ID
+        self.__saving = {}
+        self.__lock = threading.Lock()
+        reaper = threading.Thread(target=self.__reap)
+        reaper.daemon = True
+        reaper.start()
+
+    ## create a session
+    #  @param options keyword arguments of Session
+    #  @return type: Session
+    def create(self, **options):
+        session = Session(uuid.uuid4().hex, **options)
+        with self.__lock:
+            self.__sessions[session.id] = session
+        return session
+
+    ## get a session by ID, and mark it as used
+    #  @param sid type: str
+    #  @return None if not found or expired, type: Session
+    def get(self, sid):
+        with self.__lock:
+            session = self.__sessions.get(sid)
+            if session is None and sid in self.__saving:
+                # back from expiry before its snapshot is written
+                session = self.__sessions[sid] = self.__saving[sid]
+            if session is None and self.snapshot_dir:
+                try:
+                    session = self.__sessions[sid] = Session.load(self.snapshot_dir, sid)
+                except (IOError, OSError, ValueError, KeyError):
+                    pass
+        if session is not None:
+            session.last_used = time.time()
+        return session
+
+    ## remove a session
+    #  @param sid type: str
+    #  @return True if removed, type: bool
+    def remove(self, sid):
+        with self.__lock:
+            removed = self.__sessions.pop(sid, None) is not None
+            if self.snapshot_dir:
+                for ext in ['.snap', '.json']:
+                    try:
+                        os.remove(os.path.join(self.snapshot_dir, sid + ext))
+                        removed = True
+                    except OSError:
+                        pass
+        return removed
+
+    ## remove all sessions idle for longer than the TTL
+    #  @return number of removed sessions, type: int
+    def expire(self):
+        deadline = time.time() - self.ttl
+        with self.__lock:
+            expired = [self.__sessions.pop(s) for s, v in self.__sessions.items()
+                       if v.last_used < deadline]
+            if self.snapshot_dir:
+                self.__saving.update((session.id, session) for session in expired)
+        # saved outside the manager lock, which the requests of other sessions need
+        if self.snapshot_dir:
+            for session in expired:
+                try:
+                    with session.lock:
+                        session.save(self.snapshot_dir)
+                finally:
+                    with self.__lock:
+                        self.__saving.pop(session.id, None)
+        return len(expired)
+
+    ## save all sessions, e.g. before shutdown
+    #  @return number of saved sessions, type: int
+    def save_all(self):
+        if not self.snapshot_dir:
+            return 0
+        with self.__lock:
+            sessions = self.__sessions.values()
+        for session in sessions:
+            with session.lock:
+                session.save(self.snapshot_dir)
+        return len(sessions)
+
+    ## background loop expiring idle sessions
+    def __reap(self):
+        while True:
+            time.sleep(max(1.0, self.ttl / 10.0))
+            self.expire()
+
+    def __len__(self):
+        return len(self.__sessions)
+
+
+"""Request Handler class
+
+JSON over HTTP interface of the service:
+    POST   /sessions                 {"query", "alpha", "beta", "backend"} -> status
+    GET    /sessions/<id>            -> status
+    POST   /sessions/<id>/feedback   {"items", "relevant", "k"} -> {"terms", "query"}
+    DELETE /sessions/<id>
+    GET    /stats                    -> counters of sessions and shared caches
+"""
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive
+    wbufsize = -1 # send each response in one write, not a packet per header
+    session_path = re.compile(r'^/sessions/([0-9a-f]+)(/feedback)?/?$')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    ## send a JSON response
+    #  @param code HTTP status, type: int
+    #  @param obj type: dict
+    def __reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ## the JSON body of the request
+    #  @return type: dict
+    def __body(self):
+        n = int(self.headers.getheader('content-length') or 0)
+        return json.loads(self.rfile.read(n)) if n else {}
+
+    ## the session of the request path
+    #  @return (session, True if path ends with /feedback), type: tuple(Session, bool)
+    def __session(self):
+        m = self.session_path.match(self.path)
+        if not m:
+            return None, False
+        return self.server.sessions.get(m.group(1)), bool(m.group(2))
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            return self.__reply(200, {'sessions': len(self.server.sessions),
+                                      'stem_cache': tokenizer.stats(),
+                                      'query_store': store.stats(),
+                                      'scrape_cache': SearchDocument.scraper.cache.stats(),
+                                      'shared_vocabulary': len(vocabulary)})
+        session, action = self.__session()
+        if session is None or action:
+            return self.__reply(404, {'error': 'not found'})
+        self.__reply(200, session.status())
+
+    def do_POST(self):
+        try:
+            body = self.__body()
+        except ValueError as e:
+            return self.__reply(400, {'error': 'invalid JSON: {}'.format(e)})
+
+        if self.path.rstrip('/') == '/sessions':
+            try:
+                session = self.server.sessions.create(
+                    query=body.get('query', u''), alpha=float(body.get('alpha', 0.75)),
+                    beta=float(body.get('beta', 0.25)), backend=body.get('backend', 'python'))
+            except (ValueError, TypeError) as e:
+                return self.__reply(400, {'error': str(e)})
+            except ImportError as e:
+                # the backend's dependency is not installed on the server
+                return self.__reply(501, {'error': str(e)})
+            return self.__reply(201, session.status())
+
+        session, action = self.__session()
+        if session is None or not action:
+            return self.__reply(404, {'error': 'not found'})
+        try:
+            with session.lock:
+                terms = session.feedback(body.get('items', []), body.get('relevant', []),
+                                         int(body.get('k', 2)))
+                query = u' '.join(session.query_terms)
+        except (KeyError, ValueError, TypeError) as e:
+            return self.__reply(400, {'error': 'invalid feedback: {}'.format(e)})
+        self.__reply(200, {'terms': terms, 'query': query})
+
+    def do_DELETE(self):
+        m = self.session_path.match(self.path)
+        if not m or m.group(2) or not self.server.sessions.remove(m.group(1)):
+            return self.__reply(404, {'error': 'not found'})
+        self.__reply(200, {'id': m.group(1)})
+
+
+"""Query Expansion Server class
+
+a long-running multi-threaded HTTP server of relevance feedback sessions,
+one thread per connection.
+"""
+class ExpansionServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # the default backlog of 5 drops bursts of connections
+
+    ## the constructor
+    #  @param address (host, port), type: tuple(str, int)
+    #  @param ttl seconds of inactivity before a session expires, type: float
+    #  @param verbose True to log every request, type: bool
+    #  @param snapshot_dir (None) directory of saved sessions, type: str
+    def __init__(self, address, ttl=1800, verbose=False, snapshot_dir=None):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.sessions = SessionManager(ttl, snapshot_dir)
+        self.verbose = verbose
+
+
+## main
+def main(args):
+    # load the shared stop words up front, rather than on the first session
+    gen_stop_words()
+    tokenizer.persist()
+    server = ExpansionServer((args.host, args.port), args.ttl, args.verbose, args.snapshots)
+    print "serving on {}:{}".format(*server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.sessions.save_all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Relevance Feedback Service')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8111, help='port to listen on')
+    parser.add_argument('--ttl', type=float, default=1800,
+                        help='seconds of inactivity before a session expires')
+    parser.add_argument('--verbose', action="store_true", help='log every request')
+    parser.add_argument('--snapshots', type=str,
+                        help='directory to save idle sessions to and resume them from')
+
+    main(parser.parse_args())
@@ -0,0 +1,128 @@
+import mmap
+import os
+import struct
+
+## header of a snapshot file: magic, number of sections
+header = struct.Struct('<4sI')
+magic = 'SNP1'
+## entry of the section table: name, offset and size
+section = struct.Struct('<16sQQ')
+
+## pack strings into a table of offsets followed by the UTF-8 strings
+#  @param strings type: list[str]
+#  @return type: str
+def pack_strings(strings):
+    data = [s.encode('utf-8') if isinstance(s, unicode) else s for s in strings]
+    offsets, pos = [0], 0
+    for s in data:
+        pos += len(s)
+        offsets.append(pos)
+    return struct.pack('<I{}I'.format(len(offsets)), len(data), *offsets) + ''.join(data)
+
+"""Snapshot Writer class
+
+writes named sections of binary data to a snapshot file, see Snapshot. The
+file is written to a temporary name and renamed on close(), so that a
+snapshot is never seen half written.
+"""
+class SnapshotWriter(object):
+    ## the constructor
+    #  @param path type: str
+    def __init__(self, path):
+        self.path = path
+        self.__sections = [] # (name, data)
+
+    ## add a section
+    #  @param name at most 16 characters, type: str
+    #  @param data type: str
+    def add(self, name, data):
+        if len(name) > 16:
+            raise ValueError("section name too long: {}".format(name))
+        self.__sections.append((name, data))
+
+    ## write the snapshot file
+    def close(self):
+        d = os.path.dirname(self.path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        pos = header.size + section.size * len(self.__sections)
+        table = []
+        for name, data in self.__sections:
+            # sections are 8-byte aligned
+            pos += -pos % 8
+            table.append(section.pack(name, pos, len(data)))
+            pos += len(data)
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(header.pack(magic, len(self.__sections)))
+            f.write(''.join(table))
+            for name, data in self.__sections:
+                f.write('\0' * (-f.tell() % 8))
+                f.write(data)
+        os.rename(tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        if exc is None:
+            self.close()
+
+
+"""Snapshot class
+
+a read-only, memory-mapped file of named binary sections, the format of
+saved sessions. The sections are read in place: nothing is copied until a
+part of a section is asked for, and the pages are shared by every process
+that has the file open. The layout is:
+    header      magic, number of sections
+    table       name, offset and size of each section
+    sections    the data of each section, 8-byte aligned
+"""
+class Snapshot(object):
+    ## the constructor
+    #  @param path type: str
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        tag, n = header.unpack_from(self.mm, 0)
+        if tag != magic:
+            raise ValueError("not a snapshot: {}".format(path))
+        self.__sections = {}
+        for i in range(n):
+            name, offset, size = section.unpack_from(self.mm, header.size + section.size * i)
+            self.__sections[name.rstrip('\0')] = (offset, size)
+
+    def __contains__(self, name):
+        return name in self.__sections
+
+    ## offset and size of a section
+    #  @param name type: str
+    #  @return type: tuple(int, int)
+    def section(self, name):
+        try:
+            return self.__sections[name]
+        except KeyError:
+            raise KeyError("no section {} in snapshot {}".format(name, self.path))
+
+    ## the data of a section
+    #  @param name type: str
+    #  @return type: str
+    def read(self, name):
+        offset, size = self.section(name)
+        return self.mm[offset:offset + size]
+
+    ## the strings of a section written by pack_strings
+    #  @param name type: str
+    #  @return type: list[unicode]
+    def strings(self, name):
+        offset, _ = self.section(name)
+        n = struct.unpack_from('<I', self.mm, offset)[0]
+        offsets = struct.unpack_from('<{}I'.format(n + 1), self.mm, offset + 4)
+        base = offset + 4 * (n + 2)
+        data = self.mm[base:base + offsets[-1]]
+        return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in xrange(n)]
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,177 @@
+import threading
+from gsearch import gsearch
+from instrument import recorder
+
+"""Speculator class
+
+computes the query expansion in the background while the user is still
+judging the results, and prefetches the search (and scrapes) of the likely
+next query, so that the next iteration is ready once the last document is
+judged.
+
+After each judgment a worker thread folds the judged documents into the
+Rocchio instance and generates the new query terms; documents already added
+are skipped by Rocchio, so the final generate_query() of the iteration only
+adds the last judgments. Whenever the generated terms change, the prefetch
+of the previous guess is cancelled and the new query is prefetched. To bound
+the API calls spent on guesses, at most max_prefetches queries are
+prefetched per iteration, and only after min_judged judgments with at least
+one relevant document.
+
+The Rocchio instance is only used by the worker between begin() and wait(),
+the caller must not use it in the meantime.
+"""
+class Speculator(object):
+    ## the constructor
+    #  @param rocchio the Rocchio instance of the session, type: Rocchio
+    #  @param api the Google search API key, type: str
+    #  @param engine the Google search engine ID, type: str
+    #  @param htmltext (False) True to prefetch the html text of webpages as well
+    #  @param k number of new query terms, type: int
+    #  @param min_judged judgments before the first prefetch, type: int
+    #  @param max_prefetches prefetched queries per iteration, type: int
+    #  @param backend (None) the source of results, Google search API if None, type: SearchBackend
+    #  @param passages (False) True to count only the passages of the html texts
+    #         around the query terms
+    def __init__(self, rocchio, api, engine, htmltext=False, k=2, min_judged=3,
+                 max_prefetches=3, backend=None, passages=False):
+        self.rocchio = rocchio
+        self.api = api
+        self.engine = engine
+        self.backend = backend
+        self.htmltext = htmltext
+        self.passages = passages
+        self.k = k
+        self.min_judged = min_judged
+        self.max_prefetches = max_prefetches
+        self.terms = None # the latest guess of the new query terms
+        self.__cond = threading.Condition()
+        self.__query_terms = []
+        self.__rel, self.__irrel = set(), set()
+        self.__dirty = False # judgments not yet folded into the expansion
+        self.__busy = False # the worker is expanding the query
+        self.__closed = False
+        self.__prefetch = None # the prefetch of the latest guess
+        self.__prefetches = 0
+        worker = threading.Thread(target=self.__run)
+        worker.daemon = True
+        worker.start()
+
+    ## start an iteration on the given query terms
+    #  a prefetch not taken by then is cancelled
+    #  @param query_terms type: list[str]
+    def begin(self, query_terms):
+        with self.__cond:
+            self.__cancel()
+            self.__query_terms = list(query_terms)
+            self.__rel, self.__irrel = set(), set()
+            self.__prefetches = 0
+            self.terms = None
+
+    ## record the judgment of one document
+    #  @param doc type: SearchDocument
+    #  @param relevant True if judged relevant, type: bool
+    def judge(self, doc, relevant):
+        with self.__cond:
+            (self.__rel if relevant else self.__irrel).add(doc)
+            self.__dirty = True
+            self.__cond.notify_all()
+
+    ## wait until the worker has folded in every judgment, after which the
+    #  Rocchio instance may be used again
+    def wait(self):
+        with self.__cond:
+            while self.__dirty or self.__busy:
+                self.__cond.wait()
+
+    ## documents of the given query if it has been prefetched
+    #  waits for the prefetch if it is still running
+    #  @param query type: str
+    #  @return None if not prefetched, type: list[SearchDocument]
+    def take(self, query):
+        with self.__cond:
+            p = self.__prefetch
+            if p is None or p['query'] != query:
+                recorder.count('speculate.miss')
+                return None
+            self.__prefetch = None
+        p['done'].wait()
+        recorder.count('speculate.hit' if p['docs'] is not None else 'speculate.miss')
+        return p['docs']
+
+    ## stop the worker and cancel the prefetch
+    def close(self):
+        with self.__cond:
+            self.__closed = True
+            self.__cancel()
+            self.__cond.notify_all()
+
+    ## cancel the running prefetch, the lock must be held
+    def __cancel(self):
+        if self.__prefetch is not None:
+            self.__prefetch['cancelled'] = True
+            self.__prefetch = None
+            recorder.count('speculate.cancelled')
+
+    ## the worker loop, expands the query after each batch of judgments
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not (self.__dirty or self.__closed):
+                    self.__cond.wait()
+                if self.__closed:
+                    return
+                self.__dirty, self.__busy = False, True
+                rel, irrel = list(self.__rel), list(self.__irrel)
+                query_terms = list(self.__query_terms)
+
+            try:
+                if rel and len(rel) + len(irrel) >= self.min_judged:
+                    with recorder.span('speculate'):
+                        terms = self.rocchio.generate_query(rel, irrel, query_terms, self.k)
+                    # start the prefetch before wait() returns, so that it is
+                    # found by take() right after the final expansion
+                    if terms:
+                        self.__speculate(query_terms, terms)
+            finally:
+                with self.__cond:
+                    self.__busy = False
+                    self.__cond.notify_all()
+
+    ## prefetch the query of the given guess, unless already prefetching it
+    #  @param query_terms terms of the current query, type: list[str]
+    #  @param terms the guess of the new terms, type: list[str]
+    def __speculate(self, query_terms, terms):
+        query = " ".join(query_terms + terms)
+        with self.__cond:
+            if query_terms != self.__query_terms:
+                return # a new iteration has begun
+            self.terms = terms
+            if self.__prefetch is not None and self.__prefetch['query'] == query:
+                return
+            if self.__prefetches >= self.max_prefetches:
+                return
+            self.__cancel()
+            self.__prefetches += 1
+            p = self.__prefetch = {'query': query, 'cancelled': False, 'docs': None,
+                                   'done': threading.Event()}
+        t = threading.Thread(target=self.__fetch, args=(p,))
+        t.daemon = True
+        t.start()
+
+    ## run one prefetch, errors are left to the regular search
+    #  @param p the prefetch, type: dict
+    def __fetch(self, p):
+        try:
+            p['docs'] = gsearch(p['query'], self.api, self.engine, htmltext=self.htmltext,
+                                cancelled=lambda: p['cancelled'], backend=self.backend,
+                                duplicates=self.rocchio.duplicates,
+                                positional=self.rocchio.phrases, passages=self.passages,
+                                vocab=self.rocchio.vocab)
+            recorder.count('speculate.prefetch')
+        except Exception:
+            p['docs'] = None
+        finally:
+            if p['cancelled']:
+                p['docs'] = None
+            p['done'].set()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+import time
+from array import array
+from multiprocessing import Pool
+from batch import load_judgments
+from dedup import canonical_url
+from gsearch import SearchDocument, mark_duplicates
+from invfile import DocumentRef
+from qstore import QueryStore
+from rocchio import Rocchio
+from snapshot import Snapshot, SnapshotWriter, pack_strings
+from tokenizer import tokenizer
+from vocab import Vocabulary
+
+## write the documents of every recorded search result to a corpus snapshot
+#  each document is tokenized once, however many results it is part of; the
+#  sections are the vocabulary, the keys, fingerprints and term frequencies
+#  of the documents, and the documents of each normalized query
+#  @param path the corpus snapshot, type: str
+#  @param store the recorded results, type: QueryStore
+#  @param htmltext True to use the cached html text of webpages, which are
+#         never downloaded, type: bool
+#  @return number of queries and documents, type: tuple(int, int)
+def build_corpus(path, store, htmltext=False):
+    docs, index, queries, vocab = [], {}, {}, Vocabulary()
+    for query, res in store.entries():
+        ids = array('I')
+        for item in res.get('items', []):
+            key = canonical_url(item['link'])
+            if key not in index:
+                if htmltext:
+                    text = SearchDocument.scraper.cache.get(item['link']) or ""
+                    doc = SearchDocument(item, stemming=True, htmltext=True, normalize=True,
+                                         text=text, vocab=vocab)
+                else:
+                    doc = SearchDocument(item, stemming=True, normalize=True, vocab=vocab)
+                index[key] = len(docs)
+                docs.append(doc)
+            ids.append(index[key])
+        queries[store.key(query)] = ids
+
+    offsets, tids, freqs, fingerprints = array('I', [0]), array('I'), array('d'), array('I')
+    for doc in docs:
+        tids.extend(doc.tf.ids)
+        freqs.extend(doc.tf.freqs)
+        offsets.append(len(tids))
+        fp = doc.fingerprint or 0
+        fingerprints.extend([fp & 0xffffffff, fp >> 32])
+    names = sorted(queries)
+    qoffsets, qdocs = array('I', [0]), array('I')
+    for q in names:
+        qdocs.extend(queries[q])
+        qoffsets.append(len(qdocs))
+
+    with SnapshotWriter(path) as w:
+        vocab.save(w, 'vocab')
+        w.add('doc.keys', pack_strings([d.key for d in docs]))
+        w.add('doc.offsets', offsets.tostring())
+        w.add('doc.ids', tids.tostring())
+        w.add('doc.freqs', freqs.tostring())
+        w.add('doc.fps', fingerprints.tostring())
+        w.add('q.keys', pack_strings(names))
+        w.add('q.offsets', qoffsets.tostring())
+        w.add('q.docs', qdocs.tostring())
+    return len(names), len(docs)
+
+
+"""Corpus Document class
+
+a document of a corpus snapshot, standing in for SearchDocument: only the
+key, the term frequencies and the fingerprint are kept.
+"""
+class CorpusDocument(DocumentRef):
+    __slots__ = ('fingerprint', 'duplicate_of')
+
+    ## the constructor
+    #  @param key type: str
+    #  @param tf term frequencies, type: dict(key:str, value:float)
+    #  @param fingerprint type: int
+    def __init__(self, key, tf, fingerprint=None):
+        super(CorpusDocument, self).__init__(key, tf)
+        self.fingerprint = fingerprint
+        self.duplicate_of = None
+
+
+"""Corpus class
+
+the recorded search results of a corpus snapshot written by build_corpus(),
+answering queries as a search backend would, without any API call. The
+snapshot is memory-mapped, so every worker process of a sweep shares its
+pages; the documents are read from it when first returned and then kept, so
+that each worker reads each document once for all the settings it evaluates.
+"""
+class Corpus(object):
+    ## the constructor
+    #  @param path the corpus snapshot, type: str
+    def __init__(self, path):
+        self.snapshot = Snapshot(path)
+        self.terms = self.snapshot.strings('vocab')
+        self.keys = self.snapshot.strings('doc.keys')
+        self.__offsets = self.__array('doc.offsets', 'I')
+        self.__fingerprints = self.__array('doc.fps', 'I')
+        self.__base = (self.snapshot.section('doc.ids')[0], self.snapshot.section('doc.freqs')[0])
+        qoffsets, qdocs = self.__array('q.offsets', 'I'), self.__array('q.docs', 'I')
+        self.queries = dict((q, qdocs[qoffsets[i]:qoffsets[i + 1]]) \
+                            for i, q in enumerate(self.snapshot.strings('q.keys')))
+        self.__docs = {} # documents already read, by document ID
+        self.__key = QueryStore().key # the database is never opened
+
+    ## the data of a section as an array
+    #  @param name type: str
+    #  @param typecode type: str
+    #  @return type: array
+    def __array(self, name, typecode):
+        res = array(typecode)
+        res.fromstring(self.snapshot.read(name))
+        return res
+
+    ## the document of the given ID
+    #  @param did type: int
+    #  @return type: CorpusDocument
+    def document(self, did):
+        doc = self.__docs.get(did)
+        if doc is None:
+            start, end = self.__offsets[did], self.__offsets[did + 1]
+            ids, freqs = array('I'), array('d')
+            ids.fromstring(self.snapshot.mm[self.__base[0] + 4 * start:self.__base[0] + 4 * end])
+            freqs.fromstring(self.snapshot.mm[self.__base[1] + 8 * start:self.__base[1] + 8 * end])
+            fp = self.__fingerprints[2 * did] | self.__fingerprints[2 * did + 1] << 32
+            doc = self.__docs[did] = CorpusDocument(
+                self.keys[did], dict(zip([self.terms[t] for t in ids], freqs)), fp or None)
+        return doc
+
+    ## the recorded documents of a query
+    #  @param query type: str
+    #  @return None if the query is not recorded, type: list[CorpusDocument]
+    def search(self, query):
+        ids = self.queries.get(self.__key(query))
+        if ids is None:
+            return None
+        return [self.document(did) for did in ids]
+
+    def close(self):
+        self.snapshot.close()
+
+
+## the corpus and judgments shared by the sessions of a worker process
+context = {}
+
+## set up the shared context of a worker process
+#  @param ctx judgments and settings, type: dict
+def init_worker(ctx):
+    context.update(ctx)
+    context['corpus'] = Corpus(ctx['corpus_path'])
+
+## replay the search-feedback loop of one query under one setting
+#  documents without judgment are treated as irrelevant, as in batch mode;
+#  the session stops when an expanded query was never recorded
+#  @param task (setting, line number, query string), type: tuple(tuple, int, str)
+#  @return per-query record, type: dict
+def run_session(task):
+    (alpha, beta, k), n, query = task
+    corpus, judgments = context['corpus'], context['judgments']
+    query_terms = [unicode(i) for i in query.strip().split()]
+    ro = Rocchio(alpha, beta, backend=context['backend'])
+
+    iteration, precision, status = 0, 0.0, 'max iterations'
+    try:
+        while True:
+            docs = corpus.search(" ".join(query_terms))
+            if docs is None:
+                status = 'not recorded'
+                break
+            # copies are marked again, since the index differs per session
+            for d in docs:
+                d.duplicate_of = None
+            mark_duplicates(docs, ro.duplicates)
+            judged = dict((d, judgments.get(d.key, judgments.get(d.duplicate_of))) for d in docs)
+            rel = set(d for d in docs if judged[d] is True)
+            irrel = set(docs) - rel
+            precision = float(len(rel)) / len(docs) if docs else 0.0
+            iteration += 1
+
+            if precision >= context['target_precision']:
+                status = 'achieved'
+                break
+            elif precision == 0:
+                status = 'zero precision'
+                break
+            if iteration >= context['max_iterations']:
+                break
+            query_terms += ro.generate_query(rel, irrel, query_terms, k)
+    except Exception as e:
+        status = 'error: {}'.format(e)
+    return {'alpha': alpha, 'beta': beta, 'k': k, 'id': n, 'status': status,
+            'precision': precision, 'nr_iterations': iteration}
+
+## summarize the records of each setting, best first: the mean precision,
+#  then the fewest iterations
+#  @param records type: iterable(dict)
+#  @return one row per setting, type: list[dict]
+def summarize(records):
+    settings = {}
+    for r in records:
+        settings.setdefault((r['alpha'], r['beta'], r['k']), []).append(r)
+    rows = []
+    for (alpha, beta, k), rs in settings.items():
+        n = len(rs)
+        rows.append({'alpha': alpha, 'beta': beta, 'k': k, 'queries': n,
+                     'precision': sum(r['precision'] for r in rs) / n,
+                     'iterations': float(sum(r['nr_iterations'] for r in rs)) / n,
+                     'achieved': sum(1 for r in rs if r['status'] == 'achieved'),
+                     'not_recorded': sum(1 for r in rs if r['status'] == 'not recorded')})
+    rows.sort(key=lambda r: (-r['precision'], r['iterations'], r['alpha'], r['beta'], r['k']))
+    return rows
+
+## parse a comma separated list of numbers
+#  @param s type: str
+#  @param cast type: type
+#  @return type: list
+def parse_grid(s, cast=float):
+    return [cast(i) for i in s.split(',') if i.strip()]
+
+
+## main
+def main(args):
+    if not 0 < args.target_precision <= 1.0:
+        print >> sys.stderr, "[ERROR] target precision {} not in range (0, 1]".format(
+            args.target_precision)
+        exit(1)
+    tokenizer.persist()
+
+    if args.rebuild or not os.path.exists(args.corpus):
+        start = time.time()
+        nq, nd = build_corpus(args.corpus, QueryStore(args.queries_db, ttl=None), args.htmltext)
+        print >> sys.stderr, "recorded {} queries, {} documents in {:.2f}s".format(
+            nq, nd, time.time() - start)
+
+    with open(args.queries, 'r') as f:
+        queries = [(n, l.strip()) for n, l in enumerate(f) if l.strip()]
+    grid = [(a, b, k) for a in parse_grid(args.alpha) for b in parse_grid(args.beta) \
+            for k in parse_grid(args.k, int)]
+    tasks = [(s, n, q) for s in grid for n, q in queries]
+    ctx = {'judgments': load_judgments(args.judgments), 'corpus_path': args.corpus,
+           'target_precision': args.target_precision, 'max_iterations': args.max_iterations,
+           'backend': args.backend}
+
+    start = time.time()
+    if args.workers == 1:
+        init_worker(ctx)
+        records = [run_session(t) for t in tasks]
+    else:
+        pool = Pool(args.workers or None, init_worker, (ctx,))
+        try:
+            records = pool.map(run_session, tasks, chunksize=max(1, len(tasks) // 64))
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+    print >> sys.stderr, "evaluated {} settings over {} queries in {:.2f}s".format(
+        len(grid), len(queries), time.time() - start)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+
+    rows = summarize(records)
+    print "{:>6} {:>6} {:>3} {:>9} {:>10} {:>8} {:>12}".format(
+        'alpha', 'beta', 'k', 'precision', 'iterations', 'achieved', 'not recorded')
+    for r in rows[:args.top] if args.top else rows:
+        print "{alpha:>6.2f} {beta:>6.2f} {k:>3d} {precision:>9.3f} {iterations:>10.2f} " \
+              "{achieved:>8d} {not_recorded:>12d}".format(**r)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rocchio parameter sweep over recorded sessions')
+    parser.add_argument('queries', type=str, help='file of initial query strings, one per line')
+    parser.add_argument('--judgments', type=str,
+                        help='file of "<url> <rel|irrel>" rows, default tmp/rel.txt and tmp/irrel.txt')
+    parser.add_argument('--alpha', type=str, default='0.5,0.75,1.0',
+                        help='comma separated weights of relevant documents')
+    parser.add_argument('--beta', type=str, default='0,0.25,0.5',
+                        help='comma separated weights of irrelevant documents')
+    parser.add_argument('-k', type=str, default='1,2,3',
+                        help='comma separated numbers of new query terms per iteration')
+    parser.add_argument('--target-precision', type=float, default=0.9,
+                        help='target precision, (0, 1]')
+    parser.add_argument('--max-iterations', type=int, default=10, help='maximum iterations per query')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes, default number of CPUs')
+    parser.add_argument('--corpus', type=str, default='tmp/sweep.snap',
+                        help='corpus snapshot of the recorded results, built if missing')
+    parser.add_argument('--rebuild', action="store_true",
+                        help='rebuild the corpus snapshot from the query store')
+    parser.add_argument('--queries-db', type=str, default='tmp/queries.db',
+                        help='database of the query store')
+    parser.add_argument('--htmltext', action="store_true",
+                        help='Use the cached html text of webpages instead of snippets')
+    parser.add_argument('--backend', type=str, default='python', choices=['python', 'matrix'],
+                        help='Rocchio weighting backend, "matrix" requires numpy')
+    parser.add_argument('--output', type=str, help='output file of per-query JSON lines')
+    parser.add_argument('--top', type=int, default=0, help='number of settings shown, 0 for all')
+
+    main(parser.parse_args())
@@ -0,0 +1,195 @@
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""Term-document matrix class
+
+A sparse matrix representation of a collection of documents, each row is a
+word and each column is a document, the value of a cell is the term frequency
+of the word in the document. Only per-word statistics are needed, such as
+document frequency and sum of log term frequency, so the non-zero cells are
+kept as parallel arrays of row and value in document order, and reduced
+with numpy bincount as whole-array operations instead of per-word Python
+loops.
+
+Rows are indexed by a vocabulary shared among several matrices, so that rows
+of the relevant and irrelevant matrices refer to the same word.
+"""
+class TermDocMatrix(object):
+    ## the constructor
+    #  @param vocab shared mapping of word to row index, type: dict(key:str, value:int)
+    #  @param words shared list of words indexed by row, type: list[str]
+    def __init__(self, vocab, words):
+        if np is None:
+            raise ImportError("numpy is required for TermDocMatrix")
+        self.vocab = vocab
+        self.words = words
+        self.__rows = array('l') # row (word) index of each non-zero cell
+        self.__vals = array('d') # term frequency of each non-zero cell
+        self.__docs = 0
+        # per-word statistics reduced from the first self.__reduced cells, 
+        # only the cells added afterwards are reduced on the next query
+        self.__reduced = 0
+        self.__df = np.zeros(0, dtype=np.int_)
+        self.__logtf = np.zeros(0)
+
+    ## add one document to the matrix as a new column
+    #  new words are appended to the shared vocabulary
+    #  @param doc type: SearchDocument
+    def add_document(self, doc):
+        for word, freq in doc.tf.items():
+            row = self.vocab.get(word)
+            if row is None:
+                row = self.vocab[word] = len(self.words)
+                self.words.append(word)
+            self.__rows.append(row)
+            self.__vals.append(freq)
+        self.__docs += 1
+
+    ## number of documents (columns) in the matrix
+    #  @return type: int
+    def nr_docs(self):
+        return self.__docs
+
+    ## fold the cells added since the last query into the per-word statistics
+    #  the cost is proportional to the number of new cells, not to the 
+    #  whole matrix
+    def __reduce(self):
+        n = len(self.vocab)
+        if len(self.__df) < n:
+            self.__df = np.concatenate((self.__df, np.zeros(n - len(self.__df), dtype=np.int_)))
+            self.__logtf = np.concatenate((self.__logtf, np.zeros(n - len(self.__logtf))))
+        if self.__reduced < len(self.__rows):
+            rows = np.frombuffer(self.__rows, dtype=np.int_)[self.__reduced:]
+            vals = np.frombuffer(self.__vals, dtype=np.float64)[self.__reduced:]
+            self.__df += np.bincount(rows, minlength=n)
+            self.__logtf += np.bincount(rows, weights=np.log1p(vals) / np.log(10), minlength=n)
+            self.__reduced = len(self.__rows)
+
+    ## document frequency of every word
+    #  @return type: numpy.ndarray(int)
+    def df(self):
+        self.__reduce()
+        return self.__df
+
+    ## sum of log(1+tf, 10) over all documents, for every word
+    #  @return type: numpy.ndarray(float)
+    def logtf_sums(self):
+        self.__reduce()
+        return self.__logtf
+
+
+"""Matrix-based Rocchio scorer
+
+Vectorized counterpart of the per-word weighting in Rocchio, keeps one
+TermDocMatrix for relevant documents and one for irrelevant documents over
+a shared vocabulary, and computes idf, tf-idf and the alpha/beta combination
+for all words at once. The results are the same as the pure-Python path
+within float tolerance.
+"""
+class MatrixScorer(object):
+    ## the constructor
+    #  @param alpha weight of relevant document vectors, type: float
+    #  @param beta weight of irrelevant document vectors, type: float
+    #  @param stops known stop words, type: set(str)
+    #  @param corpus corpus-wide document frequencies, type: DFIndex
+    #  @param blend weight of the corpus-wide idf, in [0, 1], type: float
+    def __init__(self, alpha, beta, stops=set(), corpus=None, blend=0.0):
+        self.alpha = alpha
+        self.beta = beta
+        self.stops = stops
+        self.vocab, self.words = {}, []
+        self.rel = TermDocMatrix(self.vocab, self.words)
+        self.irrel = TermDocMatrix(self.vocab, self.words)
+        # corpus-wide idf of each row, looked up once per word while the
+        # number of documents of the corpus stays the same, NaN if unknown
+        self.corpus = corpus
+        self.blend = blend if corpus is not None else 0.0
+        self.__corpus = np.zeros(0)
+        self.__corpus_size = 0
+
+    ## add one judged document
+    #  @param doc type: SearchDocument
+    #  @param relevant True if the document is relevant, type: bool
+    def add_document(self, doc, relevant):
+        if relevant:
+            self.rel.add_document(doc)
+        else:
+            self.irrel.add_document(doc)
+
+    ## mask of rows of the given words
+    #  @param words type: iterable(str)
+    #  @return type: numpy.ndarray(bool)
+    def __mask(self, words):
+        mask = np.zeros(len(self.vocab), dtype=bool)
+        rows = [self.vocab[w] for w in words if w in self.vocab]
+        if rows:
+            mask[rows] = True
+        return mask
+
+    ## corpus-wide idf of every word, new words are looked up, and all of
+    #  them again once documents are added to the corpus
+    #  @return type: numpy.ndarray(float)
+    def __corpus_idf(self):
+        size = self.corpus.nr_docs()
+        if size != self.__corpus_size:
+            self.__corpus, self.__corpus_size = np.zeros(0), size
+        n = len(self.__corpus)
+        if n < len(self.words):
+            new = [self.corpus.idf(w) for w in self.words[n:]]
+            self.__corpus = np.concatenate((self.__corpus,
+                np.array([np.nan if i is None else i for i in new])))
+        return self.__corpus
+
+    ## calculate the Rocchio weight of every word in the vocabulary
+    #  @param blacklist words to be ignored, type: list[str]
+    #  @return (candidate rows, weights of all rows), type: tuple(numpy.ndarray)
+    def weights(self, blacklist=[]):
+        rel_size, irrel_size = self.rel.nr_docs(), self.irrel.nr_docs()
+        rel_df, irrel_df = self.rel.df(), self.irrel.df()
+
+        # idf = log(N/df, 10), 0.0 for unseen words
+        n = rel_size + irrel_size
+        df = rel_df + irrel_df
+        idf = np.zeros(len(self.vocab))
+        seen = df > 0
+        idf[seen] = np.log10(float(n) / df[seen])
+        if self.blend:
+            corpus = self.__corpus_idf()
+            known = seen & ~np.isnan(corpus)
+            idf[known] = (1 - self.blend) * idf[known] + self.blend * corpus[known]
+        stops = self.__mask(self.stops)
+        idf[stops] = np.minimum(idf[stops], 0.0001)
+
+        # weights of words in relevant documents
+        weights = self.rel.logtf_sums() * idf
+
+        # update weights w.r.t irrelevant documents
+        if self.beta > 0 and irrel_size:
+            irrel_weights = self.irrel.logtf_sums() * idf
+            upd = irrel_weights > 0
+            weights[upd] = np.maximum(0.0,
+                float(self.alpha) * weights[upd] / rel_size - \
+                float(self.beta) * irrel_weights[upd] / irrel_size)
+
+        # only words in relevant documents are candidates
+        candidates = np.flatnonzero((rel_df > 0) & ~self.__mask(blacklist))
+        return candidates, weights
+
+    ## top k words with largest weights
+    #  @param blacklist words to be ignored, type: list[str]
+    #  @param k number of words, type: int
+    #  @return type: list[str]
+    def top_terms(self, blacklist=[], k=2):
+        if k <= 0 or not self.rel.nr_docs():
+            return []
+        candidates, weights = self.weights(blacklist)
+        scores = weights[candidates]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='mergesort')]
+        return [self.words[candidates[i]] for i in top]
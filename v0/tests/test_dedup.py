@@ -0,0 +1,24 @@
+import unittest
+from dedup import canonical_url
+
+class CanonicalUrlTest(unittest.TestCase):
+    def test_variants(self):
+        key = canonical_url('https://www.example.com:443/a/?utm_source=x&b=2&a=1#top')
+        self.assertEqual(key, '//example.com/a?a=1&b=2')
+        self.assertEqual(canonical_url('http://example.com/a?b=2&a=1'), key)
+
+    def test_without_scheme(self):
+        self.assertEqual(canonical_url('www.davidbrin.com/'), '//davidbrin.com/')
+        self.assertEqual(canonical_url('www.davidbrin.com/'),
+                         canonical_url('http://www.davidbrin.com/'))
+        self.assertEqual(canonical_url('//davidbrin.com'), '//davidbrin.com/')
+        self.assertEqual(canonical_url('example.com/a?u=http://b.com/'),
+                         '//example.com/a?u=http://b.com/')
+
+    def test_not_a_url(self):
+        self.assertEqual(canonical_url('/a/b'), '/a/b')
+        self.assertEqual(canonical_url(''), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from fetcher import PageFetcher
+from scraper import WebScraper
+
+## seconds before the server answers a page
+latency = 0.2
+
+"""Request Handler class
+
+serves, after latency seconds:
+    /page/<n>    a page whose text is "hello <n>", with a script and a title
+    /redirect    302 to /page/1
+    /loop        302 to itself
+    /missing     404
+and counts the requests in flight.
+"""
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    ## send a response
+    #  @param code HTTP status, type: int
+    #  @param body type: str
+    #  @param location (None) Location header, type: str
+    def __reply(self, code, body, location=None):
+        self.send_response(code)
+        if location:
+            self.send_header('Location', location)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+        try:
+            time.sleep(latency)
+            if self.path.startswith('/page/'):
+                n = self.path[len('/page/'):]
+                self.__reply(200, '<html><head><title>title {0}</title></head><body>'
+                             '<script>var x = {0};</script><p>hello {0}</p></body></html>'.format(n))
+            elif self.path == '/redirect':
+                self.__reply(302, '', '/page/1')
+            elif self.path == '/loop':
+                self.__reply(302, '', '/loop')
+            else:
+                self.__reply(404, 'not found')
+        finally:
+            with server.lock:
+                server.inflight -= 1
+
+
+"""Local Server class
+
+a multi-threaded stand-in of the web, on a free local port.
+"""
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RequestHandler)
+        self.lock = threading.Lock()
+        self.requests = self.inflight = self.max_inflight = 0
+
+    ## connections kept alive by the client are reset when it closes them
+    def handle_error(self, request, client_address):
+        pass
+
+    ## URL of the given path
+    #  @param path type: str
+    #  @return type: str
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+
+"""Server Test Case class
+
+runs a local server and a fetcher for each test.
+"""
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.fetcher = PageFetcher(workers=8, per_host=3, timeout=5.0)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FetcherTest(ServerTestCase):
+    def test_concurrency(self):
+        start = time.time()
+        res = self.fetcher.fetch_many([self.server.url('/page/{}'.format(i)) for i in range(6)])
+        elapsed = time.time() - start
+        self.assertEqual([r[0] for r in res], [200] * 6)
+        self.assertIn('hello 5', res[5][1])
+        # 6 pages, 3 at a time
+        self.assertEqual(self.server.max_inflight, 3)
+        self.assertLess(elapsed, 4 * latency)
+
+    def test_redirect(self):
+        status, body = self.fetcher.fetch(self.server.url('/redirect'))
+        self.assertEqual(status, 200)
+        self.assertIn('hello 1', body)
+        self.assertRaises(IOError, self.fetcher.fetch, self.server.url('/loop'))
+
+    def test_errors(self):
+        status, _ = self.fetcher.fetch(self.server.url('/missing'))
+        self.assertEqual(status, 404)
+        # a failure is reported in place, the other URLs are fetched
+        res = self.fetcher.fetch_many(['http://127.0.0.1:1/', self.server.url('/page/2')])
+        self.assertIsInstance(res[0], Exception)
+        self.assertEqual(res[1][0], 200)
+
+
+class ScraperTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.scraper = WebScraper(self.dir, fetcher=self.fetcher)
+
+    def tearDown(self):
+        ServerTestCase.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def test_extraction(self):
+        text = self.scraper.scrape_text(self.server.url('/page/7'))
+        self.assertEqual(text.split(), ['hello', '7'])
+        # the second time from the cache
+        requests = self.server.requests
+        self.assertEqual(self.scraper.scrape_text(self.server.url('/page/7')), text)
+        self.assertEqual(self.server.requests, requests)
+
+    def test_scrape_many(self):
+        urls = [self.server.url('/page/1'), self.server.url('/missing'),
+                self.server.url('/redirect')]
+        texts = self.scraper.scrape_many(urls)
+        self.assertEqual([t.split() for t in texts], [['hello', '1'], [], ['hello', '1']])
+
+
+if __name__ == '__main__':
+    unittest.main()
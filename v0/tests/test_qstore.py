@@ -0,0 +1,19 @@
+import unittest
+from qstore import QueryStore
+
+class QueryStoreKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.key = QueryStore().key # the database is never opened
+
+    def test_terms(self):
+        self.assertEqual(self.key(u'Brin  sergey brin'), u'brin sergey')
+
+    def test_phrases(self):
+        self.assertEqual(self.key(u'google "Sergey  Brin" founder'),
+                         self.key(u'founder "sergey brin" google'))
+        self.assertNotEqual(self.key(u'"a b c"'), self.key(u'"a c b"'))
+        self.assertNotEqual(self.key(u'"a b" c'), self.key(u'a b c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
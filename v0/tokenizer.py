@@ -0,0 +1,146 @@
+import atexit
+import marshal
+import os
+import re
+import threading
+from cache import LRUCache
+
+"""Tokenizer class
+
+converts strings to lists of lowercase words without punctuations, with
+optional word stemming. Whitespaces are normalized and punctuations are
+removed from the whole string by two precompiled regular expressions, then
+each distinct word is stemmed once; stemmed words are kept in a bounded LRU
+cache shared by all users of the tokenizer.
+
+Importing nltk takes most of the startup time of the program, so the
+stemming engine is only loaded when a word is not in the cache. The cache
+can be saved to a file and loaded by the next run, and then a run over 
+known words never loads nltk. The cache is saved at exit only by the
+programs that call persist(), not by every importer of the module.
+"""
+class Tokenizer(object):
+    ## whitespaces of any kind
+    spaces = re.compile(r'\s+', re.UNICODE)
+    ## punctuations and underscores, i.e. anything but a word character or ' '
+    puncts = re.compile(r'[^\w ]|_')
+
+    ## global stemming engine, loaded on first use
+    stemmer = None
+    stemmer_lock = threading.Lock()
+
+    ## the constructor
+    #  @param cache_size max number of stemmed words kept in cache, type: int
+    #  @param stems_file (None) file the cache is loaded from and saved to, type: str
+    def __init__(self, cache_size=100000, stems_file=None):
+        self.cache = LRUCache(cache_size)
+        self.stems_file = stems_file
+        self.__loaded = stems_file is None
+        self.__added = 0 # words stemmed since the cache was loaded or saved
+        self.__persistent = False
+
+    ## the stemming engine
+    #  @return None if failed to initialize, type: SnowballStemmer
+    @classmethod
+    def engine(cls):
+        with cls.stemmer_lock:
+            if cls.stemmer is None:
+                try:
+                    from nltk.stem.snowball import SnowballStemmer
+                    cls.stemmer = SnowballStemmer("english")
+                except Exception as e:
+                    print "Tokenizer class failed to initialize stemming engine: {}".format(e)
+                    cls.stemmer = False
+        return cls.stemmer
+
+    ## apply word stemming, e.g. stem("apples") = "appl"
+    #  @param word a lowercase word w/o punctuations, type: str
+    #  @return type: str
+    def stem(self, word):
+        if not self.__loaded:
+            self.load()
+        stemmed = self.cache.get(word)
+        if stemmed is None:
+            stemmer = self.engine()
+            if not stemmer:
+                return word
+            stemmed = stemmer.stem(word)
+            self.cache.put(word, stemmed)
+            self.__added += 1
+        return stemmed
+
+    ## load the saved stems into the cache
+    def load(self):
+        self.__loaded = True
+        try:
+            with open(self.stems_file, 'rb') as f:
+                stems = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        for word, stemmed in stems:
+            self.cache.put(word, stemmed)
+
+    ## save the cache, if any word has been stemmed since it was loaded
+    def save(self):
+        if not self.__added or not self.stems_file:
+            return
+        d = os.path.dirname(self.stems_file)
+        try:
+            if d and not os.path.exists(d):
+                os.makedirs(d)
+            tmp = "{}.{}.tmp".format(self.stems_file, os.getpid())
+            with open(tmp, 'wb') as f:
+                marshal.dump(self.cache.items(), f)
+            os.rename(tmp, self.stems_file)
+            self.__added = 0
+        except (IOError, OSError):
+            pass
+
+    ## save the cache when the program exits, called once by its main function
+    def persist(self):
+        if self.stems_file and not self.__persistent:
+            self.__persistent = True
+            atexit.register(self.save)
+
+    ## split string to lowercase words w/o punctuations, without stemming
+    #  @param s type: str
+    #  @return type: list[str]
+    def split(self, s):
+        return self.puncts.sub('', self.spaces.sub(' ', s.lower())).split()
+
+    ## convert string to list of lowercase words w/o punctuations
+    #  @param s type: str
+    #  @param stemming True to apply word stemming, type: bool
+    #  @return type: list[str]
+    def tokenize(self, s, stemming=True):
+        return self.tokenize_many([s], stemming)[0]
+
+    ## convert several strings to lists of lowercase words w/o punctuations
+    #  each distinct word among all strings is stemmed only once
+    #  @param strings type: list[str]
+    #  @param stemming True to apply word stemming, type: bool
+    #  @return type: list[list[str]]
+    def tokenize_many(self, strings, stemming=True):
+        res = [self.split(s) for s in strings]
+        if not stemming or self.stemmer is False:
+            return res
+        stems = {}
+        for words in res:
+            for w in words:
+                if w not in stems:
+                    stems[w] = self.stem(w)
+        return [[stems[w] for w in words] for words in res]
+
+    ## counters of the stemming cache
+    #  @return type: dict(key:str, value:number)
+    def stats(self):
+        return self.cache.stats()
+
+
+## file of the saved stems, next to the module rather than in the working
+#  directory of the program
+stems_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'stems.marshal')
+
+## tokenizer shared by documents and highlighting, the programs call its
+#  persist() to save its stems for the next run
+tokenizer = Tokenizer(stems_file=stems_file)
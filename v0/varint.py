@@ -0,0 +1,22 @@
+## append a variable-length integer, 7 bits per byte
+#  @param n type: int
+#  @param out type: bytearray
+def put_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+## read a variable-length integer written by put_varint
+#  @param buf type: bytearray
+#  @param pos offset of the integer, type: int
+#  @return (integer, offset past it), type: tuple(int, int)
+def get_varint(buf, pos):
+    x, shift = 0, 0
+    while True:
+        c = buf[pos]
+        pos += 1
+        x |= (c & 0x7f) << shift
+        if c < 0x80:
+            return x, pos
+        shift += 7
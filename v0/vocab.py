@@ -0,0 +1,74 @@
+import sys
+import threading
+from snapshot import pack_strings
+
+"""Vocabulary class
+
+Interns the words of a collection of documents, each distinct word is given
+a dense integer ID, and only one copy of each word string is kept. The same
+vocabulary can be shared by several inverted-files so that their term IDs
+agree. Lookups never add words to the vocabulary. Words are never removed
+either: a vocabulary lives as long as the collection (e.g. the session) it
+belongs to. Words can be added by several threads at once.
+"""
+class Vocabulary(object):
+    ## the constructor
+    def __init__(self):
+        self.__ids = {} # word to term ID
+        self.__terms = [] # term ID to word
+        self.__lock = threading.Lock() # held while adding words
+
+    ## ID of the given word, the word is added if not already known
+    #  @param word type: str
+    #  @return type: int
+    def intern(self, word):
+        tid = self.__ids.get(word)
+        if tid is None:
+            with self.__lock:
+                tid = self.__ids.get(word)
+                if tid is None:
+                    # the word is known only once its term is there
+                    tid = len(self.__terms)
+                    self.__terms.append(word)
+                    self.__ids[word] = tid
+        return tid
+
+    ## ID of the given word, None if unknown
+    #  @param word type: str
+    #  @return type: int
+    def id(self, word):
+        return self.__ids.get(word)
+
+    ## word of the given term ID
+    #  @param tid type: int
+    #  @return type: str
+    def term(self, tid):
+        return self.__terms[tid]
+
+    ## number of words in the vocabulary
+    #  @return type: int
+    def __len__(self):
+        return len(self.__terms)
+
+    ## memory used by the vocabulary, in bytes
+    #  @return type: int
+    def memory_usage(self):
+        return sys.getsizeof(self.__ids) + sys.getsizeof(self.__terms) + \
+            sum(sys.getsizeof(w) for w in self.__terms)
+
+    ## save the vocabulary as a section of a snapshot
+    #  @param writer type: SnapshotWriter
+    #  @param name section name, type: str
+    def save(self, writer, name):
+        writer.add(name, pack_strings(self.__terms))
+
+    ## load a vocabulary from a section of a snapshot
+    #  @param snapshot type: Snapshot
+    #  @param name section name, type: str
+    #  @return type: Vocabulary
+    @classmethod
+    def load(cls, snapshot, name):
+        vocab = cls()
+        vocab.__terms = snapshot.strings(name)
+        vocab.__ids = dict((w, i) for i, w in enumerate(vocab.__terms))
+        return vocab